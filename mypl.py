@@ -6,8 +6,11 @@ DATE: Spring 2024
 """
 
 import argparse
+import asyncio
+import gc
 import sys
 import io
+import os
 
 from mypl_iowrapper import FileWrapper, StdInWrapper
 from mypl_error import MyPLError
@@ -18,7 +21,17 @@ from mypl_ast_parser import ASTParser
 from mypl_printer import PrintVisitor
 from mypl_semantic_checker import SemanticChecker
 from mypl_code_gen import CodeGenerator
-from mypl_vm import VM
+from mypl_vm import VM, Limits
+from mypl_threaded import ThreadedVM
+from mypl_register_vm import RegisterVM
+from mypl_py_gen import PythonGenerator
+from mypl_fusion import FusionPass
+from mypl_profile import Profiler, SamplingProfiler
+from mypl_batch import BatchJob, compile_program, run_batch
+from mypl_async import SessionHost
+from mypl_gc import GCStats
+from mypl_heap import HeapStats
+from mypl_checkpoint import Checkpointer, restore, DEFAULT_INTERVAL
 
 
 def run_lex_mode(in_stream):
@@ -102,14 +115,53 @@ def run_check_mode(in_stream):
 
 
 
-    
-def run_ir_mode(in_stream):
+def run_fusion_pass(vm, report):
+    """Fuses common instruction sequences of the generated code into
+    superinstructions.
+
+    Args:
+        vm -- The VM holding the generated frame templates.
+        report -- If true, print the fusions that fired to standard error.
+
+    """
+    fusion = FusionPass()
+    fusion.run(vm)
+    if report:
+        print(fusion.report(), end='', file=sys.stderr)
+
+
+def run_profiler(vm, report, json_file):
+    """Runs the VM under the profiler.
+
+    Args:
+        vm -- The VM to run.
+        report -- If true, print the profile tables to standard error.
+        json_file -- If given, the name of a file to write the profile to
+                     as JSON.
+
+    """
+    profiler = Profiler()
+    try:
+        profiler.profile(vm)
+    finally:
+        if report:
+            print(profiler.report(), end='', file=sys.stderr)
+        if json_file:
+            with open(json_file, 'w') as out_stream:
+                profiler.write_json(out_stream)
+
+
+def run_ir_mode(in_stream, fuse=False, backend='vm'):
     """Generates the intermediate representation (VM instructions) for the
     given mypl program and prints to standard output the resulting
     instructions.
 
     Args: 
         in_stream -- A wrapped input stream containing a mypl program.
+        fuse -- If true, show the code after the fusion pass.
+        backend -- The execution backend, where 'python' shows the
+                   generated Python source and 'register' the register
+                   code and its size compared to the stack code.
 
     """
     try: 
@@ -118,37 +170,221 @@ def run_ir_mode(in_stream):
         ast = parser.parse()
         visitor = SemanticChecker()
         ast.accept(visitor)
-        vm = VM()
+        if backend == 'python':
+            pygen = PythonGenerator()
+            ast.accept(pygen)
+            print(pygen.source(), end='')
+            return
+        vm = RegisterVM() if backend == 'register' else VM()
         codegen = CodeGenerator(vm)
         ast.accept(codegen)
+        if fuse:
+            run_fusion_pass(vm, False)
         print(vm)
+        if backend == 'register':
+            print(vm.stats(), end='')
     except MyPLError as ex:
         print(ex)
         exit(1)
 
     
-def run_normal_mode(in_stream):
+def run_normal_mode(in_stream, dispatch='table', fuse=False,
+                    fusion_report=False, backend='vm', trace_file=None,
+                    profile=False, profile_file=None, sample_file=None,
+                    sample_interval=5.0, sample_pcs=False, limits=None,
+                    gc_stats=False, heap_stats=False, checkpointer=None):
     """Executes the given mypl program. Any output produced by the program
     is printed to standard output. 
 
     Args: 
         in_stream -- A wrapped input stream containing a mypl program.
+        dispatch -- The VM instruction dispatch mode ('table' or 'switch').
+        fuse -- If true, run the superinstruction fusion pass.
+        fusion_report -- If true, fuse and report the fusions that fired.
+        backend -- The execution backend ('vm', 'threaded', 'register' or
+                   'python').
+        trace_file -- If given, the name of a file to write a trace record
+                      (one line of JSON) to for each instruction executed.
+        profile -- If true, print a profile of the run to standard error.
+        profile_file -- If given, the name of a file to write the profile
+                        of the run to as JSON.
+        sample_file -- If given, the name of a file to write the sampled
+                       call stacks of the run to (in collapsed format).
+        sample_interval -- Milliseconds between call stack samples.
+        sample_pcs -- If true, label sampled frames with their pc.
+        limits -- The execution Limits of the run (optional).
+        gc_stats -- If true, print the garbage collections during the run
+                    to standard error.
+        heap_stats -- If true, print the heap statistics of the run to
+                      standard error.
+        checkpointer -- A Checkpointer to save checkpoints of the run
+                        with (optional).
 
     """
+    collector = GCStats()
+    heap = HeapStats()
+    vm = None
     try: 
         lexer = Lexer(in_stream)
         parser = ASTParser(lexer)
         ast = parser.parse()
         visitor = SemanticChecker()
         ast.accept(visitor)
-        vm = VM()
+        if gc_stats:
+            collector.start()
+        if backend == 'python':
+            pygen = PythonGenerator()
+            ast.accept(pygen)
+            pygen.run()
+            return
+        if backend == 'threaded':
+            vm = ThreadedVM(limits)
+        elif backend == 'register':
+            vm = RegisterVM(limits)
+        else:
+            vm = VM(limits)
         codegen = CodeGenerator(vm)
         ast.accept(codegen)
-        vm.run()
+        if fuse or fusion_report:
+            run_fusion_pass(vm, fusion_report)
+        if heap_stats:
+            vm.heap_stats = heap
+        if checkpointer is not None:
+            checkpointer.attach(vm)
+        if profile or profile_file:
+            run_profiler(vm, profile, profile_file)
+        elif sample_file:
+            sampler = SamplingProfiler(sample_interval / 1000)
+            try:
+                sampler.profile(vm)
+            finally:
+                with open(sample_file, 'w') as out_stream:
+                    sampler.write_collapsed(out_stream, sample_pcs)
+        elif trace_file:
+            with open(trace_file, 'w') as trace:
+                vm.run(trace=trace)
+        else:
+            vm.run(dispatch=dispatch)
+        if checkpointer is not None:
+            checkpointer.wait()
+    except MyPLError as ex:
+        if checkpointer is not None:
+            # the last checkpoint is the one to resume from
+            checkpointer.wait(quiet=True)
+        print(ex)
+        exit(1)
+    finally:
+        if gc_stats:
+            collector.stop()
+            print(collector.report(), end='', file=sys.stderr)
+        if heap_stats:
+            if vm is not None:
+                heap.finish(vm)
+            print(heap.report(), end='', file=sys.stderr)
+
+
+
+def run_restore_mode(restore_file, dispatch='table', limits=None,
+                     checkpointer=None):
+    """Continues the run saved in the given checkpoint file. Any further
+    output of the program is printed to standard output.
+
+    Args:
+        restore_file -- The name of the checkpoint file.
+        dispatch -- The VM instruction dispatch mode ('table' or 'switch').
+        limits -- The execution Limits of the run (optional).
+        checkpointer -- A Checkpointer to save checkpoints of the run
+                        with (optional).
+
+    """
+    try:
+        vm = restore(restore_file, VM, limits)
+        if checkpointer is not None:
+            checkpointer.attach(vm)
+        vm.continue_run(dispatch=dispatch)
+        if checkpointer is not None:
+            checkpointer.wait()
+    except OSError as ex:
+        print(f"ERROR: Could not read checkpoint '{restore_file}': {ex}")
+        exit(1)
+    except MyPLError as ex:
+        if checkpointer is not None:
+            # the last checkpoint is the one to resume from
+            checkpointer.wait(quiet=True)
+        print(ex)
+        exit(1)
+
+
+def run_batch_mode(in_stream, input_files, out_dir=None, workers=None,
+                   backend='vm', fuse=False, limits=None):
+    """Compiles the given mypl program once and runs it on each input file
+    in a pool of worker processes, then prints a summary to standard error.
+
+    Args:
+        in_stream -- A wrapped input stream containing a mypl program.
+        input_files -- The names of the files holding each run's input.
+        out_dir -- If given, the directory to write each run's output to
+                   (as the input file's name plus .out).
+        workers -- The number of worker processes (default: one per CPU).
+        backend -- The VM backend ('vm', 'threaded' or 'register').
+        fuse -- If true, run the superinstruction fusion pass.
+        limits -- The execution Limits of each run (optional).
+
+    """
+    try:
+        templates = compile_program(in_stream, fuse)
     except MyPLError as ex:
         print(ex)
         exit(1)
+    jobs = []
+    for file_name in input_files:
+        try:
+            with open(file_name, 'r', encoding='utf-8') as input_file:
+                jobs.append(BatchJob(file_name, input_file.read()))
+        except (OSError, UnicodeDecodeError) as ex:
+            print(f"ERROR: Could not read input file '{file_name}': {ex}")
+            exit(1)
+    results, summary = run_batch(templates, jobs, workers, backend, limits)
+    for result in results:
+        if out_dir:
+            out_name = os.path.basename(result.name) + '.out'
+            with open(os.path.join(out_dir, out_name), 'w') as out_file:
+                out_file.write(result.output)
+                if result.error:
+                    out_file.write(result.error + '\n')
+        if result.error:
+            print(f'{result.name}: {result.error}', file=sys.stderr)
+    print(summary.report(), end='', file=sys.stderr)
+    if summary.failed:
+        exit(1)
+
+
+def run_serve_mode(in_stream, host, port, fuse=False, limits=None):
+    """Compiles the given mypl program once and serves an interactive
+    session of it to each TCP connection until interrupted.
+
+    Args:
+        in_stream -- A wrapped input stream containing a mypl program.
+        host -- The address to listen on.
+        port -- The TCP port to listen on (0 picks a free one).
+        fuse -- If true, run the superinstruction fusion pass.
+        limits -- The execution Limits of each session (optional).
 
+    """
+    try:
+        templates = compile_program(in_stream, fuse)
+    except MyPLError as ex:
+        print(ex)
+        exit(1)
+    def started(server):
+        for sock in server.sockets:
+            address = sock.getsockname()
+            print(f'serving on {address[0]}:{address[1]}', file=sys.stderr)
+    session_host = SessionHost(templates, limits)
+    try:
+        asyncio.run(session_host.serve_forever(host, port, started))
+    except KeyboardInterrupt:
+        pass
 
     
 if __name__ == '__main__':
@@ -169,16 +405,124 @@ if __name__ == '__main__':
     group.add_argument('--check', action='store_true', help=help_msg)
     help_msg = 'displays intermediate code'
     group.add_argument('--ir', action='store_true', help=help_msg)
+    help_msg = 'VM instruction dispatch mode (default: table)'
+    argparser.add_argument('--dispatch', choices=['table', 'switch'],
+                           default='table', help=help_msg)
+    help_msg = 'execution backend (default: vm)'
+    argparser.add_argument('--backend', choices=['vm', 'threaded', 'register',
+                                                 'python'],
+                           default='vm', help=help_msg)
+    help_msg = 'fuse common instruction sequences into superinstructions'
+    argparser.add_argument('--fuse', action='store_true', help=help_msg)
+    help_msg = 'fuse instructions and report the fusions that fired'
+    argparser.add_argument('--fusion-report', action='store_true',
+                           help=help_msg)
+    help_msg = 'write a JSON trace record per executed instruction to FILE'
+    argparser.add_argument('--trace', metavar='FILE', help=help_msg)
+    help_msg = 'print instruction counts and function times to standard error'
+    argparser.add_argument('--profile', action='store_true', help=help_msg)
+    help_msg = 'write the profile of the run to FILE as JSON'
+    argparser.add_argument('--profile-json', metavar='FILE', help=help_msg)
+    help_msg = 'sample the call stack and write flamegraph stacks to FILE'
+    argparser.add_argument('--sample', metavar='FILE', help=help_msg)
+    help_msg = 'milliseconds between call stack samples (default: 5)'
+    argparser.add_argument('--sample-interval', metavar='MS', type=float,
+                           default=5.0, help=help_msg)
+    help_msg = 'label sampled stack frames with their pc'
+    argparser.add_argument('--sample-pcs', action='store_true', help=help_msg)
+    help_msg = 'stop the program after N instructions'
+    argparser.add_argument('--max-instructions', metavar='N', type=int,
+                           help=help_msg)
+    help_msg = 'stop the program after SECONDS of wall-clock time'
+    argparser.add_argument('--max-time', metavar='SECONDS', type=float,
+                           help=help_msg)
+    help_msg = 'stop the program when the call stack has N frames'
+    argparser.add_argument('--max-depth', metavar='N', type=int,
+                           help=help_msg)
+    help_msg = 'stop the program when N structs and arrays are live'
+    argparser.add_argument('--max-heap', metavar='N', type=int, help=help_msg)
+    help_msg = 'print garbage collection statistics to standard error'
+    argparser.add_argument('--gc-stats', action='store_true', help=help_msg)
+    help_msg = 'print heap allocation and live object statistics to standard error'
+    argparser.add_argument('--heap-stats', action='store_true', help=help_msg)
+    help_msg = 'allocations between young generation collections'
+    argparser.add_argument('--gc-threshold', metavar='N', type=int,
+                           help=help_msg)
+    help_msg = 'run the program once per input FILE on a process pool'
+    argparser.add_argument('--batch', metavar='FILE', nargs='+',
+                           help=help_msg)
+    help_msg = 'directory to write the output of each batch run to'
+    argparser.add_argument('--batch-out', metavar='DIR', help=help_msg)
+    help_msg = 'number of batch worker processes (default: one per CPU)'
+    argparser.add_argument('--workers', metavar='N', type=int, help=help_msg)
+    help_msg = 'serve an interactive session per TCP connection on PORT'
+    argparser.add_argument('--serve', metavar='PORT', type=int, help=help_msg)
+    help_msg = 'address to serve sessions on (default: 127.0.0.1)'
+    argparser.add_argument('--host', default='127.0.0.1', help=help_msg)
+    help_msg = 'save a checkpoint of the run to FILE periodically'
+    argparser.add_argument('--checkpoint', metavar='FILE', help=help_msg)
+    help_msg = 'instructions run between checkpoints (default: 1000000)'
+    argparser.add_argument('--checkpoint-interval', metavar='N', type=int,
+                           default=DEFAULT_INTERVAL, help=help_msg)
+    help_msg = 'continue the run saved in the checkpoint FILE'
+    argparser.add_argument('--restore', metavar='FILE', help=help_msg)
     help_msg = 'mypl program file (optional)'
     argparser.add_argument('filename', nargs='?', help=help_msg)
     args = argparser.parse_args()
+    if (args.fuse or args.fusion_report) and args.backend == 'python':
+        argparser.error('--fuse needs a VM backend')
+    if args.trace and args.backend == 'python':
+        argparser.error('--trace needs a VM backend')
+    if (args.profile or args.profile_json) and args.backend == 'python':
+        argparser.error('--profile needs a VM backend')
+    if args.sample and args.backend == 'python':
+        argparser.error('--sample needs a VM backend')
+    if args.heap_stats and args.backend == 'python':
+        argparser.error('--heap-stats needs a VM backend')
+    if (args.checkpoint or args.restore) and args.backend == 'python':
+        argparser.error('checkpoints need a VM backend')
+    if args.checkpoint_interval <= 0:
+        argparser.error('--checkpoint-interval must be positive')
+    checkpointer = None
+    if args.checkpoint:
+        checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval)
+    limits = None
+    if args.max_instructions is not None or args.max_time is not None or \
+       args.max_depth is not None or args.max_heap is not None:
+        if args.backend == 'python':
+            argparser.error('limits need a VM backend')
+        limits = Limits(args.max_instructions, args.max_time, args.max_depth,
+                        args.max_heap)
+    if args.backend in ['threaded', 'register'] and not (args.lex or \
+       args.parse or args.print or args.check or args.ir):
+        # the stack VM's run loop is the one that supports these
+        options = [('--trace', args.trace),
+                   ('--profile', args.profile or args.profile_json),
+                   ('--sample', args.sample), ('limits', limits),
+                   ('--heap-stats', args.heap_stats),
+                   ('--checkpoint', args.checkpoint),
+                   ('--restore', args.restore)]
+        fallbacks = [name for name, used in options if used]
+        if fallbacks:
+            print(f'warning: running on the vm backend instead of '
+                  f'{args.backend} for {", ".join(fallbacks)}',
+                  file=sys.stderr)
+    if args.gc_threshold is not None:
+        gc.set_threshold(args.gc_threshold, *gc.get_threshold()[1:])
+    if args.restore:
+        # the program is in the checkpoint, and the run reads standard in
+        run_restore_mode(args.restore, args.dispatch, limits, checkpointer)
+        exit(0)
     # get the input (file or standard in)
     in_stream = StdInWrapper(sys.stdin)
     if args.filename:
-        try: 
-            in_stream = FileWrapper(open(args.filename, 'r', encoding='utf-8'))
-        except: 
-            print(f"ERROR: Could not open file '{args.filename}'")
+        try:
+            # read (and decode) the whole file up front, so a file that is
+            # not UTF-8 fails here rather than part way through lexing
+            with open(args.filename, 'r', encoding='utf-8') as source_file:
+                in_stream = FileWrapper(io.StringIO(source_file.read()))
+        except (OSError, UnicodeDecodeError) as ex:
+            print(f"ERROR: Could not open file '{args.filename}': {ex}")
             exit(1)
     # check args and route to appropriate function
     if args.lex:
@@ -190,9 +534,22 @@ if __name__ == '__main__':
     elif args.check:
         run_check_mode(in_stream)
     elif args.ir:
-        run_ir_mode(in_stream)
+        run_ir_mode(in_stream, args.fuse, args.backend)
+    elif args.batch:
+        if args.backend == 'python':
+            argparser.error('--batch needs a VM backend')
+        run_batch_mode(in_stream, args.batch, args.batch_out, args.workers,
+                       args.backend, args.fuse, limits)
+    elif args.serve is not None:
+        if args.backend != 'vm':
+            argparser.error('--serve runs on the vm backend')
+        run_serve_mode(in_stream, args.host, args.serve, args.fuse, limits)
     else:
-        run_normal_mode(in_stream)
+        run_normal_mode(in_stream, args.dispatch, args.fuse,
+                        args.fusion_report, args.backend, args.trace,
+                        args.profile, args.profile_json, args.sample,
+                        args.sample_interval, args.sample_pcs, limits,
+                        args.gc_stats, args.heap_stats, checkpointer)
     # close the (wrapped) input stream
     in_stream.close()
 
@@ -0,0 +1,143 @@
+"""An asyncio host running many interactive MyPL sessions in one process.
+
+Each session is a resumable VM run (see VM.start and VM.resume) driven by
+a task: the VM runs a slice of instructions at a time and the task yields
+to the event loop in between, and a READ with no input suspends the task
+until a line arrives on the session's stream. WRITE output is collected
+during a slice and sent to the session's writer before the task yields.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import asyncio
+from mypl_error import *
+from mypl_vm import VM, RunStatus
+
+
+# instructions a session runs before yielding to other sessions
+DEFAULT_STEPS = 10000
+
+
+class SessionHost:
+    """Runs a compiled program once per connected stream pair."""
+
+    def __init__(self, templates, limits=None, steps=DEFAULT_STEPS):
+        """Create a host.
+
+        Args:
+            templates -- The compiled program (see
+                         mypl_batch.compile_program).
+            limits -- The Limits of each session (optional). The time
+                      limit counts only the time a session spends running.
+            steps -- Instructions run between yields to the event loop.
+
+        """
+        self.templates = templates
+        self.limits = limits
+        self.steps = steps
+        self.active = 0      # sessions running
+        self.finished = 0    # sessions ended
+        self.failed = 0      # sessions ended by an error
+
+
+    def new_vm(self):
+        """Returns a VM loaded with the host's program."""
+        vm = VM(self.limits)
+        for template in self.templates.values():
+            vm.add_frame_template(template)
+        return vm
+
+
+    async def run_session(self, reader, writer):
+        """Run the program with READ taking lines from the reader and WRITE
+        sending text to the writer. Returns the error message of a failed
+        run (which is also sent to the writer), or None.
+
+        Args:
+            reader -- An asyncio.StreamReader (or other object with an
+                      async readline giving bytes, and b'' at the end).
+            writer -- An asyncio.StreamWriter (or other object with write
+                      taking bytes and an async drain).
+
+        """
+        output = []
+        vm = self.new_vm()
+        self.active += 1
+        try:
+            vm.start(write=output.append)
+            status = RunStatus.YIELDED
+            while status != RunStatus.FINISHED:
+                status = vm.resume(self.steps)
+                if output:
+                    writer.write(''.join(output).encode())
+                    output.clear()
+                    await writer.drain()
+                if status == RunStatus.BLOCKED:
+                    line = await reader.readline()
+                    if line:
+                        try:
+                            text = line.decode()
+                        except UnicodeDecodeError:
+                            raise VMError('session input is not valid UTF-8')
+                        vm.feed_input(text.rstrip('\r\n'))
+                    else:
+                        vm.close_input()
+                elif status == RunStatus.YIELDED:
+                    await asyncio.sleep(0)
+        except MyPLError as ex:
+            self.failed += 1
+            if output:
+                writer.write(''.join(output).encode())
+            writer.write(f'{ex}\n'.encode())
+            await writer.drain()
+            return str(ex)
+        finally:
+            self.active -= 1
+            self.finished += 1
+            # the templates are shared by all sessions
+            vm.release_frames()
+        return None
+
+
+    async def handle(self, reader, writer):
+        """Connection callback for asyncio.start_server: run a session
+        and close the connection.
+
+        """
+        try:
+            await self.run_session(reader, writer)
+        except ConnectionError:
+            # the client went away
+            pass
+        finally:
+            writer.close()
+
+
+    async def start_server(self, host='127.0.0.1', port=0):
+        """Returns an asyncio.Server running a session per connection.
+
+        Args:
+            host -- The address to listen on.
+            port -- The TCP port to listen on (0 picks a free one).
+
+        """
+        return await asyncio.start_server(self.handle, host, port)
+
+
+    async def serve_forever(self, host='127.0.0.1', port=0, started=None):
+        """Serve sessions until cancelled.
+
+        Args:
+            host -- The address to listen on.
+            port -- The TCP port to listen on (0 picks a free one).
+            started -- A callable given the server once it is listening
+                       (optional).
+
+        """
+        server = await self.start_server(host, port)
+        if started is not None:
+            started(server)
+        async with server:
+            await server.serve_forever()
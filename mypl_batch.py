@@ -0,0 +1,167 @@
+"""Batch execution of one MyPL program over many inputs on a process pool.
+
+The program is compiled once, and its frame templates are sent to each
+worker process once (when the pool starts). Every job then runs the
+program in a fresh VM with its own standard input and captured standard
+output.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from mypl_error import *
+from mypl_lexer import Lexer
+from mypl_ast_parser import ASTParser
+from mypl_semantic_checker import SemanticChecker
+from mypl_code_gen import CodeGenerator
+from mypl_fusion import FusionPass
+from mypl_vm import VM
+from mypl_threaded import ThreadedVM
+from mypl_register_vm import RegisterVM
+
+
+# backend name -> VM class
+BACKENDS = {'vm': VM, 'threaded': ThreadedVM, 'register': RegisterVM}
+
+
+@dataclass
+class BatchJob:
+    """A single run of the batch program."""
+    name: str                  # e.g. the input file name
+    input_text: str = ''       # the run's standard input
+
+
+@dataclass
+class JobResult:
+    """The outcome of a BatchJob."""
+    name: str
+    output: str                # everything the program printed
+    error: str = None          # the error message of a failed run
+    seconds: float = 0.0       # wall-clock time of the run
+    instructions: int = 0      # instructions run (only counted with limits)
+
+
+@dataclass
+class BatchSummary:
+    """Totals of a batch run."""
+    jobs: int = 0
+    failed: int = 0
+    seconds: float = 0.0       # wall-clock time of the whole batch
+    job_seconds: float = 0.0   # sum of the jobs' own run times
+    instructions: int = 0
+    workers: int = 0
+
+    def report(self):
+        """Returns a human-readable summary."""
+        rate = self.jobs / self.seconds if self.seconds else 0.0
+        s = f'jobs: {self.jobs} ({self.failed} failed) on {self.workers} workers\n'
+        s += f'time: {self.seconds:.3f}s ({rate:.1f} jobs/s, '
+        s += f'{self.job_seconds:.3f}s in jobs)\n'
+        if self.instructions:
+            s += f'instructions: {self.instructions} '
+            s += f'({self.instructions / self.seconds:.0f}/s)\n'
+        return s
+
+
+def compile_program(in_stream, fuse=False):
+    """Returns the frame templates (function name -> VMFrameTemplate) of
+    the given program.
+
+    Args:
+        in_stream -- A wrapped input stream containing a mypl program.
+        fuse -- If true, run the superinstruction fusion pass.
+
+    """
+    ast = ASTParser(Lexer(in_stream)).parse()
+    ast.accept(SemanticChecker())
+    vm = VM()
+    ast.accept(CodeGenerator(vm))
+    if fuse:
+        FusionPass().run(vm)
+    return vm.frame_templates
+
+
+#----------------------------------------------------------------------
+# Worker processes
+#----------------------------------------------------------------------
+
+# the compiled program and settings of a worker process (see init_worker)
+worker_state = {}
+
+
+def init_worker(templates, backend, limits):
+    """Pool initializer: keep the compiled program in the worker."""
+    worker_state['templates'] = templates
+    worker_state['vm_class'] = BACKENDS[backend]
+    worker_state['limits'] = limits
+
+
+def run_job(job):
+    """Returns the JobResult of running the worker's program on the given
+    job.
+
+    """
+    vm = worker_state['vm_class'](worker_state['limits'])
+    for template in worker_state['templates'].values():
+        vm.add_frame_template(template)
+    output = io.StringIO()
+    error = None
+    stdin = sys.stdin
+    sys.stdin = io.StringIO(job.input_text)
+    start_time = time.perf_counter()
+    try:
+        with redirect_stdout(output):
+            vm.run()
+    except MyPLError as ex:
+        error = str(ex)
+    except EOFError:
+        error = str(VMError('read past the end of the input'))
+    except Exception as ex:
+        # any other failure fails this job, not the whole batch
+        error = f'{type(ex).__name__}: {ex}'
+    finally:
+        sys.stdin = stdin
+        # the worker's templates outlive the job: let go of its objects
+        vm.release_frames()
+    seconds = time.perf_counter() - start_time
+    return JobResult(job.name, output.getvalue(), error, seconds, vm.executed)
+
+
+#----------------------------------------------------------------------
+# Batch runs
+#----------------------------------------------------------------------
+
+def run_batch(templates, jobs, workers=None, backend='vm', limits=None):
+    """Run the compiled program on every job in a pool of worker processes.
+    Returns the JobResults (in the order of the jobs) and a BatchSummary.
+
+    Args:
+        templates -- The compiled program (see compile_program).
+        jobs -- The BatchJobs to run.
+        workers -- The number of worker processes (default: one per CPU).
+        backend -- The VM backend ('vm', 'threaded' or 'register').
+        limits -- The Limits of each job (optional).
+
+    """
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(templates, backend, limits)) as pool:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        results = list(pool.map(run_job, jobs, chunksize=chunksize))
+    summary = BatchSummary(len(jobs), workers=workers)
+    summary.seconds = time.perf_counter() - start_time
+    for result in results:
+        summary.failed += result.error is not None
+        summary.job_seconds += result.seconds
+        summary.instructions += result.instructions
+    return results, summary
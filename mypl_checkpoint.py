@@ -0,0 +1,323 @@
+"""Checkpoints of MyPL VM runs, for continuing a run in a later process.
+
+A checkpoint holds the whole execution state of a run between two
+instructions: the frame templates (the program), the frames of the call
+stack (with their pcs, variables and operand stacks), every struct and
+array reachable from them, and the VM's instruction and allocation
+counts. Objects are direct references (see mypl_vm.Struct), so the object
+graph is flattened into a table with a walk that needs no recursion
+(pickle itself would recurse once per link of a long list): every object
+is an entry in the table, and a reference to it is a 1-tuple of its index
+(tuples are never MyPL values). The file is the MAGIC header followed by
+the zlib-compressed pickle of the state.
+
+Saving forks the process where it can: the child has a copy-on-write
+image of the run as it stood and writes the checkpoint (to a temporary
+file, renamed over the checkpoint file once complete) while the parent
+goes on running, so a save only stops the run for the fork.
+
+A restored run first takes the input lines that were read but not yet
+used at the checkpoint, then reads the rest of its input from the new
+process's standard input, and repeats any output written after the
+checkpoint.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import os
+import pickle
+import sys
+import time
+import zlib
+from mypl_error import *
+from mypl_frame import VMFrameTemplate, VMFrame
+from mypl_vm import VM, Struct, Array, TYPED_ARRAYS
+
+
+# first bytes of a checkpoint file (the last one is the format version)
+MAGIC = b'MyPLckp1'
+
+# instructions run between checkpoints
+DEFAULT_INTERVAL = 1000000
+
+# instructions run before retrying a save put off by a busy writer
+RETRY_INTERVAL = 10000
+
+# TypedArray class -> array element type name
+TYPED_NAMES = {cls: name for name, cls in TYPED_ARRAYS.items()}
+
+# the classes of heap objects
+HEAP_CLASSES = frozenset([Struct, Array, *TYPED_ARRAYS.values()])
+
+
+class Checkpointer:
+    """Saves a checkpoint of a VM's run to a file every interval
+    instructions (see VM.run_limited).
+
+    """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, fork=None):
+        """Create a checkpointer.
+
+        Args:
+            path -- The name of the checkpoint file (overwritten by each
+                    checkpoint).
+            interval -- The instructions run between checkpoints.
+            fork -- If true, write checkpoints from a forked process (the
+                    default where os.fork exists), else stop the run until
+                    each one is written.
+
+        """
+        self.path = path
+        self.interval = interval
+        self.fork = hasattr(os, 'fork') if fork is None else fork
+        self.next_checkpoint = interval  # instruction count of the next save
+        self.saves = 0
+        self.pause_total = 0.0           # seconds the run was stopped
+        self.pause_max = 0.0
+        self.writer = None               # pid of the process writing
+
+
+    def profile(self, vm, **kwargs):
+        """Run the given VM while saving checkpoints.
+
+        Args:
+            vm -- The VM to run.
+            kwargs -- Passed on to vm.run.
+
+        """
+        self.attach(vm)
+        try:
+            vm.run(**kwargs)
+        except BaseException:
+            self.wait(quiet=True)
+            raise
+        finally:
+            vm.checkpointer = None
+        self.wait()
+
+
+    def attach(self, vm):
+        """Save checkpoints of the given VM's next run, the first one after
+        interval more instructions.
+
+        """
+        vm.checkpointer = self
+        self.next_checkpoint = vm.executed + self.interval
+
+
+    def save(self, vm):
+        """Save a checkpoint of the VM's run, which must be stopped between
+        instructions. A forked save is put off (for RETRY_INTERVAL
+        instructions) while the last one is still being written. A VM
+        being sampled is saved without forking, since forking a process
+        with other threads (the sampler's) can deadlock the child.
+
+        """
+        start_time = time.perf_counter()
+        # output from before the checkpoint is not repeated by a restored
+        # run, so it must not be lost with this process
+        vm.output.flush()
+        sys.stdout.flush()
+        if not self.fork or vm.sampler is not None:
+            self.write(vm)
+        elif self.writing():
+            self.next_checkpoint = vm.executed + min(self.interval,
+                                                     RETRY_INTERVAL)
+            return
+        else:
+            pid = os.fork()
+            if pid == 0:
+                # the child has a copy of the run, frozen at this point
+                status = 0
+                try:
+                    self.write(vm)
+                except BaseException as ex:
+                    print(f'checkpoint: {ex}', file=sys.stderr)
+                    status = 1
+                os._exit(status)
+            self.writer = pid
+        self.saves += 1
+        self.next_checkpoint = vm.executed + self.interval
+        pause = time.perf_counter() - start_time
+        self.pause_total += pause
+        self.pause_max = max(self.pause_max, pause)
+
+
+    def write(self, vm):
+        """Write a checkpoint of the VM's run to the checkpoint file (by
+        way of a temporary file, so a complete checkpoint is never
+        overwritten by a partial one).
+
+        """
+        data = zlib.compress(pickle.dumps(snapshot(vm),
+                                          pickle.HIGHEST_PROTOCOL), 1)
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as out_file:
+                out_file.write(MAGIC)
+                out_file.write(data)
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            raise VMError(f'could not write checkpoint "{self.path}": {ex}')
+
+
+    def writing(self):
+        """Returns true if a forked save is still being written."""
+        if self.writer is None:
+            return False
+        pid, status = os.waitpid(self.writer, os.WNOHANG)
+        if pid == 0:
+            return True
+        self.writer = None
+        self.check_status(status)
+        return False
+
+
+    def wait(self, quiet=False):
+        """Wait for the last checkpoint to be written, raising a VMError if
+        writing it failed.
+
+        Args:
+            quiet -- If true, print the error to standard error instead of
+                     raising it (when the run itself has failed, and its
+                     error is the one to report).
+
+        """
+        if self.writer is not None:
+            pid, status = os.waitpid(self.writer, 0)
+            self.writer = None
+            try:
+                self.check_status(status)
+            except MyPLError as ex:
+                if not quiet:
+                    raise
+                print(ex, file=sys.stderr)
+
+
+    def check_status(self, status):
+        """Raise a VMError if a writer process exited with an error."""
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise VMError(f'could not write checkpoint "{self.path}"')
+
+
+    def report(self):
+        """Returns a human-readable summary of the checkpoints saved."""
+        s = f'checkpoints: {self.saves} saved to {self.path}\n'
+        s += f'pause: {self.pause_total * 1000:.2f}ms total, '
+        s += f'{self.pause_max * 1000:.2f}ms max\n'
+        return s
+
+
+#----------------------------------------------------------------------
+# Flattening
+#----------------------------------------------------------------------
+
+def snapshot(vm):
+    """Returns the execution state of the VM's run as a dictionary of
+    values pickle can save without recursing into the object graph.
+
+    """
+    index = {}      # id of an object -> index in objects
+    objects = []    # the object of each entry
+    def encode(values):
+        encoded = list(values)
+        for i, value in enumerate(encoded):
+            if type(value) in HEAP_CLASSES:
+                obj_index = index.get(id(value))
+                if obj_index is None:
+                    obj_index = index[id(value)] = len(objects)
+                    objects.append(value)
+                encoded[i] = (obj_index,)
+        return encoded
+    frames = [(frame.template.function_name, frame.pc,
+               encode(frame.variables), encode(frame.operand_stack))
+              for frame in vm.call_stack]
+    # encoding an entry can add entries after it
+    entries = []
+    for obj in objects:
+        if type(obj) is Struct:
+            entries.append(('struct', encode(obj), None))
+        elif type(obj) is Array:
+            entries.append(('array', encode(obj), None))
+        else:
+            entries.append((TYPED_NAMES[type(obj)], obj.tobytes(),
+                            obj.extra))
+    templates = [(t.function_name, t.arg_count, t.instructions, t.local_count)
+                 for t in vm.frame_templates.values()]
+    return {'templates': templates, 'frames': frames, 'objects': entries,
+            'executed': vm.executed, 'allocated': vm.allocated,
+            'input': (list(vm.input.lines), vm.input.partial)}
+
+
+def restore_state(vm, state):
+    """Replace the program and call stack of the VM with those of the
+    given snapshot.
+
+    """
+    objects = []
+    for kind, payload, extra in state['objects']:
+        if kind == 'struct':
+            objects.append(Struct())
+        elif kind == 'array':
+            objects.append(Array())
+        else:
+            obj = TYPED_ARRAYS[kind](0)
+            obj.frombytes(payload)
+            obj.extra = extra
+            objects.append(obj)
+    def decode(values):
+        return [objects[value[0]] if type(value) is tuple else value
+                for value in values]
+    for obj, (kind, payload, extra) in zip(objects, state['objects']):
+        if kind in ['struct', 'array']:
+            obj.extend(decode(payload))
+    vm.frame_templates = {}
+    for name, arg_count, instructions, local_count in state['templates']:
+        vm.add_frame_template(VMFrameTemplate(name, arg_count, instructions,
+                                              local_count=local_count))
+    vm.call_stack = [VMFrame(vm.frame_templates[name], pc, decode(variables),
+                             decode(stack))
+                     for name, pc, variables, stack in state['frames']]
+    vm.executed = state['executed']
+    vm.allocated = state['allocated']
+    lines, partial = state['input']
+    vm.input.lines.extend(lines)
+    vm.input.partial = partial
+
+
+#----------------------------------------------------------------------
+# Files
+#----------------------------------------------------------------------
+
+def load(path):
+    """Returns the state saved in the given checkpoint file."""
+    with open(path, 'rb') as in_file:
+        data = in_file.read()
+    if not data.startswith(MAGIC):
+        raise VMError(f'"{path}" is not a MyPL checkpoint')
+    try:
+        return pickle.loads(zlib.decompress(data[len(MAGIC):]))
+    except (zlib.error, pickle.UnpicklingError, EOFError) as ex:
+        raise VMError(f'damaged checkpoint "{path}": {ex}')
+
+
+def restore(path, vm_class=VM, limits=None):
+    """Returns a VM holding the run saved in the given checkpoint file,
+    ready for continue_run.
+
+    Args:
+        path -- The name of the checkpoint file.
+        vm_class -- The VM class to create.
+        limits -- The Limits of the continued run (optional). The
+                  instruction limit counts the instructions run before the
+                  checkpoint as well.
+
+    """
+    vm = vm_class(limits)
+    restore_state(vm, load(path))
+    return vm
@@ -29,12 +29,73 @@ class CodeGenerator (Visitor):
         self.var_table = VarTable()
         # struct name -> StructDef for struct field info
         self.struct_defs = {}
+        # scratch STORE/LOAD instructions of the current function, given
+        # memory addresses past its variables once they are all known
+        self.scratch_instrs = []
 
     
     def add_instr(self, instr):
         """Helper function to add an instruction to the current template."""
         self.curr_template.instructions.append(instr)
 
+
+    def add_var(self, var_name, data_type=None):
+        """Helper function to add a variable to the var table, keeping track
+        of the number of variable slots the current function needs.
+
+        """
+        self.var_table.add(var_name, data_type)
+        template = self.curr_template
+        template.local_count = max(template.local_count,
+                                   self.var_table.total_vars)
+
+
+    def field_slot(self, data_type, var_ref):
+        """Helper function that returns the slot index of the field named
+        by var_ref within structs of the given type, and the field's type.
+
+        """
+        struct_def = self.struct_defs[data_type.type_name.lexeme]
+        field_name = var_ref.var_name.lexeme
+        for index, field in enumerate(struct_def.fields):
+            if field.var_name.lexeme == field_name:
+                return index, field.data_type
+
+
+    def add_swap_instrs(self):
+        """Helper function to swap the top two stack values through two
+        scratch memory addresses (placed after the function's variables
+        at the end of visit_fun_def).
+
+        """
+        instrs = [STORE(1),  # Store the top item
+                  STORE(0),  # Store the second item
+                  LOAD(1),   # Load the top item
+                  LOAD(0)]   # Load the second item
+        for instr in instrs:
+            self.add_instr(instr)
+        self.scratch_instrs += instrs
+
+
+    def is_append(self, var_name, expr):
+        """Helper function that returns true if expr is var_name + (...)
+        for a string variable var_name, so assigning it to the variable
+        can append to the string in place (see OpCode.ADDL) instead of
+        copying it.
+
+        """
+        data_type = self.var_table.get_type(var_name)
+        if data_type is None or data_type.is_array or \
+           data_type.type_name.token_type != TokenType.STRING_TYPE:
+            return False
+        if expr.not_op or not expr.op or expr.op.token_type != TokenType.PLUS \
+           or type(expr.first) is not SimpleTerm:
+            return False
+        rvalue = expr.first.rvalue
+        return type(rvalue) is VarRValue and len(rvalue.path) == 1 and \
+            rvalue.path[0].var_name.lexeme == var_name and \
+            not rvalue.path[0].array_expr
+
         
     def visit_program(self, program):
         for struct_def in program.struct_defs:
@@ -54,8 +115,11 @@ class CodeGenerator (Visitor):
 
         self.var_table.push_environment()
 
+        # the arguments are on the stack in order, so the last one is
+        # stored first
         for param in fun_def.params:
-            self.var_table.add(param.var_name.lexeme)
+            self.add_var(param.var_name.lexeme, param.data_type)
+        for param in reversed(fun_def.params):
             index = self.var_table.get(param.var_name.lexeme)
             self.add_instr(STORE(index))
         
@@ -65,6 +129,13 @@ class CodeGenerator (Visitor):
         if not self.curr_template.instructions or self.curr_template.instructions[-1].opcode != OpCode.RET:
             self.add_instr(PUSH(None))
             self.add_instr(RET())
+
+        # the scratch slots go after the variables
+        if self.scratch_instrs:
+            for instr in self.scratch_instrs:
+                instr.operand += self.curr_template.local_count
+            self.curr_template.local_count += 2
+            self.scratch_instrs = []
         
         self.var_table.pop_environment()
         self.vm.add_frame_template(self.curr_template)
@@ -75,13 +146,19 @@ class CodeGenerator (Visitor):
         # TODO
         if return_stmt.expr:
             return_stmt.expr.accept(self)
+            # returning a call's value: the callee can take over this frame
+            # (the RET stays, so the function still ends with one)
+            last_instr = self.curr_template.instructions[-1]
+            if last_instr.opcode == OpCode.CALL:
+                last_instr.opcode = OpCode.TCALL
         else:
             self.add_instr(PUSH(None))            
         self.add_instr(RET())
         
     def visit_var_decl(self, var_decl):
         # TODO
-        self.var_table.add(var_decl.var_def.var_name.lexeme)
+        self.add_var(var_decl.var_def.var_name.lexeme,
+                     var_decl.var_def.data_type)
         if var_decl.expr:
             var_decl.expr.accept(self)
         else:
@@ -103,12 +180,18 @@ class CodeGenerator (Visitor):
                 assign_stmt.lvalue[0].array_expr.accept(self)
                 assign_stmt.expr.accept(self)
                 self.add_instr(SETI())
+            elif self.is_append(var_name, assign_stmt.expr):
+                # s = s + x: evaluate x, then append it to s
+                assign_stmt.expr.rest.accept(self)
+                self.add_instr(ADDL(index))
             else:
                 assign_stmt.expr.accept(self)
                 self.add_instr(STORE(index))
         else:
             var_name = assign_stmt.lvalue[0].var_name.lexeme
             index = self.var_table.get(var_name)
+            # the type of each struct along the path gives the field slots
+            path_type = self.var_table.get_type(var_name)
             if assign_stmt.lvalue[0].array_expr:
                 # If it's an array element, handle it differently
                 self.add_instr(LOAD(index))
@@ -119,7 +202,8 @@ class CodeGenerator (Visitor):
             
             for var_ref in assign_stmt.lvalue[1:-1]: #skips first and last var_ref
                 field_name = var_ref.var_name.lexeme
-                self.add_instr(GETF(field_name))
+                field_index, path_type = self.field_slot(path_type, var_ref)
+                self.add_instr(GETF(field_index, field_name))
                 if var_ref.array_expr:
                     var_ref.array_expr.accept(self)
                     self.add_instr(GETI())
@@ -127,14 +211,15 @@ class CodeGenerator (Visitor):
             
             
             assign_field = assign_stmt.lvalue[-1].var_name.lexeme
+            field_index, _ = self.field_slot(path_type, assign_stmt.lvalue[-1])
             if assign_stmt.lvalue[-1].array_expr:
-                self.add_instr(GETF(assign_field))
+                self.add_instr(GETF(field_index, assign_field))
                 assign_stmt.lvalue[-1].array_expr.accept(self)
                 assign_stmt.expr.accept(self)
                 self.add_instr(SETI())
             else:
                 assign_stmt.expr.accept(self)
-                self.add_instr(SETF(assign_field))
+                self.add_instr(SETF(field_index, assign_field))
             
         
     def visit_while_stmt(self, while_stmt):
@@ -257,6 +342,12 @@ class CodeGenerator (Visitor):
             self.add_instr(GETC())
         elif call_expr.fun_name.lexeme == "input":
             self.add_instr(READ())
+        elif call_expr.fun_name.lexeme == "input_all":
+            self.add_instr(READA())
+        elif call_expr.fun_name.lexeme == "input_n":
+            self.add_instr(READN())
+        elif call_expr.fun_name.lexeme == "input_eof":
+            self.add_instr(EOF())
         elif call_expr.fun_name.lexeme == "itos" or call_expr.fun_name.lexeme == "dtos":
             self.add_instr(TOSTR())
         elif call_expr.fun_name.lexeme == "stoi" or call_expr.fun_name.lexeme == "dtoi":
@@ -297,16 +388,10 @@ class CodeGenerator (Visitor):
             elif expr.op.token_type == TokenType.LESS_EQ:
                 self.add_instr(CMPLE())
             elif expr.op.token_type == TokenType.GREATER:
-                self.add_instr(STORE(100))  # Store the top item
-                self.add_instr(STORE(99))  # Store the second item
-                self.add_instr(LOAD(100))   # Load the top item
-                self.add_instr(LOAD(99))   # Load the second item
+                self.add_swap_instrs()
                 self.add_instr(CMPLT()) 
             elif expr.op.token_type == TokenType.GREATER_EQ:
-                self.add_instr(STORE(100))  # Store the top item
-                self.add_instr(STORE(99))  # Store the second item
-                self.add_instr(LOAD(100))   # Load the top item
-                self.add_instr(LOAD(99))   # Load the second item
+                self.add_swap_instrs()
                 self.add_instr(CMPLE()) 
 
 
@@ -351,19 +436,20 @@ class CodeGenerator (Visitor):
         # TODO
         if new_rvalue.array_expr:
             new_rvalue.array_expr.accept(self)
-            self.add_instr(ALLOCA())
+            # the element type lets the VM store numbers unboxed
+            self.add_instr(ALLOCA(new_rvalue.type_name.lexeme))
         else:
             struct_name = new_rvalue.type_name.lexeme
             struct_def = self.struct_defs[struct_name]
 
-            self.add_instr(ALLOCS())
+            self.add_instr(ALLOCS(len(struct_def.fields), struct_name))
             field_index = 0
             for param in new_rvalue.struct_params:
                 self.add_instr(DUP())
                 param.accept(self)
                 field_name = struct_def.fields[field_index].var_name.lexeme
+                self.add_instr(SETF(field_index, field_name))
                 field_index += 1
-                self.add_instr(SETF(field_name))
                 
             
     def visit_var_rvalue(self, var_rvalue):
@@ -382,6 +468,7 @@ class CodeGenerator (Visitor):
         else:
             var_name = var_rvalue.path[0].var_name.lexeme
             index = self.var_table.get(var_name)
+            path_type = self.var_table.get_type(var_name)
             if var_rvalue.path[0].array_expr:
                 self.add_instr(LOAD(index))
                 var_rvalue.path[0].array_expr.accept(self)
@@ -391,7 +478,8 @@ class CodeGenerator (Visitor):
             
             for var_ref in var_rvalue.path[1:]: #excludes first and last element
                 field_name = var_ref.var_name.lexeme
-                self.add_instr(GETF(field_name))
+                field_index, path_type = self.field_slot(path_type, var_ref)
+                self.add_instr(GETF(field_index, field_name))
                 if var_ref.array_expr:
                     var_ref.array_expr.accept(self)
                     self.add_instr(GETI())
@@ -10,6 +10,15 @@ DATE: Spring 2024
 from dataclasses import dataclass, field
 from typing import Any
 from mypl_opcode import OpCode
+from mypl_error import VMError
+
+
+# opcode value of the sentinel entry that ends every linked instruction
+# stream (OpCode values start at 1)
+END = 0
+
+# most recycled frames each frame template keeps
+FRAME_POOL_SIZE = 16
 
 
 @dataclass
@@ -19,9 +28,85 @@ class VMFrameTemplate:
     function_name: str
     arg_count: int
     instructions: list['VMInstr'] = field(default_factory=list) 
+    # pre-decoded instruction stream (filled in by link)
+    opcodes: tuple = ()
+    operands: tuple = ()
+    size: int = 0
+    # number of variable slots in a frame (set by the code generator)
+    local_count: int = 0
+    # local_count nulls, copied into recycled frames (set by link)
+    null_variables: list = field(default_factory=list, repr=False,
+                                 compare=False)
+    # frames of finished calls, recycled by new_frame
+    free_frames: list['VMFrame'] = field(default_factory=list, repr=False,
+                                         compare=False)
+
+    def link(self, templates=None):
+        """Pre-decode the instructions into parallel tuples of integer
+        opcodes and operands, each followed by an END sentinel so running
+        off the end of the function needs no bounds check. The original
+        instruction list is kept for printing and error messages. Also
+        makes sure local_count covers every memory address used (for
+        templates that were not built by the code generator).
+
+        Args:
+            templates -- If given, the function name -> VMFrameTemplate
+                         mapping used to replace the function names of
+                         CALL and TCALL with the called template.
+
+        """
+        self.size = len(self.instructions)
+        self.opcodes = tuple(i.opcode.value for i in self.instructions) + (END,)
+        operands = []
+        for pc, instr in enumerate(self.instructions):
+            operand = instr.operand
+            if templates is not None and \
+               instr.opcode in [OpCode.CALL, OpCode.TCALL]:
+                if operand not in templates:
+                    msg = f'call to undefined function "{operand}"'
+                    msg += f' (in {self.function_name} at {pc}: {instr})'
+                    raise VMError(msg)
+                operand = templates[operand]
+            operands.append(operand)
+        self.operands = tuple(operands) + (None,)
+        for instr in self.instructions:
+            if instr.opcode in [OpCode.LOAD, OpCode.STORE, OpCode.ADDL]:
+                mem_addr = instr.operand
+            elif instr.opcode in [OpCode.INCL, OpCode.LOADF]:
+                mem_addr = instr.operand[0]
+            else:
+                continue
+            self.local_count = max(self.local_count, mem_addr + 1)
+        self.local_count = max(self.local_count, self.arg_count)
+        self.null_variables = [None] * self.local_count
+
+
+    def new_frame(self):
+        """Returns a frame for a new call, with every variable slot already
+        allocated (and null).
+
+        """
+        if self.free_frames:
+            frame = self.free_frames.pop()
+            frame.pc = 0
+            return frame
+        return VMFrame(self, 0, [None] * self.local_count, [])
+
+
+    def free_frame(self, frame):
+        """Recycle the frame of a call that returned, dropping the values
+        it holds so they can be reclaimed. The variables are cleared in
+        place, so recycling allocates nothing. At most FRAME_POOL_SIZE
+        frames are kept.
+
+        """
+        if len(self.free_frames) < FRAME_POOL_SIZE:
+            frame.operand_stack.clear()
+            frame.variables[:] = self.null_variables
+            self.free_frames.append(frame)
 
     
-@dataclass
+@dataclass(slots=True)
 class VMFrame:
     """A VM function-call frame."""
     template: VMFrameTemplate
@@ -58,6 +143,9 @@ def LOAD(mem_addr):
 def STORE(mem_addr):
     return VMInstr(OpCode.STORE, mem_addr)
 
+def ADDL(mem_addr):
+    return VMInstr(OpCode.ADDL, mem_addr)
+
 def ADD():
     return VMInstr(OpCode.ADD)
 
@@ -103,12 +191,24 @@ def CALL(fun_name):
 def RET():
     return VMInstr(OpCode.RET)    
 
+def TCALL(fun_name):
+    return VMInstr(OpCode.TCALL, fun_name)
+
 def WRITE():
     return VMInstr(OpCode.WRITE)
 
 def READ():
     return VMInstr(OpCode.READ)
 
+def READA():
+    return VMInstr(OpCode.READA)
+
+def READN():
+    return VMInstr(OpCode.READN)
+
+def EOF():
+    return VMInstr(OpCode.EOF)
+
 def LEN():
     return VMInstr(OpCode.LEN)
 
@@ -124,17 +224,17 @@ def TODBL():
 def TOSTR():
     return VMInstr(OpCode.TOSTR)
 
-def ALLOCS():
-    return VMInstr(OpCode.ALLOCS)
+def ALLOCS(field_count, struct_name=''):
+    return VMInstr(OpCode.ALLOCS, field_count, struct_name)
 
-def SETF(field_name):
-    return VMInstr(OpCode.SETF, field_name)
+def SETF(field_index, field_name=''):
+    return VMInstr(OpCode.SETF, field_index, field_name)
 
-def GETF(field_name):
-    return VMInstr(OpCode.GETF, field_name)
+def GETF(field_index, field_name=''):
+    return VMInstr(OpCode.GETF, field_index, field_name)
 
-def ALLOCA():
-    return VMInstr(OpCode.ALLOCA)
+def ALLOCA(elem_type=None):
+    return VMInstr(OpCode.ALLOCA, elem_type)
 
 def SETI():
     return VMInstr(OpCode.SETI)
@@ -148,6 +248,23 @@ def DUP():
 def NOP():
     return VMInstr(OpCode.NOP)
 
+def INCL(mem_addr, value):
+    return VMInstr(OpCode.INCL, (mem_addr, value))
 
+def LOADF(mem_addr, field_index):
+    return VMInstr(OpCode.LOADF, (mem_addr, field_index))
 
-    
+def SWAP():
+    return VMInstr(OpCode.SWAP)
+
+def CMPLTJF(offset):
+    return VMInstr(OpCode.CMPLTJF, offset)
+
+def CMPLEJF(offset):
+    return VMInstr(OpCode.CMPLEJF, offset)
+
+def CMPEQJF(offset):
+    return VMInstr(OpCode.CMPEQJF, offset)
+
+def CMPNEJF(offset):
+    return VMInstr(OpCode.CMPNEJF, offset)
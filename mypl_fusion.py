@@ -0,0 +1,167 @@
+"""Superinstruction fusion pass for MyPL VM instructions.
+
+Rewrites common instruction sequences produced by the code generator
+into single superinstructions, so the VM dispatches fewer instructions
+per loop iteration.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+from mypl_opcode import OpCode
+from mypl_frame import *
+
+
+# opcodes whose operand is an instruction offset
+JUMP_OPCODES = [OpCode.JMP, OpCode.JMPF, OpCode.CMPLTJF, OpCode.CMPLEJF,
+                OpCode.CMPEQJF, OpCode.CMPNEJF]
+
+# comparison -> fused compare-and-branch instruction
+COMPARE_JUMPS = {OpCode.CMPLT: CMPLTJF, OpCode.CMPLE: CMPLEJF,
+                 OpCode.CMPEQ: CMPEQJF, OpCode.CMPNE: CMPNEJF}
+
+
+class FusionPass:
+    """Fuses instruction sequences of each frame template into
+    superinstructions and records which fusions fired.
+
+    """
+
+    def __init__(self):
+        """Create a fusion pass with an empty report."""
+        # fusion name -> function name -> number of times it fired
+        self.fired = {}
+        # scratch memory addresses of the template being fused
+        self.scratch = set()
+
+
+    def run(self, vm):
+        """Fuse the instructions of every frame template in the given VM.
+
+        Args:
+            vm -- The VM holding the generated frame templates.
+
+        """
+        for template in vm.frame_templates.values():
+            self.fuse(template)
+
+
+    def fuse(self, template):
+        """Rewrite the instructions of a single frame template in place.
+
+        A sequence is only fused if no jump lands inside it, and all jump
+        offsets are remapped to the shortened instruction list.
+
+        Args:
+            template -- The VMFrameTemplate to rewrite.
+
+        """
+        instrs = template.instructions
+        targets = set()
+        for instr in instrs:
+            if instr.opcode in JUMP_OPCODES:
+                targets.add(instr.operand)
+        self.scratch = self.scratch_slots(instrs)
+        fused_instrs = []
+        new_index = {}
+        i = 0
+        while i < len(instrs):
+            new_index[i] = len(fused_instrs)
+            match = self.match(instrs, i, targets)
+            if match:
+                name, length, fused_instr = match
+                fused_instr.comment = name
+                counts = self.fired.setdefault(name, {})
+                fun_name = template.function_name
+                counts[fun_name] = counts.get(fun_name, 0) + 1
+            else:
+                length, fused_instr = 1, instrs[i]
+            fused_instrs.append(fused_instr)
+            i += length
+        new_index[len(instrs)] = len(fused_instrs)
+        for instr in fused_instrs:
+            if instr.opcode in JUMP_OPCODES:
+                instr.operand = new_index[instr.operand]
+        template.instructions = fused_instrs
+
+
+    def scratch_slots(self, instrs):
+        """Returns the memory addresses that are only ever accessed by
+        STORE a; STORE b; LOAD a; LOAD b sequences (the scratch slots used
+        for the > and >= operators), and so hold no value worth keeping.
+
+        """
+        accesses = {}
+        in_swaps = {}
+        for instr in instrs:
+            if instr.opcode in [OpCode.LOAD, OpCode.STORE, OpCode.ADDL]:
+                addr = instr.operand
+                accesses[addr] = accesses.get(addr, 0) + 1
+        for i in range(len(instrs) - 3):
+            seq = instrs[i:i+4]
+            ops = [instr.opcode for instr in seq]
+            addrs = [instr.operand for instr in seq]
+            if ops == [OpCode.STORE, OpCode.STORE, OpCode.LOAD, OpCode.LOAD] \
+               and addrs[0] != addrs[1] and addrs[:2] == addrs[2:]:
+                for addr in addrs:
+                    in_swaps[addr] = in_swaps.get(addr, 0) + 1
+        return {a for a in in_swaps if in_swaps[a] == accesses[a]}
+
+
+    def match(self, instrs, i, targets):
+        """Returns (fusion name, sequence length, superinstruction) for the
+        sequence starting at index i, or None if no fusion applies.
+
+        """
+        def opcodes(n):
+            if i + n > len(instrs):
+                return []
+            if any(j in targets for j in range(i + 1, i + n)):
+                return []
+            return [instr.opcode for instr in instrs[i:i+n]]
+
+        # LOAD a; PUSH c; ADD|SUB; STORE a  ->  INCL (a, +/-c)
+        ops = opcodes(4)
+        if ops[:2] == [OpCode.LOAD, OpCode.PUSH] and ops[3:] == [OpCode.STORE]:
+            addr = instrs[i].operand
+            value = instrs[i+1].operand
+            numeric = type(value) in [int, float]
+            if instrs[i+3].operand == addr and value is not None:
+                if ops[2] == OpCode.ADD:
+                    return 'increment-local', 4, INCL(addr, value)
+                if ops[2] == OpCode.SUB and numeric:
+                    return 'increment-local', 4, INCL(addr, -value)
+
+        # STORE a; STORE b; LOAD a; LOAD b  ->  SWAP (scratch slots used
+        # for the > and >= operators)
+        if ops == [OpCode.STORE, OpCode.STORE, OpCode.LOAD, OpCode.LOAD]:
+            a, b = instrs[i].operand, instrs[i+1].operand
+            if a != b and [instrs[i+2].operand, instrs[i+3].operand] == [a, b] \
+               and a in self.scratch and b in self.scratch:
+                return 'swap', 4, SWAP()
+
+        # CMPxx; JMPF t  ->  CMPxxJF t
+        ops = opcodes(2)
+        if ops[1:] == [OpCode.JMPF] and ops[0] in COMPARE_JUMPS:
+            make_instr = COMPARE_JUMPS[ops[0]]
+            return 'compare-and-branch', 2, make_instr(instrs[i+1].operand)
+
+        # LOAD x; GETF f  ->  LOADF (x, f)
+        if ops == [OpCode.LOAD, OpCode.GETF]:
+            fused = LOADF(instrs[i].operand, instrs[i+1].operand)
+            return 'load-field-of-local', 2, fused
+
+        return None
+
+
+    def report(self):
+        """Returns a human-readable table of the fusions that fired."""
+        if not self.fired:
+            return 'No fusions fired\n'
+        s = f'{"FUSION":<22}{"FUNCTION":<24}{"COUNT":>6}\n'
+        for name, counts in sorted(self.fired.items()):
+            for fun_name, count in sorted(counts.items()):
+                s += f'{name:<22}{fun_name:<24}{count:>6}\n'
+            s += f'{name:<22}{"(total)":<24}{sum(counts.values()):>6}\n'
+        return s
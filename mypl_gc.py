@@ -0,0 +1,110 @@
+"""Garbage collection statistics for MyPL runs.
+
+Structs and arrays are ordinary Python objects referenced directly from
+frames (see mypl_vm.Struct and mypl_vm.Array), so an object is freed as
+soon as the last reference to it goes away, and cycles of objects (such
+as doubly linked lists) are found by Python's generational mark-sweep
+collector, which runs whenever the number of allocations since the last
+collection passes a threshold. GCStats records what that collector does
+during a run.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import gc
+import time
+
+
+class GCStats:
+    """Counts the garbage collections, their pause times and the objects
+    they reclaim while active.
+
+    """
+
+    def __init__(self):
+        """Create a collector statistics object with no data."""
+        self.collections = [0, 0, 0]   # collections per generation
+        self.collected = [0, 0, 0]     # objects reclaimed per generation
+        self.uncollectable = 0         # unreachable objects left over
+        self.pause_total = 0.0         # seconds spent collecting
+        self.pause_max = 0.0           # longest single collection
+        self.start_time = None         # start of the current collection
+
+
+    def __call__(self, phase, info):
+        """The gc.callbacks hook, called at the start and end of every
+        collection.
+
+        """
+        if phase == 'start':
+            self.start_time = time.perf_counter()
+        elif self.start_time is not None:
+            pause = time.perf_counter() - self.start_time
+            self.start_time = None
+            generation = info['generation']
+            self.collections[generation] += 1
+            self.collected[generation] += info['collected']
+            self.uncollectable += info['uncollectable']
+            self.pause_total += pause
+            self.pause_max = max(self.pause_max, pause)
+
+
+    def start(self):
+        """Start recording collections."""
+        if self not in gc.callbacks:
+            gc.callbacks.append(self)
+
+
+    def stop(self):
+        """Stop recording collections."""
+        if self in gc.callbacks:
+            gc.callbacks.remove(self)
+
+
+    def profile(self, vm, **kwargs):
+        """Run the given VM while recording collections.
+
+        Args:
+            vm -- The VM to run.
+            kwargs -- Passed on to vm.run.
+
+        """
+        self.start()
+        try:
+            vm.run(**kwargs)
+        finally:
+            self.stop()
+
+
+    #----------------------------------------------------------------------
+    # Reports
+    #----------------------------------------------------------------------
+
+    def total(self):
+        """Returns the number of collections recorded."""
+        return sum(self.collections)
+
+
+    def report(self):
+        """Returns a human-readable table of the collections."""
+        s = f'{"GENERATION":<12}{"COLLECTIONS":>12}{"RECLAIMED":>12}\n'
+        for generation in range(3):
+            s += f'{generation:<12}{self.collections[generation]:>12}'
+            s += f'{self.collected[generation]:>12}\n'
+        s += f'{"(total)":<12}{self.total():>12}{sum(self.collected):>12}\n'
+        s += f'pause: {self.pause_total * 1000:.2f}ms total, '
+        s += f'{self.pause_max * 1000:.2f}ms max\n'
+        if self.uncollectable:
+            s += f'uncollectable: {self.uncollectable}\n'
+        return s
+
+
+    def to_dict(self):
+        """Returns the statistics as a JSON-compatible dictionary."""
+        return {'collections': list(self.collections),
+                'collected': list(self.collected),
+                'uncollectable': self.uncollectable,
+                'pause_total': self.pause_total,
+                'pause_max': self.pause_max}
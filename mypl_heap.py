@@ -0,0 +1,197 @@
+"""Heap statistics for the MyPL VM.
+
+HeapStats counts every struct and array a VM allocates, by type and by
+allocating instruction, and finds the live objects (and their
+approximate size in bytes) with a census of everything reachable from
+the frames on the call stack. A census runs whenever the number of
+allocations since the last one reaches the number of values it looked
+at (so censuses take time in proportion to the allocations), which also
+tracks the peak.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import sys
+from mypl_opcode import OpCode
+from mypl_vm import Struct, Array, TypedArray
+
+
+# objects counted by a census
+HEAP_TYPES = (Struct, Array, TypedArray)
+
+
+class HeapStats:
+    """Allocation counts and live-object censuses of a VM run."""
+
+    def __init__(self, census_interval=1):
+        """Create a heap statistics object with no data.
+
+        Args:
+            census_interval -- The fewest allocations between censuses.
+
+        """
+        self.census_interval = census_interval
+        self.allocations = {}     # type label -> [count, bytes]
+        self.sites = {}           # (function name, pc) -> [label, count, bytes]
+        self.live = {}            # type label -> [count, bytes] (last census)
+        self.peak = {}            # type label -> [count, bytes] (peak census)
+        self.peak_bytes = 0
+        # (allocations so far, live objects, live bytes) of each census
+        self.history = []
+        # id -> (type label, bytes) of the objects allocated and not yet
+        # found dead by a census
+        self.objects = {}
+        self.since_census = 0     # allocations since the last census
+        self.next_census = census_interval
+
+
+    def profile(self, vm, **kwargs):
+        """Run the given VM while recording its heap.
+
+        Args:
+            vm -- The VM to run.
+            kwargs -- Passed on to vm.run.
+
+        """
+        vm.heap_stats = self
+        try:
+            vm.run(**kwargs)
+        finally:
+            vm.heap_stats = None
+            self.finish(vm)
+
+
+    def finish(self, vm):
+        """Take a last census if the run ended with frames still on the
+        call stack (when stopped by an error).
+
+        """
+        if vm.call_stack:
+            self.census(vm)
+
+
+    def record(self, vm, frame):
+        """Count the object just allocated (and pushed) by the instruction
+        before the frame's pc, running a census when one is due.
+
+        """
+        obj = frame.operand_stack[-1]
+        pc = frame.pc - 1
+        instr = frame.template.instructions[pc]
+        if instr.opcode == OpCode.ALLOCS:
+            label = instr.comment or 'struct'
+        else:
+            label = f'array {instr.operand}' if instr.operand else 'array'
+        size = sys.getsizeof(obj)
+        self.objects[id(obj)] = (label, size)
+        totals = self.allocations.setdefault(label, [0, 0])
+        totals[0] += 1
+        totals[1] += size
+        site = self.sites.setdefault((frame.template.function_name, pc),
+                                     [label, 0, 0])
+        site[1] += 1
+        site[2] += size
+        self.since_census += 1
+        if self.since_census >= self.next_census:
+            self.census(vm)
+
+
+    def census(self, vm):
+        """Find the objects reachable from the VM's call stack, recording
+        them as the live objects (and the peak if they take more bytes
+        than any census before). Returns the live objects as type label
+        -> [count, bytes].
+
+        """
+        known = self.objects
+        objects = {}
+        live = {}
+        pending = []
+        for frame in vm.call_stack:
+            pending.extend(frame.variables)
+            pending.extend(frame.operand_stack)
+        roots = len(pending)
+        while pending:
+            value = pending.pop()
+            if not isinstance(value, HEAP_TYPES) or id(value) in objects:
+                continue
+            entry = known.get(id(value))
+            if entry is None:
+                entry = (type(value).__name__, sys.getsizeof(value))
+            objects[id(value)] = entry
+            totals = live.setdefault(entry[0], [0, 0])
+            totals[0] += 1
+            totals[1] += entry[1]
+            if not isinstance(value, TypedArray):
+                pending.extend(value)
+        self.objects = objects
+        self.live = live
+        live_count = sum(count for count, size in live.values())
+        live_bytes = sum(size for count, size in live.values())
+        if live_bytes > self.peak_bytes:
+            self.peak_bytes = live_bytes
+            self.peak = {label: list(totals) for label, totals in live.items()}
+        self.history.append((self.total(), live_count, live_bytes))
+        self.since_census = 0
+        self.next_census = max(self.census_interval, live_count + roots)
+        return live
+
+
+    #----------------------------------------------------------------------
+    # Reports
+    #----------------------------------------------------------------------
+
+    def total(self):
+        """Returns the number of objects allocated."""
+        return sum(count for count, size in self.allocations.values())
+
+
+    def report(self, top=10):
+        """Returns human-readable tables of the heap statistics.
+
+        Args:
+            top -- The number of most allocating instructions to list.
+
+        """
+        s = f'{"TYPE":<24}{"ALLOCATED":>12}{"BYTES":>14}'
+        s += f'{"PEAK LIVE":>12}{"PEAK BYTES":>14}\n'
+        for label, (count, size) in sorted(self.allocations.items(),
+                                           key=lambda item: -item[1][1]):
+            peak_count, peak_size = self.peak.get(label, (0, 0))
+            s += f'{label:<24}{count:>12}{size:>14}'
+            s += f'{peak_count:>12}{peak_size:>14}\n'
+        allocated_bytes = sum(size for count, size in self.allocations.values())
+        peak_count = sum(count for count, size in self.peak.values())
+        s += f'{"(total)":<24}{self.total():>12}{allocated_bytes:>14}'
+        s += f'{peak_count:>12}{self.peak_bytes:>14}\n'
+        if self.history:
+            allocated, live_count, live_bytes = self.history[-1]
+            s += f'censuses: {len(self.history)}, last after {allocated} '
+            s += f'allocations: {live_count} live objects, {live_bytes} bytes\n'
+        s += f'\n{"FUNCTION":<24}{"PC":>6}  {"TYPE":<24}{"COUNT":>12}'
+        s += f'{"BYTES":>14}\n'
+        sites = sorted(self.sites.items(), key=lambda item: -item[1][2])
+        for (name, pc), (label, count, size) in sites[:top]:
+            s += f'{name:<24}{pc:>6}  {label:<24}{count:>12}{size:>14}\n'
+        return s
+
+
+    def to_dict(self):
+        """Returns the statistics as a JSON-compatible dictionary."""
+        sites = [{'function': name, 'pc': pc, 'type': label,
+                  'count': count, 'bytes': size}
+                 for (name, pc), (label, count, size) in sorted(self.sites.items())]
+        censuses = [{'allocations': allocated, 'live_objects': live_count,
+                     'live_bytes': live_bytes}
+                    for allocated, live_count, live_bytes in self.history]
+        return {'allocations': {label: {'count': count, 'bytes': size}
+                                for label, (count, size) in self.allocations.items()},
+                'live': {label: {'count': count, 'bytes': size}
+                         for label, (count, size) in self.live.items()},
+                'peak': {label: {'count': count, 'bytes': size}
+                         for label, (count, size) in self.peak.items()},
+                'peak_bytes': self.peak_bytes,
+                'sites': sites,
+                'censuses': censuses}
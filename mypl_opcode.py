@@ -16,6 +16,7 @@ OpCode = Enum('OpCode', [
     'POP',     # pop x
     'LOAD',    # push value at memory address (operand) A 
     'STORE',   # pop x, store x at memory address (operand) A
+    'ADDL',    # pop x, append x to the value at memory address A (in place)
 
     # arithmetic, relational, and logical operators
     'ADD',     # pop x, pop y, push (y + x) 
@@ -37,25 +38,38 @@ OpCode = Enum('OpCode', [
     # functions
     'CALL',    # call function A (pop and push arguments)
     'RET',     # return from current function
+    'TCALL',   # call function A in place of the current function (tail call)
 
     # built ins
     'WRITE',   # pop x, print x to standard output
     'READ',    # read standard input, push result onto stack
-    'LEN',     # pop string x, push len(x) if str, else push len(obj(x))
+    'READA',   # read the rest of standard input, push its lines as an array
+    'READN',   # pop int x, read x more lines (fewer at the end), push array
+    'EOF',     # push true if standard input has no more lines
+    'LEN',     # pop string or array x, push len(x)
     'GETC',    # pop string x, pop int y, push x[y]
     'TOINT',   # pop x, push int(x)
     'TODBL',   # pop x, push double(x)
     'TOSTR',   # pop x, push str(x)
 
     # heap
-    'ALLOCS',  # allocate struct object, push oid x
-    'SETF',    # pop value x, pop oid y, set obj(y)[A] = x
-    'GETF',    # pop oid x, push obj(x)[A] onto stack
-    'ALLOCA',  # pop int x, allocate array object with x None values, push oid
-    'SETI',    # pop value x, pop index y, pop oid z, set array obj(z)[y] = x
-    'GETI',    # pop index x, pop oid y, push obj(y)[x] onto stack
+    'ALLOCS',  # allocate struct object with A fields, push its reference x
+    'SETF',    # pop value x, pop struct y, set field slot y[A] = x
+    'GETF',    # pop struct x, push field slot x[A] onto stack
+    'ALLOCA',  # pop int x, allocate array of x None values of type A, push it
+    'SETI',    # pop value x, pop index y, pop array z, set z[y] = x
+    'GETI',    # pop index x, pop array y, push y[x] onto stack
 
     # special
     'DUP',     # pop x, push x, push x
-    'NOP'      # do nothing
+    'NOP',     # do nothing
+
+    # superinstructions (only produced by the fusion pass)
+    'INCL',    # A = (addr, c): set memory address addr to (value + c)
+    'LOADF',   # A = (addr, f): push obj(value at memory address addr)[f]
+    'SWAP',    # pop x, pop y, push x, push y
+    'CMPLTJF', # pop x, pop y, if not (y < x) jump to offset A
+    'CMPLEJF', # pop x, pop y, if not (y <= x) jump to offset A
+    'CMPEQJF', # pop x, pop y, if not (y == x) jump to offset A
+    'CMPNEJF', # pop x, pop y, if not (y != x) jump to offset A
 ])
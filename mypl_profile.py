@@ -0,0 +1,292 @@
+"""Opcode and function-level profilers for the MyPL VM.
+
+Profiler is a trace callable for VM.run: it counts every instruction it
+is shown and times it up to the next one, and follows calls and returns
+from the changes in call stack depth between trace records.
+SamplingProfiler instead looks at the VM's call stack from a background
+thread every few milliseconds, which costs little enough to leave on for
+long runs, and reports the stacks it saw in the collapsed format read by
+flamegraph tools.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import json
+import threading
+import time
+from mypl_opcode import OpCode
+
+
+class Profiler:
+    """Collects instruction counts, call counts and times of a VM run."""
+
+    def __init__(self):
+        """Create a profiler with no data."""
+        self.opcode_counts = {}      # opcode name -> instructions executed
+        self.function_counts = {}    # function name -> instructions executed
+        self.instr_counts = {}       # (function name, pc) -> count
+        self.instrs = {}             # (function name, pc) -> VMInstr
+        self.calls = {}              # function name -> number of calls
+        self.inclusive = {}          # function name -> seconds (with callees)
+        self.exclusive = {}          # function name -> seconds (own code)
+        # function calls in progress, as [function name, start time]
+        self.shadow_stack = []
+        # function name -> number of its calls in progress (recursion)
+        self.active = {}
+        # run time so far, leaving out the profiler's own work
+        self.elapsed = 0.0
+        self.last_record = None
+        self.last_time = 0.0
+
+
+    def profile(self, vm, **kwargs):
+        """Run the given VM under the profiler.
+
+        Args:
+            vm -- The VM to run.
+            kwargs -- Passed on to vm.run.
+
+        """
+        try:
+            vm.run(trace=self, **kwargs)
+        finally:
+            self.finish()
+
+
+    def __call__(self, record):
+        """Account for the previous instruction and count the given one."""
+        now = time.perf_counter()
+        last_record = self.last_record
+        if last_record is not None:
+            elapsed = now - self.last_time
+            self.elapsed += elapsed
+            name = last_record.function
+            self.exclusive[name] = self.exclusive.get(name, 0.0) + elapsed
+            # returns, or a tail call replacing the current call
+            while len(self.shadow_stack) > record.depth:
+                self.leave()
+            if last_record.instr.opcode == OpCode.TCALL and \
+               len(self.shadow_stack) == record.depth:
+                self.leave()
+        if len(self.shadow_stack) < record.depth:
+            self.enter(record.function)
+
+        name = record.function
+        key = (name, record.pc)
+        opcode = record.instr.opcode.name
+        self.opcode_counts[opcode] = self.opcode_counts.get(opcode, 0) + 1
+        self.function_counts[name] = self.function_counts.get(name, 0) + 1
+        if key in self.instr_counts:
+            self.instr_counts[key] += 1
+        else:
+            self.instr_counts[key] = 1
+            self.instrs[key] = record.instr
+        self.last_record = record
+        self.last_time = time.perf_counter()
+
+
+    def enter(self, name):
+        """Start a call of the given function."""
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.active[name] = self.active.get(name, 0) + 1
+        self.shadow_stack.append([name, self.elapsed])
+
+
+    def leave(self):
+        """End the most recent call, adding its time to the function's
+        inclusive time unless the function is still running further down
+        the call stack (so recursion is not counted twice).
+
+        """
+        name, start = self.shadow_stack.pop()
+        self.active[name] -= 1
+        if not self.active[name]:
+            total = self.elapsed - start
+            self.inclusive[name] = self.inclusive.get(name, 0.0) + total
+
+
+    def finish(self):
+        """Account for the last instruction and end the calls in progress
+        once the run is over.
+
+        """
+        if self.last_record is not None:
+            elapsed = time.perf_counter() - self.last_time
+            self.elapsed += elapsed
+            name = self.last_record.function
+            self.exclusive[name] = self.exclusive.get(name, 0.0) + elapsed
+            self.last_record = None
+        while self.shadow_stack:
+            self.leave()
+
+
+    #----------------------------------------------------------------------
+    # Reports
+    #----------------------------------------------------------------------
+
+    def total(self):
+        """Returns the number of instructions executed."""
+        return sum(self.opcode_counts.values())
+
+
+    def report(self, top=20):
+        """Returns human-readable tables of the profile.
+
+        Args:
+            top -- The number of most executed instructions to list.
+
+        """
+        total = max(self.total(), 1)
+        s = f'{"FUNCTION":<24}{"CALLS":>8}{"INSTRS":>12}{"INCL(ms)":>12}'
+        s += f'{"EXCL(ms)":>12}\n'
+        for name in sorted(self.function_counts, key=self.exclusive.get,
+                           reverse=True):
+            s += f'{name:<24}{self.calls.get(name, 0):>8}'
+            s += f'{self.function_counts[name]:>12}'
+            s += f'{self.inclusive.get(name, 0.0) * 1000:>12.2f}'
+            s += f'{self.exclusive.get(name, 0.0) * 1000:>12.2f}\n'
+        s += f'\n{"OPCODE":<24}{"COUNT":>12}{"%":>8}\n'
+        for opcode, count in sorted(self.opcode_counts.items(),
+                                    key=lambda item: -item[1]):
+            s += f'{opcode:<24}{count:>12}{100 * count / total:>8.1f}\n'
+        s += f'{"(total)":<24}{self.total():>12}\n'
+        s += f'\n{"FUNCTION":<24}{"PC":>6}  {"INSTRUCTION":<30}{"COUNT":>12}\n'
+        hot = sorted(self.instr_counts.items(), key=lambda item: -item[1])
+        for (name, pc), count in hot[:top]:
+            instr = str(self.instrs[(name, pc)])
+            s += f'{name:<24}{pc:>6}  {instr:<30}{count:>12}\n'
+        return s
+
+
+    def to_dict(self):
+        """Returns the profile as a JSON-compatible dictionary."""
+        functions = {}
+        for name in self.function_counts:
+            functions[name] = {'calls': self.calls.get(name, 0),
+                               'instructions': self.function_counts[name],
+                               'inclusive': self.inclusive.get(name, 0.0),
+                               'exclusive': self.exclusive.get(name, 0.0)}
+        instructions = []
+        for (name, pc), count in sorted(self.instr_counts.items()):
+            instructions.append({'function': name, 'pc': pc,
+                                 'instruction': str(self.instrs[(name, pc)]),
+                                 'count': count})
+        return {'total_instructions': self.total(),
+                'opcodes': dict(sorted(self.opcode_counts.items())),
+                'functions': functions,
+                'instructions': instructions}
+
+
+    def write_json(self, out_stream):
+        """Write the profile as JSON to the given (text) file."""
+        json.dump(self.to_dict(), out_stream, indent=2)
+        out_stream.write('\n')
+
+
+class SamplingProfiler:
+    """Periodically samples the call stack of a running VM."""
+
+    def __init__(self, interval=0.005):
+        """Create a sampling profiler.
+
+        Args:
+            interval -- Seconds between samples. Python only switches
+                        threads every sys.getswitchinterval() seconds (5 ms
+                        by default), so shorter intervals take no more
+                        samples.
+
+        """
+        self.interval = interval
+        # call stack, as a tuple of (function name, pc), -> times seen
+        self.samples = {}
+        self.thread = None
+        self.vm = None
+        self.stopped = threading.Event()
+
+
+    def profile(self, vm, **kwargs):
+        """Run the given VM while sampling its call stack.
+
+        Args:
+            vm -- The VM to run.
+            kwargs -- Passed on to vm.run.
+
+        """
+        self.start(vm)
+        try:
+            vm.run(**kwargs)
+        finally:
+            self.stop()
+
+
+    def start(self, vm):
+        """Start sampling the call stack of the given VM (which runs on
+        the stack VM's run loop while sampled, since the other backends
+        do not keep the pcs of their frames).
+
+        """
+        self.vm = vm
+        vm.sampler = self
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.sample_loop,
+                                       args=(vm.call_stack,), daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """Stop sampling."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.vm is not None:
+            self.vm.sampler = None
+            self.vm = None
+
+
+    def sample_loop(self, call_stack):
+        """Take a sample every interval until stopped."""
+        samples = self.samples
+        while not self.stopped.wait(self.interval):
+            # a copy, since the VM keeps running while the frames are read
+            frames = call_stack[:]
+            if not frames:
+                continue
+            # the pc of a frame is the next instruction: report the current
+            # one (the CALL for the callers)
+            stack = tuple((frame.template.function_name, max(frame.pc - 1, 0))
+                          for frame in frames)
+            samples[stack] = samples.get(stack, 0) + 1
+
+
+    def total(self):
+        """Returns the number of samples taken."""
+        return sum(self.samples.values())
+
+
+    def collapsed(self, pcs=False):
+        """Returns the samples as collapsed stacks, one line per distinct
+        stack with its frames separated by semicolons, outermost first,
+        followed by the number of samples.
+
+        Args:
+            pcs -- If true, label each frame with its pc (as name:pc).
+
+        """
+        counts = {}
+        for stack, count in self.samples.items():
+            if pcs:
+                names = [f'{name}:{pc}' for name, pc in stack]
+            else:
+                names = [name for name, pc in stack]
+            line = ';'.join(names)
+            counts[line] = counts.get(line, 0) + count
+        return ''.join(f'{line} {count}\n'
+                       for line, count in sorted(counts.items()))
+
+
+    def write_collapsed(self, out_stream, pcs=False):
+        """Write the collapsed stacks to the given (text) file."""
+        out_stream.write(self.collapsed(pcs))
@@ -0,0 +1,501 @@
+"""Python code generator for running MyPL programs as native Python.
+
+Translates a (semantically checked) MyPL program into Python source with
+one Python function per MyPL function and one __slots__ class per
+struct, compiles it with compile(), and runs main directly. Values keep
+the same representation the VM uses (int, float, str, bool, None), and
+the runtime helpers below reproduce the VM's semantics where Python's
+own operators differ (int division, null checks, eager and/or, array
+bounds and print formatting).
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import keyword
+import sys
+
+from mypl_error import *
+from mypl_token import *
+from mypl_ast import *
+from mypl_var_table import *
+from mypl_vm import Array, InputBuffer
+
+
+#----------------------------------------------------------------------
+# Runtime support for the generated code
+#----------------------------------------------------------------------
+
+def add_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y + x
+
+def sub_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y - x
+
+def mul_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y * x
+
+def lt_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y < x
+
+def le_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y <= x
+
+def gt_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y > x
+
+def ge_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y >= x
+
+def div_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    elif x == 0:
+        raise VMError("can't divide by 0")
+    result = y / x
+    if type(x) == int or type(y) == int:
+        result = int(result)
+    return result
+
+def and_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y and x
+
+def or_op(y, x):
+    if x == None or y == None:
+        raise VMError("operands cant be None during operator use")
+    return y or x
+
+def not_op(x):
+    if x == None:
+        raise VMError("operands cant be None during operator use")
+    return not x
+
+def write(msg):
+    if msg == None:
+        msg = "null"
+    elif isinstance(msg, bool):
+        msg = "true" if msg else "false"
+    else:
+        msg = str(msg)
+    print(msg, end='')
+
+class Stdin(InputBuffer):
+    """The standard input of a run, with the input built-ins."""
+
+    def read_all(self):
+        return Array(self.readlines())
+
+    def read_n(self, count):
+        if count is None or count < 0:
+            raise VMError(f'invalid number of lines to read: {count}')
+        return Array(self.readlines(count))
+
+def length(x):
+    if x == None:
+        raise VMError("cant find length of nothing")
+    elif type(x) != str and type(x) != Array:
+        x = str(x)
+    return len(x)
+
+def getc(y, x):
+    if x == None or y == None:
+        raise VMError("string index error")
+    elif y > len(x)-1 or y<0:
+        raise VMError("string index error")
+    return x[y]
+
+def to_int(x):
+    if x == None:
+        raise VMError("None cant become int")
+    try:
+        return int(x)
+    except ValueError:
+        raise VMError("Value cannot be converted to int")
+
+def to_dbl(x):
+    if x == None:
+        raise VMError("None cant become double")
+    try:
+        return float(x)
+    except ValueError:
+        raise VMError("Value cannot be converted to double")
+
+def to_str(x):
+    if x == None:
+        raise VMError("None cant become string")
+    return str(x)
+
+def new_array(arr_len):
+    if arr_len is None or arr_len < 0:
+        raise VMError("Invalid size for array allocation")
+    return Array([None] * arr_len)
+
+def get_index(array, index):
+    if index == None or array == None:
+        raise VMError("array access can't have None type")
+    elif index < 0 or index >= len(array):
+        raise VMError(f"Invalid index for array access, index = {index}")
+    return array[index]
+
+def deref(obj):
+    if obj == None:
+        raise VMError("struct access can't have None type")
+    return obj
+
+def set_field(obj, field, value):
+    if obj == None:
+        raise VMError("struct access can't have None type")
+    setattr(obj, field, value)
+
+def set_index(array, index, value):
+    if index == None or array == None:
+        raise VMError(f"array access can't have None type, value={value}, index={index}")
+    elif index < 0 or index >= len(array):
+        raise VMError(f"Invalid index for array access {value} {index}")
+    array[index] = value
+
+
+RUNTIME = {
+    'Array': Array, 'add_op': add_op, 'sub_op': sub_op, 'mul_op': mul_op,
+    'lt_op': lt_op, 'le_op': le_op, 'gt_op': gt_op, 'ge_op': ge_op,
+    'div_op': div_op, 'and_op': and_op, 'or_op': or_op,
+    'not_op': not_op, 'write': write, 'length': length, 'getc': getc,
+    'to_int': to_int, 'to_dbl': to_dbl, 'to_str': to_str,
+    'new_array': new_array, 'get_index': get_index, 'set_index': set_index,
+    'deref': deref, 'set_field': set_field,
+}
+
+# MyPL built-in function -> runtime helper
+BUILT_INS = {
+    'print': 'write', 'input': 'stdin.readline', 'length': 'length',
+    'get': 'getc', 'itos': 'to_str', 'dtos': 'to_str', 'stoi': 'to_int',
+    'dtoi': 'to_int', 'stod': 'to_dbl', 'itod': 'to_dbl',
+    'input_all': 'stdin.read_all', 'input_n': 'stdin.read_n',
+    'input_eof': 'stdin.at_end',
+}
+
+# binary operators that map directly onto Python operators (null
+# operands are allowed, as in the VM)
+PY_OPS = {TokenType.EQUAL: '==', TokenType.NOT_EQUAL: '!='}
+
+# binary operators implemented by runtime helpers
+HELPER_OPS = {
+    TokenType.PLUS: 'add_op', TokenType.MINUS: 'sub_op',
+    TokenType.TIMES: 'mul_op', TokenType.DIVIDE: 'div_op',
+    TokenType.LESS: 'lt_op', TokenType.LESS_EQ: 'le_op',
+    TokenType.GREATER: 'gt_op', TokenType.GREATER_EQ: 'ge_op',
+    TokenType.AND: 'and_op', TokenType.OR: 'or_op',
+}
+
+
+class PythonGenerator(Visitor):
+
+    def __init__(self):
+        """Creates a new Python code generator."""
+        # generated source lines and current indentation level
+        self.lines = []
+        self.indent = 0
+        # for var -> index mappings wrt to environments
+        self.var_table = VarTable()
+        # Python code of the most recently visited expression
+        self.curr_code = None
+        # namespace the generated code was executed in
+        self.namespace = None
+
+
+    #----------------------------------------------------------------------
+    # Helper functions
+    #----------------------------------------------------------------------
+
+    def source(self):
+        """Returns the generated Python source."""
+        return '\n'.join(self.lines) + '\n'
+
+
+    def emit(self, line):
+        """Add a line of Python at the current indentation."""
+        self.lines.append('    ' * self.indent + line)
+
+
+    def emit_block(self, stmts):
+        """Generate an indented block for the given statements in a new
+        environment.
+
+        """
+        self.indent += 1
+        self.var_table.push_environment()
+        self.emit_stmts(stmts)
+        self.var_table.pop_environment()
+        self.indent -= 1
+
+
+    def emit_stmts(self, stmts):
+        """Generate the given statements at the current indentation."""
+        start = len(self.lines)
+        for stmt in stmts:
+            if isinstance(stmt, CallExpr):
+                # a call statement, which discards the return value
+                self.emit(self.code(stmt))
+            else:
+                stmt.accept(self)
+        if len(self.lines) == start:
+            self.emit('pass')
+
+
+    def var_name(self, name):
+        """Returns the Python local for a MyPL variable. Variables are
+        suffixed with their frame offset so that a variable declared in
+        a nested block does not overwrite one it shadows.
+
+        """
+        return f'{name}_{self.var_table.get(name)}'
+
+
+    def field_name(self, name):
+        """Returns the Python attribute for a struct field."""
+        return name + '_' if keyword.iskeyword(name) else name
+
+
+    def code(self, node):
+        """Returns the Python code for an expression node."""
+        node.accept(self)
+        return self.curr_code
+
+
+    def condition(self, expr):
+        """Returns the Python code for a branch condition. Like JMPF, the
+        branch is only skipped on false, so null values that are not the
+        result of an operator are compared against False explicitly.
+
+        """
+        code = self.code(expr)
+        if expr.op or expr.not_op:
+            return code
+        return f'{code} != False'
+
+
+    #----------------------------------------------------------------------
+    # Running
+    #----------------------------------------------------------------------
+
+    def run(self, recursion_limit=100000):
+        """Compile the generated source and run the main function.
+
+        Args:
+            recursion_limit -- Python recursion limit to use while running,
+                               bounding the MyPL call depth.
+
+        """
+        code = compile(self.source(), '<mypl>', 'exec')
+        self.namespace = dict(RUNTIME)
+        self.namespace['stdin'] = Stdin()
+        exec(code, self.namespace)
+        old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(old_limit, recursion_limit))
+        try:
+            self.namespace['mypl_main']()
+        except RecursionError:
+            raise VMError("maximum call depth exceeded")
+        finally:
+            sys.setrecursionlimit(old_limit)
+
+
+    #----------------------------------------------------------------------
+    # Visitor functions
+    #----------------------------------------------------------------------
+
+    def visit_program(self, program):
+        for struct_def in program.struct_defs:
+            struct_def.accept(self)
+        for fun_def in program.fun_defs:
+            fun_def.accept(self)
+
+
+    def visit_struct_def(self, struct_def):
+        fields = [self.field_name(f.var_name.lexeme) for f in struct_def.fields]
+        self.emit(f'class struct_{struct_def.struct_name.lexeme}:')
+        self.indent += 1
+        self.emit(f'__slots__ = {tuple(fields)}')
+        params = ''.join(f', a{i}' for i in range(len(fields)))
+        self.emit(f'def __init__(obj{params}):')
+        self.indent += 1
+        for i, field in enumerate(fields):
+            self.emit(f'obj.{field} = a{i}')
+        if not fields:
+            self.emit('pass')
+        self.indent -= 2
+        self.emit('')
+
+
+    def visit_fun_def(self, fun_def):
+        self.var_table.push_environment()
+        params = []
+        for param in fun_def.params:
+            self.var_table.add(param.var_name.lexeme)
+            params.append(self.var_name(param.var_name.lexeme))
+        self.emit(f'def mypl_{fun_def.fun_name.lexeme}({", ".join(params)}):')
+        self.indent += 1
+        self.emit_stmts(fun_def.stmts)
+        self.indent -= 1
+        self.var_table.pop_environment()
+        self.emit('')
+
+
+    def visit_return_stmt(self, return_stmt):
+        if return_stmt.expr:
+            self.emit(f'return {self.code(return_stmt.expr)}')
+        else:
+            self.emit('return None')
+
+
+    def visit_var_decl(self, var_decl):
+        code = self.code(var_decl.expr) if var_decl.expr else 'None'
+        self.var_table.add(var_decl.var_def.var_name.lexeme)
+        self.emit(f'{self.var_name(var_decl.var_def.var_name.lexeme)} = {code}')
+
+
+    def visit_assign_stmt(self, assign_stmt):
+        lvalue = assign_stmt.lvalue
+        target = self.var_name(lvalue[0].var_name.lexeme)
+        if len(lvalue) == 1:
+            if lvalue[0].array_expr:
+                index = self.code(lvalue[0].array_expr)
+                value = self.code(assign_stmt.expr)
+                self.emit(f'set_index({target}, {index}, {value})')
+            else:
+                self.emit(f'{target} = {self.code(assign_stmt.expr)}')
+            return
+        if lvalue[0].array_expr:
+            target = f'get_index({target}, {self.code(lvalue[0].array_expr)})'
+        for var_ref in lvalue[1:-1]:
+            target = f'deref({target}).{self.field_name(var_ref.var_name.lexeme)}'
+            if var_ref.array_expr:
+                target = f'get_index({target}, {self.code(var_ref.array_expr)})'
+        field = self.field_name(lvalue[-1].var_name.lexeme)
+        if lvalue[-1].array_expr:
+            index = self.code(lvalue[-1].array_expr)
+            value = self.code(assign_stmt.expr)
+            self.emit(f'set_index(deref({target}).{field}, {index}, {value})')
+        else:
+            # the object is evaluated before the value, as in the VM
+            value = self.code(assign_stmt.expr)
+            self.emit(f'set_field({target}, {field!r}, {value})')
+
+
+    def visit_while_stmt(self, while_stmt):
+        self.emit(f'while {self.condition(while_stmt.condition)}:')
+        self.emit_block(while_stmt.stmts)
+
+
+    def visit_for_stmt(self, for_stmt):
+        self.var_table.push_environment()
+        for_stmt.var_decl.accept(self)
+        self.emit(f'while {self.condition(for_stmt.condition)}:')
+        self.emit_block(for_stmt.stmts + [for_stmt.assign_stmt])
+        self.var_table.pop_environment()
+
+
+    def visit_if_stmt(self, if_stmt):
+        self.emit(f'if {self.condition(if_stmt.if_part.condition)}:')
+        self.emit_block(if_stmt.if_part.stmts)
+        for else_if in if_stmt.else_ifs:
+            self.emit(f'elif {self.condition(else_if.condition)}:')
+            self.emit_block(else_if.stmts)
+        if if_stmt.else_stmts:
+            self.emit('else:')
+            self.emit_block(if_stmt.else_stmts)
+
+
+    def visit_call_expr(self, call_expr):
+        fun_name = call_expr.fun_name.lexeme
+        args = ', '.join(self.code(arg) for arg in call_expr.args)
+        if fun_name in BUILT_INS:
+            self.curr_code = f'{BUILT_INS[fun_name]}({args})'
+        else:
+            self.curr_code = f'mypl_{fun_name}({args})'
+
+
+    def visit_expr(self, expr):
+        code = self.code(expr.first)
+        if expr.not_op:
+            code = f'not_op({code})'
+        if expr.op:
+            rest = self.code(expr.rest)
+            op = expr.op.token_type
+            if op in PY_OPS:
+                code = f'({code} {PY_OPS[op]} {rest})'
+            else:
+                code = f'{HELPER_OPS[op]}({code}, {rest})'
+        self.curr_code = code
+
+
+    def visit_data_type(self, data_type):
+        # nothing to do here
+        pass
+
+
+    def visit_var_def(self, var_def):
+        # nothing to do here
+        pass
+
+
+    def visit_simple_term(self, simple_term):
+        simple_term.rvalue.accept(self)
+
+
+    def visit_complex_term(self, complex_term):
+        complex_term.expr.accept(self)
+
+
+    def visit_simple_rvalue(self, simple_rvalue):
+        val = simple_rvalue.value.lexeme
+        if simple_rvalue.value.token_type == TokenType.INT_VAL:
+            self.curr_code = repr(int(val))
+        elif simple_rvalue.value.token_type == TokenType.DOUBLE_VAL:
+            self.curr_code = repr(float(val))
+        elif simple_rvalue.value.token_type == TokenType.STRING_VAL:
+            val = val.replace('\\n', '\n')
+            val = val.replace('\\t', '\t')
+            self.curr_code = repr(val)
+        elif val == 'true':
+            self.curr_code = 'True'
+        elif val == 'false':
+            self.curr_code = 'False'
+        elif val == 'null':
+            self.curr_code = 'None'
+
+
+    def visit_new_rvalue(self, new_rvalue):
+        if new_rvalue.array_expr:
+            self.curr_code = f'new_array({self.code(new_rvalue.array_expr)})'
+        else:
+            args = ', '.join(self.code(p) for p in new_rvalue.struct_params)
+            self.curr_code = f'struct_{new_rvalue.type_name.lexeme}({args})'
+
+
+    def visit_var_rvalue(self, var_rvalue):
+        code = self.var_name(var_rvalue.path[0].var_name.lexeme)
+        if var_rvalue.path[0].array_expr:
+            code = f'get_index({code}, {self.code(var_rvalue.path[0].array_expr)})'
+        for var_ref in var_rvalue.path[1:]:
+            code = f'deref({code}).{self.field_name(var_ref.var_name.lexeme)}'
+            if var_ref.array_expr:
+                code = f'get_index({code}, {self.code(var_ref.array_expr)})'
+        self.curr_code = code
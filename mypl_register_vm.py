@@ -0,0 +1,852 @@
+"""Register-based execution backend for the MyPL VM.
+
+The stack bytecode of each frame template is translated into three-address
+register instructions that read and write the frame's variables directly.
+The translator simulates the operand stack symbolically: LOAD and PUSH
+only remember which register holds the value, and each operator reads its
+operands from those registers and writes its result to a temporary (or,
+when the next instruction is a STORE, straight into the variable). The
+register file of a frame holds the function's variables, then its
+constants, then the temporaries that replace operand stack slots.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any
+from mypl_error import *
+from mypl_opcode import *
+from mypl_frame import *
+from mypl_fusion import FusionPass, JUMP_OPCODES
+from mypl_threaded import ThreadedVM, SWITCH, HALT
+from mypl_vm import Array
+
+
+# register instruction opcodes, where d is the destination register, a, b
+# and c are source registers, and t is an instruction offset
+RegOpCode = Enum('RegOpCode', [
+
+    # moves and operators
+    'MOV',     # (d, a): d = a
+    'ADD',     # (d, a, b): d = a + b
+    'SUB',     # (d, a, b): d = a - b
+    'MUL',     # (d, a, b): d = a * b
+    'LT',      # (d, a, b): d = a < b
+    'LE',      # (d, a, b): d = a <= b
+    'EQ',      # (d, a, b): d = a == b
+    'NE',      # (d, a, b): d = a != b
+    'ADDL',    # (a, b): a = a + b, appending to a in place
+
+    # jump and branch
+    'JMP',     # t: jump to t
+    'JMPF',    # (a, t): if a is False jump to t
+    'LTJF',    # (a, b, t): if not (a < b) jump to t
+    'LEJF',    # (a, b, t): if not (a <= b) jump to t
+    'EQJF',    # (a, b, t): if not (a == b) jump to t
+    'NEJF',    # (a, b, t): if not (a != b) jump to t
+
+    # functions
+    'CALL',    # (d, f, (a, ...)): d = f(a, ...)
+    'RET',     # a: return a
+    'TCALL',   # (f, (a, ...)): return f(a, ...) in place of this call
+
+    # heap
+    'GETF',    # (d, a, f): d = obj(a)[f]
+    'SETF',    # (a, f, b): obj(a)[f] = b
+    'GETI',    # (d, a, b): d = obj(a)[b]
+    'SETI',    # (a, b, c): obj(a)[b] = c
+
+    # any other stack instruction, run by its VM handler on the values
+    # of the source registers (p is the stack instruction's pc, for errors)
+    'STACKOP', # (d, opcode, operand, (a, ...), p): d = opcode(a, ...)
+])
+
+# register instructions whose first operand is the destination register
+DEST_OPCODES = [RegOpCode.MOV, RegOpCode.ADD, RegOpCode.SUB, RegOpCode.MUL,
+                RegOpCode.LT, RegOpCode.LE, RegOpCode.EQ, RegOpCode.NE,
+                RegOpCode.CALL, RegOpCode.GETF, RegOpCode.GETI,
+                RegOpCode.STACKOP]
+
+# stack operators with a three-address form
+BINARY_OPS = {OpCode.ADD: RegOpCode.ADD, OpCode.SUB: RegOpCode.SUB,
+              OpCode.MUL: RegOpCode.MUL, OpCode.CMPLT: RegOpCode.LT,
+              OpCode.CMPLE: RegOpCode.LE, OpCode.CMPEQ: RegOpCode.EQ,
+              OpCode.CMPNE: RegOpCode.NE}
+
+# comparison (or fused compare-and-branch) -> register compare-and-branch
+COMPARE_JUMPS = {OpCode.CMPLT: RegOpCode.LTJF, OpCode.CMPLE: RegOpCode.LEJF,
+                 OpCode.CMPEQ: RegOpCode.EQJF, OpCode.CMPNE: RegOpCode.NEJF,
+                 OpCode.CMPLTJF: RegOpCode.LTJF,
+                 OpCode.CMPLEJF: RegOpCode.LEJF,
+                 OpCode.CMPEQJF: RegOpCode.EQJF,
+                 OpCode.CMPNEJF: RegOpCode.NEJF}
+
+# stack instructions run as STACKOP -> (values popped, values pushed)
+STACK_EFFECTS = {OpCode.DIV: (2, 1), OpCode.AND: (2, 1), OpCode.OR: (2, 1),
+                 OpCode.NOT: (1, 1), OpCode.WRITE: (1, 0),
+                 OpCode.READ: (0, 1), OpCode.READA: (0, 1),
+                 OpCode.READN: (1, 1), OpCode.EOF: (0, 1),
+                 OpCode.LEN: (1, 1),
+                 OpCode.GETC: (2, 1), OpCode.TOINT: (1, 1),
+                 OpCode.TODBL: (1, 1), OpCode.TOSTR: (1, 1),
+                 OpCode.ALLOCS: (0, 1), OpCode.ALLOCA: (1, 1)}
+
+# stack instructions that only move values between the operand stack and
+# variables or constants (and so disappear in register code)
+STACK_TRAFFIC = [OpCode.PUSH, OpCode.POP, OpCode.LOAD, OpCode.STORE,
+                 OpCode.DUP, OpCode.SWAP, OpCode.NOP]
+
+
+@dataclass
+class RegisterTemplate:
+    """The register code of a frame template."""
+    function_name: str
+    arg_count: int
+    instructions: list[VMInstr] = field(default_factory=list)
+    # initial register file: variables, constants, then temporaries
+    registers: list[Any] = field(default_factory=list)
+    # number of stack instructions the code was translated from
+    stack_size: int = 0
+    # frames of finished calls, recycled by CALL (the frame template's own
+    # free list holds stack frames)
+    free_frames: list[VMFrame] = field(default_factory=list, repr=False,
+                                       compare=False)
+
+    def free_frame(self, frame):
+        """Recycle the frame of a call that returned, resetting it to the
+        initial register file in place. At most FRAME_POOL_SIZE frames are
+        kept.
+
+        """
+        if len(self.free_frames) < FRAME_POOL_SIZE:
+            frame.variables[:] = self.registers
+            self.free_frames.append(frame)
+
+
+class RegisterTranslator:
+    """Translates the stack code of frame templates into register code."""
+
+    def __init__(self, frame_templates):
+        """Create a translator for the given frame templates.
+
+        Args:
+            frame_templates -- The VM's function name -> VMFrameTemplate
+                               mapping (used for the argument count of
+                               called functions).
+
+        """
+        self.frame_templates = frame_templates
+        # state of the template being translated
+        self.instrs = []             # register instructions so far
+        self.stack = []              # registers of the operand stack values
+        self.block_start = 0         # index of the current block's first instr
+        self.temp_base = 0           # first temporary register
+        self.temp_count = 0          # number of temporaries used
+        self.constants = {}          # (type, value) -> register
+        self.name = ''
+
+
+    def error(self, msg, pc):
+        """Raise a VMError for an untranslatable instruction."""
+        raise VMError(f'cannot translate {self.name} at {pc}: {msg}')
+
+
+    def translate(self, template):
+        """Returns the RegisterTemplate for the given frame template.
+
+        The operand stack is empty at every jump and jump target in code
+        from the code generator (apart from unused call results, which are
+        dropped), so the symbolic stack starts over at each jump target.
+
+        Args:
+            template -- The VMFrameTemplate to translate.
+
+        """
+        stack_instrs = template.instructions
+        self.name = template.function_name
+        self.instrs = []
+        self.block_start = 0
+        self.constants = {}
+        targets = set()
+        for instr in stack_instrs:
+            if instr.opcode in JUMP_OPCODES:
+                targets.add(instr.operand)
+        scratch = FusionPass().scratch_slots(stack_instrs)
+
+        # registers: variables, then constants, then temporaries
+        registers = [None] * template.arg_count
+        for instr in stack_instrs:
+            addr = None
+            if instr.opcode in [OpCode.LOAD, OpCode.STORE, OpCode.ADDL]:
+                addr = instr.operand
+            elif instr.opcode in [OpCode.INCL, OpCode.LOADF]:
+                addr = instr.operand[0]
+            if addr is not None and addr not in scratch:
+                while len(registers) <= addr:
+                    registers.append(None)
+        for instr in stack_instrs:
+            if instr.opcode == OpCode.PUSH:
+                self.constant(registers, instr.operand)
+            elif instr.opcode == OpCode.INCL:
+                self.constant(registers, instr.operand[1])
+        self.temp_base = len(registers)
+        self.temp_count = 0
+
+        # the arguments arrive in the parameter registers, the last one on
+        # top of the stack
+        self.stack = list(range(template.arg_count))
+        new_index = {}
+        i = 0
+        while i < len(stack_instrs):
+            if i in targets:
+                self.stack = []
+                self.block_start = len(self.instrs)
+            new_index[i] = len(self.instrs)
+            i += self.translate_instr(stack_instrs, i, targets, scratch)
+        new_index[len(stack_instrs)] = len(self.instrs)
+
+        # remap jump offsets to the register code
+        for instr in self.instrs:
+            if instr.opcode == RegOpCode.JMP:
+                instr.operand = new_index[instr.operand]
+            elif instr.opcode in [RegOpCode.JMPF, RegOpCode.LTJF,
+                                  RegOpCode.LEJF, RegOpCode.EQJF,
+                                  RegOpCode.NEJF]:
+                *srcs, offset = instr.operand
+                instr.operand = (*srcs, new_index[offset])
+        registers += [None] * self.temp_count
+        return RegisterTemplate(template.function_name, template.arg_count,
+                                self.instrs, registers, len(stack_instrs))
+
+
+    def constant(self, registers, value):
+        """Returns the register holding the given constant, adding it to
+        the register file if needed.
+
+        """
+        # keyed by type too, since 1, 1.0 and True are equal
+        key = (type(value), value)
+        if key not in self.constants:
+            self.constants[key] = len(registers)
+            registers.append(value)
+        return self.constants[key]
+
+
+    #----------------------------------------------------------------------
+    # Symbolic operand stack
+    #----------------------------------------------------------------------
+
+    def emit(self, opcode, operand=None):
+        self.instrs.append(VMInstr(opcode, operand))
+
+
+    def pop(self, pc):
+        """Pop the register of the top stack value."""
+        if not self.stack:
+            self.error('operand stack underflow', pc)
+        return self.stack.pop()
+
+
+    def temp(self, exclude=None):
+        """Returns a temporary register not used by any stack value (nor
+        the excluded register).
+
+        """
+        reg = self.temp_base
+        while reg in self.stack or reg == exclude:
+            reg += 1
+        self.temp_count = max(self.temp_count, reg - self.temp_base + 1)
+        return reg
+
+
+    def push_result(self, opcode, *srcs):
+        """Emit an instruction writing to a new temporary and push it."""
+        dest = self.temp()
+        self.emit(opcode, (dest, *srcs))
+        self.stack.append(dest)
+
+
+    def preserve(self, addr, exclude=None):
+        """Copy stack values still reading variable addr into a temporary
+        before addr is overwritten.
+
+        """
+        if addr in self.stack:
+            dest = self.temp(exclude)
+            self.emit(RegOpCode.MOV, (dest, addr))
+            self.stack = [dest if r == addr else r for r in self.stack]
+
+
+    def store(self, addr, pc):
+        """Store the top stack value in variable addr."""
+        src = self.pop(pc)
+        last = self.instrs[-1] if len(self.instrs) > self.block_start else None
+        if last and last.opcode in DEST_OPCODES and last.operand[0] == src \
+           and src >= self.temp_base and src not in self.stack \
+           and addr not in self.stack:
+            # write the result straight into the variable instead
+            last.operand = (addr, *last.operand[1:])
+        elif src != addr:
+            self.preserve(addr, src)
+            self.emit(RegOpCode.MOV, (addr, src))
+
+
+    #----------------------------------------------------------------------
+    # Instructions
+    #----------------------------------------------------------------------
+
+    def translate_instr(self, instrs, i, targets, scratch):
+        """Translate the stack instruction at index i and return the number
+        of stack instructions consumed.
+
+        """
+        instr = instrs[i]
+        opcode = instr.opcode
+        operand = instr.operand
+        following = [x.opcode for x in instrs[i+1:i+4]]
+
+        if opcode == OpCode.PUSH:
+            self.stack.append(self.constants[(type(operand), operand)])
+
+        elif opcode == OpCode.POP:
+            self.pop(i)
+
+        elif opcode == OpCode.LOAD:
+            self.stack.append(operand)
+
+        elif opcode == OpCode.STORE:
+            # STORE a; STORE b; LOAD a; LOAD b on scratch slots only swaps
+            # the top two values
+            addrs = [x.operand for x in instrs[i:i+4]]
+            if operand in scratch and addrs[2:] == addrs[:2] and \
+               following == [OpCode.STORE, OpCode.LOAD, OpCode.LOAD]:
+                x = self.pop(i)
+                y = self.pop(i)
+                self.stack += [x, y]
+                return 4
+            self.store(operand, i)
+
+        elif opcode in BINARY_OPS:
+            x = self.pop(i)
+            y = self.pop(i)
+            if opcode in COMPARE_JUMPS and following[:1] == [OpCode.JMPF] \
+               and i + 1 not in targets:
+                offset = instrs[i+1].operand
+                self.emit(COMPARE_JUMPS[opcode], (y, x, offset))
+                return 2
+            self.push_result(BINARY_OPS[opcode], y, x)
+
+        elif opcode == OpCode.JMP:
+            self.emit(RegOpCode.JMP, operand)
+
+        elif opcode == OpCode.JMPF:
+            self.emit(RegOpCode.JMPF, (self.pop(i), operand))
+
+        elif opcode in COMPARE_JUMPS:
+            x = self.pop(i)
+            y = self.pop(i)
+            self.emit(COMPARE_JUMPS[opcode], (y, x, operand))
+
+        elif opcode == OpCode.CALL:
+            if operand not in self.frame_templates:
+                self.error(f'call to undefined function {operand}', i)
+            arg_count = self.frame_templates[operand].arg_count
+            if len(self.stack) < arg_count:
+                self.error('operand stack underflow', i)
+            args = self.stack[len(self.stack)-arg_count:]
+            del self.stack[len(self.stack)-arg_count:]
+            self.push_result(RegOpCode.CALL, operand, tuple(args))
+
+        elif opcode == OpCode.TCALL:
+            if operand not in self.frame_templates:
+                self.error(f'call to undefined function {operand}', i)
+            arg_count = self.frame_templates[operand].arg_count
+            if len(self.stack) < arg_count:
+                self.error('operand stack underflow', i)
+            args = self.stack[len(self.stack)-arg_count:]
+            del self.stack[len(self.stack)-arg_count:]
+            self.emit(RegOpCode.TCALL, (operand, tuple(args)))
+            # stands in for the result read by the (unreachable) RET
+            self.stack.append(self.temp())
+
+        elif opcode == OpCode.RET:
+            self.emit(RegOpCode.RET, self.pop(i))
+
+        elif opcode == OpCode.GETF:
+            self.push_result(RegOpCode.GETF, self.pop(i), operand)
+
+        elif opcode == OpCode.SETF:
+            value = self.pop(i)
+            obj = self.pop(i)
+            self.emit(RegOpCode.SETF, (obj, operand, value))
+
+        elif opcode == OpCode.GETI:
+            index = self.pop(i)
+            obj = self.pop(i)
+            self.push_result(RegOpCode.GETI, obj, index)
+
+        elif opcode == OpCode.SETI:
+            value = self.pop(i)
+            index = self.pop(i)
+            obj = self.pop(i)
+            self.emit(RegOpCode.SETI, (obj, index, value))
+
+        elif opcode == OpCode.DUP:
+            if not self.stack:
+                self.error('operand stack underflow', i)
+            self.stack.append(self.stack[-1])
+
+        elif opcode == OpCode.NOP:
+            pass
+
+        elif opcode == OpCode.SWAP:
+            x = self.pop(i)
+            y = self.pop(i)
+            self.stack += [x, y]
+
+        elif opcode == OpCode.ADDL:
+            x = self.pop(i)
+            self.preserve(operand, x)
+            self.emit(RegOpCode.ADDL, (operand, x))
+
+        elif opcode == OpCode.INCL:
+            addr, value = operand
+            self.preserve(addr)
+            const = self.constants[(type(value), value)]
+            self.emit(RegOpCode.ADD, (addr, addr, const))
+
+        elif opcode == OpCode.LOADF:
+            addr, field_name = operand
+            self.push_result(RegOpCode.GETF, addr, field_name)
+
+        elif opcode in STACK_EFFECTS:
+            pops, pushes = STACK_EFFECTS[opcode]
+            if len(self.stack) < pops:
+                self.error('operand stack underflow', i)
+            srcs = tuple(self.stack[len(self.stack)-pops:])
+            del self.stack[len(self.stack)-pops:]
+            if pushes:
+                self.push_result(RegOpCode.STACKOP, opcode, operand, srcs, i)
+            else:
+                self.emit(RegOpCode.STACKOP, (None, opcode, operand, srcs, i))
+
+        else:
+            self.error(f'unsupported instruction {opcode}', i)
+        return 1
+
+
+class RegisterVM(ThreadedVM):
+    """A VM that translates the stack code into register code and runs it
+    as threaded code.
+
+    """
+
+    def __init__(self, limits=None):
+        """Creates a register VM."""
+        super().__init__(limits)
+        self.register_templates = {} # function name -> RegisterTemplate
+
+
+    def __repr__(self):
+        """Returns a string representation of the register code."""
+        self.translate()
+        s = ''
+        for name, template in self.register_templates.items():
+            s += f'\nFrame {name} ({len(template.registers)} registers)\n'
+            for pc, instr in enumerate(template.instructions):
+                s += f'  {pc}: {instr}\n'
+        return s
+
+
+    def new_frame(self, template):
+        """Returns a new frame whose variables are the function's initial
+        register file.
+
+        """
+        registers = self.register_templates[template.function_name].registers
+        return VMFrame(template, variables=list(registers))
+
+
+    def release_frames(self):
+        """Drop the recycled stack and register frames."""
+        super().release_frames()
+        for template in self.register_templates.values():
+            template.free_frames.clear()
+
+
+    def translate(self):
+        """Translate every frame template into register code."""
+        translator = RegisterTranslator(self.frame_templates)
+        for name, template in self.frame_templates.items():
+            self.register_templates[name] = translator.translate(template)
+
+
+    def stats(self):
+        """Returns a table comparing the size of the stack code and the
+        register code of each function, including the stack instructions
+        that only move values (PUSH, POP, LOAD, STORE, DUP, SWAP, NOP).
+
+        """
+        self.translate()
+        s = f'{"FUNCTION":<24}{"STACK":>8}{"MOVES":>8}{"REGISTER":>10}{"MOVS":>6}\n'
+        totals = [0, 0, 0, 0]
+        for name, template in self.register_templates.items():
+            stack_instrs = self.frame_templates[name].instructions
+            row = [len(stack_instrs),
+                   sum(1 for x in stack_instrs if x.opcode in STACK_TRAFFIC),
+                   len(template.instructions),
+                   sum(1 for x in template.instructions
+                       if x.opcode == RegOpCode.MOV)]
+            totals = [t + r for t, r in zip(totals, row)]
+            s += f'{name:<24}{row[0]:>8}{row[1]:>8}{row[2]:>10}{row[3]:>6}\n'
+        s += f'{"(total)":<24}{totals[0]:>8}{totals[1]:>8}{totals[2]:>10}{totals[3]:>6}\n'
+        return s
+
+
+    #----------------------------------------------------------------------
+    # COMPILER
+    #----------------------------------------------------------------------
+
+    def compile(self):
+        """Translate every frame template into register code and compile
+        the register code into threaded code.
+
+        """
+        self.translate()
+        for name, template in self.register_templates.items():
+            code = []
+            for pc, instr in enumerate(template.instructions):
+                code.append(self.compile_register_instr(instr, pc + 1,
+                                                        template))
+            code.append(self.compile_end())
+            self.compiled[name] = code
+
+
+    def compile_register_instr(self, instr, nxt, template):
+        """Returns the closure that executes the given register instruction.
+        Closures take the (unused) operand stack and the register file.
+
+        Args:
+            instr -- The register VMInstr to compile.
+            nxt -- The pc of the instruction that follows it.
+            template -- The RegisterTemplate the instruction belongs to.
+
+        """
+        opcode = instr.opcode
+        operand = instr.operand
+        error = self.error
+        none_msg = "operands cant be None during operator use"
+
+        #------------------------------------------------------------
+        # Moves and Operators
+        #------------------------------------------------------------
+
+        if opcode == RegOpCode.MOV:
+            d, a = operand
+            def mov(stack, regs):
+                regs[d] = regs[a]
+                return nxt
+            return mov
+
+        elif opcode == RegOpCode.ADD:
+            d, a, b = operand
+            def add(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                result = y + x
+                if type(x) == int or type(y) == int:
+                    result = int(result)
+                regs[d] = result
+                return nxt
+            return add
+
+        elif opcode == RegOpCode.ADDL:
+            a, b = operand
+            def addl(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                # in place, see VM.op_addl
+                regs[a] = None
+                y += x
+                regs[a] = y
+                return nxt
+            return addl
+
+        elif opcode == RegOpCode.SUB:
+            d, a, b = operand
+            def sub(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                result = y - x
+                if type(x) == int or type(y) == int:
+                    result = int(result)
+                regs[d] = result
+                return nxt
+            return sub
+
+        elif opcode == RegOpCode.MUL:
+            d, a, b = operand
+            def mul(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                result = y * x
+                if type(x) == int or type(y) == int:
+                    result = int(result)
+                regs[d] = result
+                return nxt
+            return mul
+
+        elif opcode == RegOpCode.LT:
+            d, a, b = operand
+            def lt(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                regs[d] = y < x
+                return nxt
+            return lt
+
+        elif opcode == RegOpCode.LE:
+            d, a, b = operand
+            def le(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                regs[d] = y <= x
+                return nxt
+            return le
+
+        elif opcode == RegOpCode.EQ:
+            d, a, b = operand
+            def eq(stack, regs):
+                regs[d] = regs[a] == regs[b]
+                return nxt
+            return eq
+
+        elif opcode == RegOpCode.NE:
+            d, a, b = operand
+            def ne(stack, regs):
+                regs[d] = regs[a] != regs[b]
+                return nxt
+            return ne
+
+        #------------------------------------------------------------
+        # Branching
+        #------------------------------------------------------------
+
+        elif opcode == RegOpCode.JMP:
+            def jmp(stack, regs):
+                return operand
+            return jmp
+
+        elif opcode == RegOpCode.JMPF:
+            a, t = operand
+            def jmpf(stack, regs):
+                if regs[a] == False:
+                    return t
+                return nxt
+            return jmpf
+
+        elif opcode == RegOpCode.LTJF:
+            a, b, t = operand
+            def ltjf(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                if not y < x:
+                    return t
+                return nxt
+            return ltjf
+
+        elif opcode == RegOpCode.LEJF:
+            a, b, t = operand
+            def lejf(stack, regs):
+                x = regs[b]
+                y = regs[a]
+                if x == None or y == None:
+                    error(none_msg, None)
+                if not y <= x:
+                    return t
+                return nxt
+            return lejf
+
+        elif opcode == RegOpCode.EQJF:
+            a, b, t = operand
+            def eqjf(stack, regs):
+                if regs[a] != regs[b]:
+                    return t
+                return nxt
+            return eqjf
+
+        elif opcode == RegOpCode.NEJF:
+            a, b, t = operand
+            def nejf(stack, regs):
+                if regs[a] == regs[b]:
+                    return t
+                return nxt
+            return nejf
+
+        #------------------------------------------------------------
+        # Functions
+        #------------------------------------------------------------
+
+        elif opcode == RegOpCode.CALL:
+            # the caller's (otherwise unused) operand stack remembers the
+            # register that receives the return value
+            d, fun_name, args = operand
+            call_stack = self.call_stack
+            callee = self.frame_templates[fun_name]
+            registers = self.register_templates[fun_name].registers
+            free_frames = self.register_templates[fun_name].free_frames
+            def call(stack, regs):
+                call_stack[-1].pc = nxt
+                stack.append(d)
+                if free_frames:
+                    new_frame = free_frames.pop()
+                    new_frame.pc = 0
+                    new_regs = new_frame.variables
+                else:
+                    new_regs = list(registers)
+                    new_frame = VMFrame(callee, 0, new_regs, [])
+                for i, a in enumerate(args):
+                    new_regs[i] = regs[a]
+                call_stack.append(new_frame)
+                return SWITCH
+            return call
+
+        elif opcode == RegOpCode.TCALL:
+            fun_name, args = operand
+            if fun_name == template.function_name:
+                # self tail call: new arguments, same frame
+                def tcall(stack, regs):
+                    values = [regs[a] for a in args]
+                    regs[:len(values)] = values
+                    return 0
+                return tcall
+            call_stack = self.call_stack
+            callee = self.frame_templates[fun_name]
+            registers = self.register_templates[fun_name].registers
+            callee_free_frames = self.register_templates[fun_name].free_frames
+            free_frame = template.free_frame
+            def tcall(stack, regs):
+                if callee_free_frames:
+                    new_frame = callee_free_frames.pop()
+                    new_frame.pc = 0
+                    new_regs = new_frame.variables
+                else:
+                    new_regs = list(registers)
+                    new_frame = VMFrame(callee, 0, new_regs, [])
+                for i, a in enumerate(args):
+                    new_regs[i] = regs[a]
+                free_frame(call_stack[-1])
+                call_stack[-1] = new_frame
+                return SWITCH
+            return tcall
+
+        elif opcode == RegOpCode.RET:
+            call_stack = self.call_stack
+            free_frame = template.free_frame
+            def ret(stack, regs):
+                return_val = regs[operand]
+                free_frame(call_stack.pop())
+                if call_stack:
+                    caller = call_stack[-1]
+                    caller.variables[caller.operand_stack.pop()] = return_val
+                    return SWITCH
+                return HALT
+            return ret
+
+        #------------------------------------------------------------
+        # Heap
+        #------------------------------------------------------------
+
+        elif opcode == RegOpCode.GETF:
+            d, a, field_name = operand
+            def getf(stack, regs):
+                struct_obj = regs[a]
+                if struct_obj == None:
+                    error("struct access can't have None type")
+                regs[d] = struct_obj[field_name]
+                return nxt
+            return getf
+
+        elif opcode == RegOpCode.SETF:
+            a, field_name, b = operand
+            def setf(stack, regs):
+                struct_obj = regs[a]
+                if struct_obj == None:
+                    error("struct access can't have None type")
+                struct_obj[field_name] = regs[b]
+                return nxt
+            return setf
+
+        elif opcode == RegOpCode.GETI:
+            d, a, b = operand
+            def geti(stack, regs):
+                index = regs[b]
+                array_obj = regs[a]
+                if index == None or array_obj == None:
+                    error("array access can't have None type")
+                elif index < 0 or index >= len(array_obj):
+                    error(f"Invalid index for array access, index = {index}")
+                if type(array_obj) is Array:
+                    regs[d] = array_obj[index]
+                else:
+                    regs[d] = array_obj.get(index)
+                return nxt
+            return geti
+
+        elif opcode == RegOpCode.SETI:
+            a, b, c = operand
+            def seti(stack, regs):
+                value = regs[c]
+                index = regs[b]
+                array_obj = regs[a]
+                if index == None or array_obj == None:
+                    error(f"array access can't have None type, value={value}, index={index}")
+                elif index < 0 or index >= len(array_obj):
+                    error(f"Invalid index for array access {value} {index}")
+                if type(array_obj) is Array:
+                    array_obj[index] = value
+                else:
+                    array_obj.put(index, value)
+                return nxt
+            return seti
+
+        #------------------------------------------------------------
+        # Stack instructions without a register form
+        #------------------------------------------------------------
+
+        elif opcode == RegOpCode.STACKOP:
+            d, stack_opcode, stack_operand, srcs, stack_pc = operand
+            handler = self.handlers[stack_opcode.value]
+            call_stack = self.call_stack
+            def stackop(stack, regs):
+                frame = call_stack[-1]
+                # the handler reports errors at the stack instruction
+                # before the frame's pc (as in the stack VM), and CALL sets
+                # the pc again before it is used as a register pc
+                frame.pc = stack_pc + 1
+                for a in srcs:
+                    stack.append(regs[a])
+                handler(frame, stack_operand)
+                if d is not None:
+                    regs[d] = stack.pop()
+                return nxt
+            return stackop
+
+        self.error(f'unsupported register instruction {opcode}')
@@ -14,7 +14,7 @@ from mypl_symbol_table import SymbolTable
 
 BASE_TYPES = ['int', 'double', 'bool', 'string']
 BUILT_INS = ['print', 'input', 'itos', 'itod', 'dtos', 'dtoi', 'stoi', 'stod',
-             'length', 'get']
+             'length', 'get', 'input_all', 'input_n', 'input_eof']
 
 class SemanticChecker(Visitor):
     """Visitor implementation to semantically check MyPL programs."""
@@ -435,6 +435,25 @@ class SemanticChecker(Visitor):
                 self.error("input() has no arguments", None)
             self.curr_type = DataType(False, Token(TokenType.STRING_TYPE, 'string', call_expr.fun_name.line, call_expr.fun_name.column))
 
+        elif fun_name == 'input_all':
+            if len(args) != 0:
+                self.error("input_all() has no arguments", None)
+            self.curr_type = DataType(True, Token(TokenType.STRING_TYPE, 'string', call_expr.fun_name.line, call_expr.fun_name.column))
+
+        elif fun_name == 'input_n':
+            if len(args) != 1:
+                self.error("input_n must have 1 argument", None)
+            for arg in args:
+                arg.accept(self)
+                if self.curr_type.type_name.token_type != TokenType.INT_TYPE or self.curr_type.is_array:
+                    self.error(f"input_n must have integer input, type = {self.curr_type.type_name}", None)
+            self.curr_type = DataType(True, Token(TokenType.STRING_TYPE, 'string', call_expr.fun_name.line, call_expr.fun_name.column))
+
+        elif fun_name == 'input_eof':
+            if len(args) != 0:
+                self.error("input_eof() has no arguments", None)
+            self.curr_type = DataType(False, Token(TokenType.BOOL_TYPE, 'bool', call_expr.fun_name.line, call_expr.fun_name.column))
+
         elif fun_name == 'itos':
             if len(args) != 1:
                 self.error("itos must have 1 argument", None)
@@ -0,0 +1,461 @@
+"""Closure-threaded execution backend for the MyPL VM.
+
+Each frame template is compiled once into a list of Python closures, one
+per instruction, with the instruction's operand (and its jump target or
+next pc) already bound. A closure takes the current operand stack and
+variables and returns the pc of the next instruction, so the run loop
+keeps pc, the operand stack and the variables in local variables and
+only touches the frame when a CALL or RET switches frames.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+from mypl_error import *
+from mypl_opcode import *
+from mypl_frame import *
+from mypl_vm import VM, Array
+
+
+# pc values returned by closures that leave the current frame
+SWITCH = -1                      # continue in the frame on top of call_stack
+HALT = -2                        # the program is finished
+
+
+class ThreadedVM(VM):
+    """A VM that executes closure-threaded code instead of decoding
+    instructions.
+
+    """
+
+    def __init__(self, limits=None):
+        """Creates a threaded VM."""
+        super().__init__(limits)
+        self.compiled = {}           # function name -> list of closures
+
+
+    def run(self, debug=False, dispatch='table', trace=None):
+        """Run the virtual machine on the threaded code.
+
+        Args:
+            debug -- If true, fall back to the (printing) table-driven
+                     run loop.
+            dispatch -- The dispatch mode of the VM run loop, used only
+                        when falling back to it (see VM.run).
+            trace -- If given, fall back to the tracing table-driven run
+                     loop (see VM.run).
+
+        A VM with limits, heap statistics or a checkpointer also falls
+        back to the table-driven run loop, which enforces, keeps and saves
+        them, as does a VM being sampled (threaded code does not keep the
+        pc of the current frame).
+
+        """
+        if debug or trace is not None or self.limits is not None or \
+           self.heap_stats is not None or self.checkpointer is not None or \
+           self.sampler is not None:
+            super().run(debug=debug, dispatch=dispatch, trace=trace)
+            return
+        if not 'main' in self.frame_templates:
+            self.error('No "main" functrion')
+        self.link()
+        self.compile()
+        frame = self.new_frame(self.frame_templates['main'])
+        self.call_stack.append(frame)
+
+        compiled = self.compiled
+        call_stack = self.call_stack
+        pc = SWITCH
+        try:
+            while pc != HALT:
+                frame = call_stack[-1]
+                code = compiled[frame.template.function_name]
+                stack = frame.operand_stack
+                variables = frame.variables
+                pc = frame.pc
+                while pc >= 0:
+                    pc = code[pc](stack, variables)
+        finally:
+            self.output.flush()
+
+
+    def new_frame(self, template):
+        """Returns a new frame for a call to the given template."""
+        return template.new_frame()
+
+
+    #----------------------------------------------------------------------
+    # COMPILER
+    #----------------------------------------------------------------------
+
+    def compile(self):
+        """Compile every frame template into threaded code. Like a linked
+        instruction stream, each list ends with a closure that stops the
+        program if pc runs past the last instruction.
+
+        """
+        for name, template in self.frame_templates.items():
+            code = []
+            for pc, instr in enumerate(template.instructions):
+                code.append(self.compile_instr(instr, pc + 1))
+            code.append(self.compile_end())
+            self.compiled[name] = code
+
+
+    def compile_end(self):
+        """Returns the closure run when pc falls off the end of a frame."""
+        def end(stack, variables):
+            return HALT
+        return end
+
+
+    def compile_instr(self, instr, nxt):
+        """Returns the closure that executes the given instruction.
+
+        Args:
+            instr -- The VMInstr to compile.
+            nxt -- The pc of the instruction that follows it.
+
+        """
+        opcode = instr.opcode
+        operand = instr.operand
+        error = self.error
+        none_msg = "operands cant be None during operator use"
+
+        #------------------------------------------------------------
+        # Literals and Variables
+        #------------------------------------------------------------
+
+        if opcode == OpCode.PUSH:
+            def push(stack, variables):
+                stack.append(operand)
+                return nxt
+            return push
+
+        elif opcode == OpCode.POP:
+            def pop(stack, variables):
+                stack.pop()
+                return nxt
+            return pop
+
+        elif opcode == OpCode.STORE:
+            def store(stack, variables):
+                variables[operand] = stack.pop()
+                return nxt
+            return store
+
+        elif opcode == OpCode.LOAD:
+            def load(stack, variables):
+                stack.append(variables[operand])
+                return nxt
+            return load
+
+        elif opcode == OpCode.ADDL:
+            def addl(stack, variables):
+                x = stack.pop()
+                y = variables[operand]
+                if x == None or y == None:
+                    error(none_msg, None)
+                # in place, see VM.op_addl
+                variables[operand] = None
+                y += x
+                variables[operand] = y
+                return nxt
+            return addl
+
+        #------------------------------------------------------------
+        # Operations
+        #------------------------------------------------------------
+
+        elif opcode == OpCode.ADD:
+            def add(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                result = y + x
+                if type(x) == int or type(y) == int:
+                    result = int(result)
+                stack.append(result)
+                return nxt
+            return add
+
+        elif opcode == OpCode.SUB:
+            def sub(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                result = y - x
+                if type(x) == int or type(y) == int:
+                    result = int(result)
+                stack.append(result)
+                return nxt
+            return sub
+
+        elif opcode == OpCode.MUL:
+            def mul(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                result = y * x
+                if type(x) == int or type(y) == int:
+                    result = int(result)
+                stack.append(result)
+                return nxt
+            return mul
+
+        elif opcode == OpCode.CMPLT:
+            def cmplt(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                stack.append(y < x)
+                return nxt
+            return cmplt
+
+        elif opcode == OpCode.CMPLE:
+            def cmple(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                stack.append(y <= x)
+                return nxt
+            return cmple
+
+        elif opcode == OpCode.CMPEQ:
+            def cmpeq(stack, variables):
+                x = stack.pop()
+                stack.append(stack.pop() == x)
+                return nxt
+            return cmpeq
+
+        elif opcode == OpCode.CMPNE:
+            def cmpne(stack, variables):
+                x = stack.pop()
+                stack.append(stack.pop() != x)
+                return nxt
+            return cmpne
+
+        #------------------------------------------------------------
+        # Branching
+        #------------------------------------------------------------
+
+        elif opcode == OpCode.JMP:
+            def jmp(stack, variables):
+                return operand
+            return jmp
+
+        elif opcode == OpCode.JMPF:
+            def jmpf(stack, variables):
+                if stack.pop() == False:
+                    return operand
+                return nxt
+            return jmpf
+
+        #------------------------------------------------------------
+        # Functions
+        #------------------------------------------------------------
+
+        elif opcode == OpCode.CALL:
+            call_stack = self.call_stack
+            template = self.frame_templates[operand]
+            arg_count = template.arg_count
+            def call(stack, variables):
+                call_stack[-1].pc = nxt
+                new_frame = template.new_frame()
+                call_stack.append(new_frame)
+                i = len(stack) - arg_count
+                new_frame.operand_stack[:] = stack[i:]
+                del stack[i:]
+                return SWITCH
+            return call
+
+        elif opcode == OpCode.TCALL:
+            call_stack = self.call_stack
+            template = self.frame_templates[operand]
+            arg_count = template.arg_count
+            def tcall(stack, variables):
+                frame = call_stack[-1]
+                i = len(stack) - arg_count
+                if template is frame.template:
+                    del stack[:i]
+                    return 0
+                new_frame = template.new_frame()
+                new_frame.operand_stack[:] = stack[i:]
+                call_stack[-1] = new_frame
+                frame.template.free_frame(frame)
+                return SWITCH
+            return tcall
+
+        elif opcode == OpCode.RET:
+            call_stack = self.call_stack
+            def ret(stack, variables):
+                return_val = stack.pop()
+                frame = call_stack.pop()
+                frame.template.free_frame(frame)
+                if call_stack:
+                    call_stack[-1].operand_stack.append(return_val)
+                    return SWITCH
+                return HALT
+            return ret
+
+        #------------------------------------------------------------
+        # Heap
+        #------------------------------------------------------------
+
+        elif opcode == OpCode.GETF:
+            def getf(stack, variables):
+                struct_obj = stack.pop()
+                if struct_obj == None:
+                    error("struct access can't have None type")
+                stack.append(struct_obj[operand])
+                return nxt
+            return getf
+
+        elif opcode == OpCode.SETF:
+            def setf(stack, variables):
+                value = stack.pop()
+                struct_obj = stack.pop()
+                if struct_obj == None:
+                    error("struct access can't have None type")
+                struct_obj[operand] = value
+                return nxt
+            return setf
+
+        elif opcode == OpCode.GETI:
+            def geti(stack, variables):
+                index = stack.pop()
+                array_obj = stack.pop()
+                if index == None or array_obj == None:
+                    error("array access can't have None type")
+                elif index < 0 or index >= len(array_obj):
+                    error(f"Invalid index for array access, index = {index}")
+                if type(array_obj) is Array:
+                    stack.append(array_obj[index])
+                else:
+                    stack.append(array_obj.get(index))
+                return nxt
+            return geti
+
+        elif opcode == OpCode.SETI:
+            def seti(stack, variables):
+                value = stack.pop()
+                index = stack.pop()
+                array_obj = stack.pop()
+                if index == None or array_obj == None:
+                    error(f"array access can't have None type, value={value}, index={index}")
+                elif index < 0 or index >= len(array_obj):
+                    error(f"Invalid index for array access {value} {index}")
+                if type(array_obj) is Array:
+                    array_obj[index] = value
+                else:
+                    array_obj.put(index, value)
+                return nxt
+            return seti
+
+        #------------------------------------------------------------
+        # Special
+        #------------------------------------------------------------
+
+        elif opcode == OpCode.DUP:
+            def dup(stack, variables):
+                stack.append(stack[-1])
+                return nxt
+            return dup
+
+        elif opcode == OpCode.NOP:
+            def nop(stack, variables):
+                return nxt
+            return nop
+
+        #------------------------------------------------------------
+        # Superinstructions
+        #------------------------------------------------------------
+
+        elif opcode == OpCode.SWAP:
+            def swap(stack, variables):
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+                return nxt
+            return swap
+
+        elif opcode == OpCode.INCL:
+            mem_addr, x = operand
+            int_operand = type(x) == int
+            def incl(stack, variables):
+                y = variables[mem_addr]
+                if y == None:
+                    error(none_msg, None)
+                result = y + x
+                if int_operand or type(y) == int:
+                    result = int(result)
+                variables[mem_addr] = result
+                return nxt
+            return incl
+
+        elif opcode == OpCode.LOADF:
+            mem_addr, field = operand
+            def loadf(stack, variables):
+                struct_obj = variables[mem_addr]
+                if struct_obj == None:
+                    error("struct access can't have None type")
+                stack.append(struct_obj[field])
+                return nxt
+            return loadf
+
+        elif opcode == OpCode.CMPLTJF:
+            def cmpltjf(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                if not y < x:
+                    return operand
+                return nxt
+            return cmpltjf
+
+        elif opcode == OpCode.CMPLEJF:
+            def cmplejf(stack, variables):
+                x = stack.pop()
+                y = stack.pop()
+                if x == None or y == None:
+                    error(none_msg, None)
+                if not y <= x:
+                    return operand
+                return nxt
+            return cmplejf
+
+        elif opcode == OpCode.CMPEQJF:
+            def cmpeqjf(stack, variables):
+                x = stack.pop()
+                if stack.pop() != x:
+                    return operand
+                return nxt
+            return cmpeqjf
+
+        elif opcode == OpCode.CMPNEJF:
+            def cmpnejf(stack, variables):
+                x = stack.pop()
+                if stack.pop() == x:
+                    return operand
+                return nxt
+            return cmpnejf
+
+        # everything else runs through its table handler on the current
+        # frame, switching frames if the handler moved to another one
+        handler = self.handlers[opcode.value]
+        call_stack = self.call_stack
+        def instr(stack, variables):
+            frame = call_stack[-1]
+            frame.pc = nxt
+            next_frame = handler(frame, operand)
+            if next_frame is None:
+                return HALT
+            if next_frame is frame and frame.pc == nxt:
+                return nxt
+            return SWITCH
+        return instr
@@ -0,0 +1,66 @@
+"""Execution trace records for the instrumented MyPL VM run loop.
+
+NAME: Cody Kesselring
+DATE: Spring 2024
+
+"""
+
+import array
+import json
+from dataclasses import dataclass
+from typing import Any
+from mypl_frame import VMInstr
+
+
+def trace_value(value):
+    """Returns a JSON-compatible stand-in for a value: heap objects
+    (structs and arrays, which are lists and array.arrays, see
+    mypl_vm.Struct) become their type, id and length, since they can be
+    large or cyclic, and other values are returned as is.
+
+    """
+    if isinstance(value, (list, array.array)):
+        return {'object': type(value).__name__, 'id': id(value),
+                'length': len(value)}
+    return value
+
+
+@dataclass(slots=True)
+class TraceRecord:
+    """The VM state just before an instruction executes."""
+    function: str              # name of the function being executed
+    depth: int                 # number of frames on the call stack
+    pc: int                    # index of the instruction
+    instr: VMInstr             # the instruction
+    stack_top: Any = None      # top of the operand stack (if not empty)
+    stack_size: int = 0        # number of values on the operand stack
+
+    def to_dict(self):
+        """Returns the record as a JSON-compatible dictionary."""
+        return {'function': self.function, 'depth': self.depth,
+                'pc': self.pc, 'opcode': self.instr.opcode.name,
+                'operand': self.instr.operand,
+                'stack_top': trace_value(self.stack_top),
+                'stack_size': self.stack_size}
+
+
+class TraceWriter:
+    """A trace callback that writes each record to a file as one line of
+    JSON.
+
+    """
+
+    def __init__(self, out_stream):
+        """Create a trace writer.
+
+        Args:
+            out_stream -- The (text) file to write the records to.
+
+        """
+        self.write = out_stream.write
+        self.encoder = json.JSONEncoder(default=str)
+
+
+    def __call__(self, record):
+        """Write a single trace record."""
+        self.write(self.encoder.encode(record.to_dict()) + '\n')
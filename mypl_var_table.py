@@ -12,6 +12,8 @@ class VarTable:
         """Create an empty var table"""
         self.environments = []
         self.total_vars = 0
+        # variable name -> DataType, per environment
+        self.data_types = []
         
         
     def __len__(self):
@@ -27,6 +29,7 @@ class VarTable:
     def push_environment(self):
         """Add a new environment to the symbol table."""
         self.environments.append([])
+        self.data_types.append({})
 
         
     def pop_environment(self):
@@ -36,17 +39,20 @@ class VarTable:
         if self.environments:
             self.total_vars -= len(self.environments[-1])
             self.environments.pop()
+            self.data_types.pop()
 
             
-    def add(self, var_name):
+    def add(self, var_name, data_type=None):
         """Add a variable to the table in the current environment.
         
         Args: 
             var_name -- The variable name to add.
+            data_type -- The declared DataType of the variable (optional).
 
         """
         if self.environments:
             self.environments[-1].append(var_name)
+            self.data_types[-1][var_name] = data_type
             self.total_vars += 1
             
             
@@ -65,4 +71,18 @@ class VarTable:
                 return num_remaining + self.environments[-i].index(var_name)
         return None
 
+
+    def get_type(self, var_name):
+        """Returns the declared DataType of the variable if it is in the
+        table. Returns None if the variable name is not in the table.
+
+        Args:
+            var_name -- The variable to lookup in the table.
+
+        """
+        for data_types in reversed(self.data_types):
+            if var_name in data_types:
+                return data_types[var_name]
+        return None
+
     
@@ -5,20 +5,355 @@ DATE: Spring 2024
 
 """
 
+import array
+import codecs
+import gc
+import io
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
 from mypl_error import *
 from mypl_opcode import *
 from mypl_frame import *
+from mypl_trace import *
+
+
+@dataclass
+class Limits:
+    """Execution budget of a VM run, where None means no limit."""
+    max_instructions: int = None  # instructions executed
+    max_time: float = None        # seconds of wall-clock time
+    max_depth: int = None         # frames on the call stack
+    max_heap: int = None          # structs and arrays live at once
+    # instructions run between checks of the instruction and time limits
+    check_interval: int = 10000
+
+
+class Struct(list):
+    """A struct object on the heap: its field values, in the order the
+    fields are declared (GETF and SETF operands are slot indexes). Objects
+    are passed around as direct references and compare by identity.
+
+    """
+    __slots__ = ()
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+
+class Array(list):
+    """An array object on the heap, compared by identity."""
+    __slots__ = ()
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+
+class TypedArray(array.array):
+    """Base of the arrays of int, double and bool values, which are kept
+    unboxed in a contiguous buffer. Elements are null until set. A slot
+    holding the class's NULL value is null, or holds a value the buffer
+    cannot (such as an int too big for 64 bits), kept in extra by index.
+    Element access goes through get and put.
+
+    """
+    __slots__ = ('extra',)
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+    TYPECODE = None
+    NULL = None
+    NULL_BYTES = b''   # the buffer of a single null slot
+
+    def __new__(cls, length):
+        self = super().__new__(cls, cls.TYPECODE)
+        self.frombytes(cls.NULL_BYTES * length)
+        self.extra = {}
+        return self
+
+    def put_extra(self, index, value):
+        """Store a value the buffer cannot hold."""
+        self[index] = self.NULL
+        if value is None:
+            self.extra.pop(index, None)
+        else:
+            self.extra[index] = value
+
+
+class IntArray(TypedArray):
+    """An array int of 64-bit slots."""
+    __slots__ = ()
+    TYPECODE = 'q'
+    NULL = -2**63
+    NULL_BYTES = array.array('q', [NULL]).tobytes()
+
+    def get(self, index):
+        value = self[index]
+        if value == -2**63:
+            return self.extra.get(index)
+        return value
+
+    def put(self, index, value):
+        if type(value) is int and -2**63 < value < 2**63:
+            self[index] = value
+        else:
+            self.put_extra(index, value)
+
+
+class DoubleArray(TypedArray):
+    """An array double of 64-bit floating point slots."""
+    __slots__ = ()
+    TYPECODE = 'd'
+    NULL = float('nan')
+    NULL_BYTES = array.array('d', [NULL]).tobytes()
+
+    def get(self, index):
+        value = self[index]
+        if value != value:
+            return self.extra.get(index)
+        return value
+
+    def put(self, index, value):
+        if type(value) is float and value == value:
+            self[index] = value
+        else:
+            self.put_extra(index, value)
+
+
+class BoolArray(TypedArray):
+    """An array bool of one-byte slots."""
+    __slots__ = ()
+    TYPECODE = 'b'
+    NULL = -1
+    NULL_BYTES = array.array('b', [NULL]).tobytes()
+
+    def get(self, index):
+        value = self[index]
+        if value < 0:
+            return self.extra.get(index)
+        return value == 1
+
+    def put(self, index, value):
+        if type(value) is bool:
+            self[index] = value
+        else:
+            self.put_extra(index, value)
+
+
+# array element type -> unboxed array class (other arrays are Arrays)
+TYPED_ARRAYS = {'int': IntArray, 'double': DoubleArray, 'bool': BoolArray}
+
+
+# characters of WRITE output buffered before it is passed on to the sink
+DEFAULT_OUTPUT_SIZE = 8192
+
+
+class OutputBuffer:
+    """The WRITE output of a VM, collected and passed on to a sink in
+    chunks: once size characters are waiting, before a READ from standard
+    input, and when a run ends or stops.
+
+    """
+
+    def __init__(self, sink=None, size=DEFAULT_OUTPUT_SIZE):
+        """Create an empty output buffer.
+
+        Args:
+            sink -- Where the output goes: a text stream, a binary stream
+                    (io.BufferedIOBase, given UTF-8 bytes) or a callable
+                    given each chunk of text. By default the output is
+                    written to sys.stdout (as it is when flushed).
+            size -- The characters to buffer before flushing.
+
+        """
+        self.sink = sink
+        self.size = size
+        self.parts = []      # text written since the last flush
+        self.pending = 0     # characters in parts
+        if sink is None:
+            self.emit = self.write_stdout
+        elif isinstance(sink, io.BufferedIOBase):
+            self.emit = self.write_binary
+        elif hasattr(sink, 'write'):
+            self.emit = sink.write
+        else:
+            self.emit = sink
+
+
+    def write(self, text):
+        """Buffer the given text, flushing once size is reached."""
+        self.parts.append(text)
+        self.pending += len(text)
+        if self.pending >= self.size:
+            self.flush()
+
+
+    def flush(self):
+        """Pass the buffered text on to the sink."""
+        if self.parts:
+            text = ''.join(self.parts)
+            self.parts.clear()
+            self.pending = 0
+            self.emit(text)
+
+
+    def write_stdout(self, text):
+        sys.stdout.write(text)
+
+
+    def write_binary(self, text):
+        self.sink.write(text.encode('utf-8'))
+
+
+# bytes of standard input read at a time
+DEFAULT_INPUT_SIZE = 65536
+
+
+class InputBuffer:
+    """The lines read by READ and the other input built-ins, read from a
+    source a block at a time instead of a line at a time.
+
+    """
+
+    def __init__(self, source=None, size=DEFAULT_INPUT_SIZE):
+        """Create an empty input buffer.
+
+        Args:
+            source -- The text stream to read. By default sys.stdin (as it
+                      is when first read). A stream with a binary buffer
+                      (such as sys.stdin or an open file) is read size
+                      bytes at a time, other streams with readline.
+            size -- The bytes to read at a time.
+
+        """
+        self.source = source
+        self.size = size
+        self.lines = deque()   # lines read but not yet taken
+        self.partial = ''      # text read after the last newline
+        self.ended = False     # true once the source is used up
+        self.decoder = None    # incremental decoder of a binary buffer
+
+
+    def fill(self):
+        """Read the next block of the source into lines. Returns false
+        (after adding an unterminated last line) once the source is used
+        up.
+
+        """
+        if self.ended:
+            return False
+        # as input does, so a prompt shows before waiting for a line
+        sys.stdout.flush()
+        source = self.source if self.source is not None else sys.stdin
+        raw = getattr(source, 'buffer', None)
+        if hasattr(raw, 'read1'):
+            # takes whatever is available (up to size), so reading a
+            # terminal or an interactive pipe does not wait for a block
+            if self.decoder is None:
+                encoding = getattr(source, 'encoding', None) or 'utf-8'
+                errors = getattr(source, 'errors', None) or 'strict'
+                self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+            data = raw.read1(self.size)
+            text = self.decoder.decode(data, not data)
+        else:
+            text = data = source.readline()
+        if not data:
+            self.ended = True
+            text = self.partial + text
+            self.partial = ''
+            if text:
+                self.lines.append(text)
+            return False
+        text = self.partial + text
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+        lines = text.split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+        return True
+
+
+    def waiting(self, count=1):
+        """Returns true if taking count more lines has to read the
+        source.
+
+        """
+        return len(self.lines) < count and not self.ended
+
+
+    def readline(self):
+        """Returns the next line (without its newline), raising EOFError
+        at the end of the input (as input does).
+
+        """
+        while not self.lines and self.fill():
+            pass
+        if not self.lines:
+            raise EOFError
+        return self.lines.popleft()
+
+
+    def readlines(self, count=None):
+        """Returns a list of the next count lines, or of all the
+        remaining lines if count is None (fewer at the end of the input).
+
+        """
+        lines = self.lines
+        if count is None:
+            while self.fill():
+                pass
+            taken = list(lines)
+            lines.clear()
+            return taken
+        while len(lines) < count and self.fill():
+            pass
+        return [lines.popleft() for i in range(min(count, len(lines)))]
+
+
+    def at_end(self):
+        """Returns true if there are no more lines."""
+        while not self.lines and self.fill():
+            pass
+        return not self.lines
+
+
+# result of VM.resume
+RunStatus = Enum('RunStatus', [
+    'FINISHED',  # the program ended
+    'YIELDED',   # ran the given number of instructions
+    'BLOCKED',   # a READ is waiting for input (see VM.feed_input)
+])
 
 
 class VM:
 
-    def __init__(self):
-        """Creates a VM."""
-        self.struct_heap = {}        # id -> dict
-        self.array_heap = {}         # id -> list
-        self.next_obj_id = 2024      # next available object id (int)
+    def __init__(self, limits=None):
+        """Creates a VM.
+
+        Args:
+            limits -- The Limits to enforce while running (optional).
+
+        """
+        self.allocated = 0           # objects allocated since the last census
+        self.heap_stats = None       # HeapStats recording allocations
+        self.checkpointer = None     # Checkpointer saving snapshots of runs
+        self.sampler = None          # SamplingProfiler reading frame pcs
         self.frame_templates = {}    # function name -> VMFrameTemplate
         self.call_stack = []         # function call stack
+        self.handlers = self.build_handlers()  # OpCode value -> handler
+        self.limits = limits
+        self.executed = 0            # instructions run (by run_limited or resume)
+        # state of a resumable run (see start and resume)
+        self.frame = None            # frame to continue with
+        self.step_handlers = None    # handler table of the run
+        self.input_lines = deque()   # lines for READ, from feed_input
+        self.input_closed = False    # true once close_input is called
+        self.blocked_frame = None    # frame of a READ waiting for input
+        self.output = OutputBuffer()  # where WRITE output goes
+        self.input = InputBuffer()    # where READ input comes from
+        self.elapsed = 0.0           # seconds spent running
 
     
     def __repr__(self):
@@ -40,12 +375,40 @@ class VM:
         """
         self.frame_templates[template.function_name] = template
 
+
+    def link(self):
+        """Pre-decode every frame template into the flat instruction stream
+        executed by the table-driven run loop, with calls resolved to the
+        called template.
+
+        """
+        for template in self.frame_templates.values():
+            template.link(self.frame_templates)
+
+    
+    def release_frames(self):
+        """Drop the recycled frames of finished calls (see
+        VMFrameTemplate.free_frame).
+
+        """
+        for template in self.frame_templates.values():
+            template.free_frames.clear()
+
+
+    def collect(self):
+        """Release the recycled frames and run a full garbage collection.
+        Returns the number of unreachable objects found.
+
+        """
+        self.release_frames()
+        return gc.collect()
+
     
     def error(self, msg, frame=None):
         """Report a VM error."""
         if not frame:
             raise VMError(msg)
-        pc = frame.pc - 1
+        pc = max(frame.pc - 1, 0)
         instr = frame.template.instructions[pc]
         name = frame.template.function_name
         msg += f' (in {name} at {pc}: {instr})'
@@ -56,14 +419,338 @@ class VM:
     # RUN FUNCTION
     #----------------------------------------------------------------------
     
-    def run(self, debug=False):
-        """Run the virtual machine."""
+    def run(self, debug=False, dispatch='table', trace=None):
+        """Run the virtual machine. The run loop is picked once, so a run
+        without debugging or tracing pays nothing for either.
+
+        Args:
+            debug -- If true, print the VM state before each instruction.
+            dispatch -- 'table' to decode through the opcode handler table,
+                        or 'switch' to use the original if/elif chain.
+            trace -- A callable given a TraceRecord before each instruction
+                     executes, or a file to write the records to (as lines
+                     of JSON). Tracing always uses the table dispatch.
+
+        With limits, heap statistics (see mypl_heap.HeapStats) or
+        checkpoints (see mypl_checkpoint.Checkpointer), the table dispatch
+        is always used as well, and exceeding a limit raises a VMError.
+
+        """
 
         # grab the "main" function frame and instantiate it
         if not 'main' in self.frame_templates:
             self.error('No "main" functrion')
-        frame = VMFrame(self.frame_templates['main'])
+        self.link()
+        frame = self.frame_templates['main'].new_frame()
         self.call_stack.append(frame)
+        self.run_from(frame, debug, dispatch, trace)
+
+
+    def continue_run(self, debug=False, dispatch='table', trace=None):
+        """Run the program on from the top frame of the call stack, such as
+        the call stack of a run restored from a checkpoint (see
+        mypl_checkpoint.restore). Takes the same arguments as run.
+
+        """
+        if not self.call_stack:
+            self.error('no run to continue')
+        self.link()
+        self.run_from(self.call_stack[-1], debug, dispatch, trace)
+
+
+    def run_from(self, frame, debug=False, dispatch='table', trace=None):
+        """Pick the run loop for the arguments of run and run it from the
+        given frame (the top of the call stack). The buffered output is
+        flushed when the loop ends, even by an error.
+
+        """
+        try:
+            self.run_loop(frame, debug, dispatch, trace)
+        finally:
+            self.output.flush()
+
+
+    def run_loop(self, frame, debug, dispatch, trace):
+        """The body of run_from."""
+        if hasattr(trace, 'write'):
+            trace = TraceWriter(trace)
+        if trace is None and debug and dispatch == 'table':
+            trace = self.debug_trace
+
+        if trace is not None and self.limits is not None:
+            self.error('limits cannot be enforced while tracing')
+        if trace is not None and self.heap_stats is not None:
+            self.error('heap statistics cannot be kept while tracing')
+        if trace is not None and self.checkpointer is not None:
+            self.error('checkpoints cannot be saved while tracing')
+        if trace is not None:
+            self.run_traced(frame, trace)
+        elif self.limits is not None or self.heap_stats is not None or \
+             self.checkpointer is not None:
+            self.run_limited(frame)
+        elif dispatch == 'table':
+            self.run_table(frame)
+        elif dispatch == 'switch':
+            self.run_switch(frame, debug)
+        else:
+            self.error(f'unknown dispatch mode "{dispatch}"')
+
+
+    def debug_print(self, frame, instr):
+        """Print the VM state for the instruction about to be executed."""
+        self.output.flush()
+        print('\n')
+        print('\t FRAME.........:', frame.template.function_name)
+        print('\t PC............:', frame.pc)
+        print('\t INSTRUCTION...:', instr)
+        val = None if not frame.operand_stack else frame.operand_stack[-1]
+        print('\t NEXT OPERAND..:', val)
+        cs = self.call_stack
+        fun = cs[-1].template.function_name if cs else None
+        print('\t NEXT FUNCTION..:', fun)
+
+
+    def debug_trace(self, record):
+        """Print a trace record in the layout of debug_print."""
+        self.output.flush()
+        print('\n')
+        print('\t FRAME.........:', record.function)
+        print('\t PC............:', record.pc + 1)
+        print('\t INSTRUCTION...:', record.instr)
+        print('\t NEXT OPERAND..:', record.stack_top)
+        print('\t NEXT FUNCTION..:', record.function)
+
+
+    def run_table(self, frame):
+        """Run loop that dispatches each instruction through the handler
+        table. Every handler returns the frame to continue executing (or
+        None once the program is finished), so the cost of decoding an
+        instruction does not depend on its opcode. Instructions are read
+        from the linked opcode/operand tuples of the current template,
+        which are only re-fetched when the handler switches frames.
+
+        """
+        handlers = self.handlers
+        curr_frame = None
+        while frame is not None:
+            if frame is not curr_frame:
+                curr_frame = frame
+                opcodes = frame.template.opcodes
+                operands = frame.template.operands
+            pc = frame.pc
+            frame.pc = pc + 1
+            frame = handlers[opcodes[pc]](frame, operands[pc])
+
+
+    def run_steps(self, frame, count, handlers):
+        """The run loop of run_table, stopping after at most count
+        instructions. Returns the frame to continue with (None once the
+        program is finished) and the number of instructions run.
+
+        """
+        curr_frame = None
+        for executed in range(count):
+            if frame is None:
+                return None, executed
+            if frame is not curr_frame:
+                curr_frame = frame
+                opcodes = frame.template.opcodes
+                operands = frame.template.operands
+            pc = frame.pc
+            frame.pc = pc + 1
+            frame = handlers[opcodes[pc]](frame, operands[pc])
+        return frame, count
+
+
+    def run_limited(self, frame):
+        """Run loop that enforces the VM's limits. Instructions run in
+        batches of check_interval (see run_steps) with the instruction and
+        time limits checked in between, while the call depth and heap
+        limits are checked by the CALL and ALLOCS/ALLOCA handlers only.
+        Also used (without limits) to keep heap statistics and to save
+        checkpoints, with a batch ending early where the next checkpoint
+        is due.
+
+        """
+        limits = self.limits if self.limits is not None else Limits()
+        handlers = self.limited_handlers()
+        checkpointer = self.checkpointer
+        deadline = None
+        if limits.max_time is not None:
+            deadline = time.perf_counter() + limits.max_time
+        while frame is not None:
+            count = self.batch_size(limits.check_interval, frame)
+            if checkpointer is not None:
+                count = min(count, max(1, checkpointer.next_checkpoint
+                                          - self.executed))
+            frame, executed = self.run_steps(frame, count, handlers)
+            self.executed += executed
+            if deadline is not None and time.perf_counter() > deadline:
+                msg = f'time limit of {limits.max_time}s exceeded'
+                self.error(msg, frame)
+            if checkpointer is not None and frame is not None and \
+               self.executed >= checkpointer.next_checkpoint:
+                checkpointer.save(self)
+
+
+    def limited_handlers(self):
+        """Returns a copy of the handler table where CALL, ALLOCS and
+        ALLOCA check the call depth and heap limits (if set), and ALLOCS
+        and ALLOCA record heap statistics (if kept).
+
+        """
+        handlers = list(self.handlers)
+        limits = self.limits
+        if limits is not None and limits.max_depth is not None:
+            handlers[OpCode.CALL.value] = self.op_call_limited
+        if (limits is not None and limits.max_heap is not None) or \
+           self.heap_stats is not None:
+            handlers[OpCode.ALLOCS.value] = self.op_allocs_limited
+            handlers[OpCode.ALLOCA.value] = self.op_alloca_limited
+        return handlers
+
+
+    def batch_size(self, count, frame):
+        """Returns how many of the next count instructions can run without
+        going over the instruction limit, raising a VMError if none can.
+
+        """
+        if self.limits is None:
+            return count
+        max_instructions = self.limits.max_instructions
+        if max_instructions is not None:
+            count = min(count, max_instructions - self.executed)
+            if count <= 0:
+                msg = f'instruction limit of {max_instructions} exceeded'
+                self.error(msg, frame)
+        return count
+
+
+    #----------------------------------------------------------------------
+    # RESUMABLE EXECUTION
+    #----------------------------------------------------------------------
+
+    def start(self, write=None):
+        """Set up a run of the program that resume executes a slice at a
+        time. READ takes its lines from feed_input instead of standard
+        input.
+
+        Args:
+            write -- The sink of the run's output (see OutputBuffer,
+                     optional, by default standard output). The output is
+                     flushed to it whenever resume returns.
+
+        """
+        if not 'main' in self.frame_templates:
+            self.error('No "main" functrion')
+        self.link()
+        self.frame = self.frame_templates['main'].new_frame()
+        self.call_stack.append(self.frame)
+        self.step_handlers = self.limited_handlers()
+        self.step_handlers[OpCode.READ.value] = self.op_read_queued
+        self.step_handlers[OpCode.READA.value] = self.op_reada_queued
+        self.step_handlers[OpCode.READN.value] = self.op_readn_queued
+        self.step_handlers[OpCode.EOF.value] = self.op_eof_queued
+        if write is not None:
+            self.output = OutputBuffer(write)
+
+
+    def resume(self, max_steps):
+        """Continue the run set up by start for at most max_steps
+        instructions, and return the resulting RunStatus. The limits are
+        enforced as in run, except that the time limit counts only the time
+        spent inside resume. The buffered output is flushed before
+        returning.
+
+        Args:
+            max_steps -- The most instructions to run before yielding.
+
+        Raises a VMError if there is no run to continue, either because
+        start was not called or because the run already finished.
+
+        """
+        if self.frame is None:
+            self.error('no run to resume (start it first)')
+        try:
+            return self.resume_steps(max_steps)
+        finally:
+            self.output.flush()
+
+
+    def resume_steps(self, max_steps):
+        """The body of resume."""
+        limits = self.limits
+        frame = self.frame
+        while frame is not None and max_steps > 0:
+            count = max_steps
+            if limits is not None:
+                count = self.batch_size(min(count, limits.check_interval),
+                                        frame)
+            start_time = time.perf_counter()
+            frame, executed = self.run_steps(frame, count, self.step_handlers)
+            self.elapsed += time.perf_counter() - start_time
+            if self.blocked_frame is not None:
+                # the READ runs again once there is input
+                self.frame = self.blocked_frame
+                self.blocked_frame = None
+                self.executed += executed - 1
+                return RunStatus.BLOCKED
+            self.executed += executed
+            max_steps -= executed
+            if limits is not None and limits.max_time is not None and \
+               self.elapsed > limits.max_time:
+                msg = f'time limit of {limits.max_time}s exceeded'
+                self.error(msg, frame)
+        self.frame = frame
+        if frame is None:
+            return RunStatus.FINISHED
+        return RunStatus.YIELDED
+
+
+    def feed_input(self, line):
+        """Queue a line (without its newline) for READ in a resumable
+        run.
+
+        """
+        self.input_lines.append(line)
+
+
+    def close_input(self):
+        """Mark the end of the input of a resumable run, after which READ
+        gives null once the queued lines are used up.
+
+        """
+        self.input_closed = True
+
+
+    def run_traced(self, frame, trace):
+        """The run loop of run_table, instrumented to pass a TraceRecord
+        to the trace callable before each instruction.
+
+        """
+        handlers = self.handlers
+        call_stack = self.call_stack
+        curr_frame = None
+        while frame is not None:
+            if frame is not curr_frame:
+                curr_frame = frame
+                template = frame.template
+                opcodes = template.opcodes
+                operands = template.operands
+                instructions = template.instructions
+                stack = frame.operand_stack
+            pc = frame.pc
+            frame.pc = pc + 1
+            if pc < template.size:
+                stack_size = len(stack)
+                stack_top = stack[-1] if stack_size else None
+                trace(TraceRecord(template.function_name, len(call_stack), pc,
+                                  instructions[pc], stack_top, stack_size))
+            frame = handlers[opcodes[pc]](frame, operands[pc])
+
+
+    def run_switch(self, frame, debug=False):
+        """Run loop that decodes each instruction with an if/elif chain."""
 
         # run loop (continue until run out of call frames or instructions)
         while self.call_stack and frame.pc < len(frame.template.instructions):
@@ -73,15 +760,8 @@ class VM:
             frame.pc += 1
             # for debugging:
             if debug:
-                print('\n')
-                print('\t FRAME.........:', frame.template.function_name)
-                print('\t PC............:', frame.pc)
-                print('\t INSTRUCTION...:', instr)
-                val = None if not frame.operand_stack else frame.operand_stack[-1]
-                print('\t NEXT OPERAND..:', val)
-                cs = self.call_stack
-                fun = cs[-1].template.function_name if cs else None
-                print('\t NEXT FUNCTION..:', fun)
+                self.debug_print(frame, instr)
+
 
             #------------------------------------------------------------
             # Literals and Variables
@@ -98,13 +778,15 @@ class VM:
             elif instr.opcode == OpCode.STORE:
                 x = frame.operand_stack.pop()
                 mem_addr = instr.operand
-                while len(frame.variables) <= mem_addr:
-                    frame.variables.append(None)
                 frame.variables[mem_addr] = x
             
             elif instr.opcode == OpCode.LOAD:
                 mem_addr = instr.operand
                 frame.operand_stack.append(frame.variables[mem_addr])
+
+            elif instr.opcode == OpCode.ADDL:
+                # see op_addl
+                self.op_addl(frame, instr.operand)
                 
 
             
@@ -233,23 +915,21 @@ class VM:
             elif instr.opcode == OpCode.CALL:
                 fun_name = instr.operand
                 new_frame_template = self.frame_templates[fun_name]
-                new_frame = VMFrame(new_frame_template)
-                self.call_stack.append(new_frame)
-                i = new_frame_template.arg_count
-                while i > 0:
-                    arg = frame.operand_stack.pop()
-                    new_frame.operand_stack.append(arg)
-                    i -= 1
-                frame = new_frame
+                frame = self.op_call(frame, new_frame_template)
             
             elif instr.opcode == OpCode.RET:
                 return_val = frame.operand_stack.pop()
                 self.call_stack.pop()
+                frame.template.free_frame(frame)
                 if self.call_stack:
                     frame = self.call_stack[-1]
                     frame.operand_stack.append(return_val)
                 else:
                     return
+
+            elif instr.opcode == OpCode.TCALL:
+                new_frame_template = self.frame_templates[instr.operand]
+                frame = self.op_tcall(frame, new_frame_template)
                     
             #------------------------------------------------------------
             # Built-In Functions
@@ -267,19 +947,36 @@ class VM:
                         msg = "false"
                 else:
                     msg = str(msg)
-                print(msg, end='')
+                self.output.write(msg)
 
             elif instr.opcode == OpCode.READ:
-                x = input()
+                if self.input.waiting():
+                    self.output.flush()
+                x = self.input.readline()
                 frame.operand_stack.append(x)
 
+            elif instr.opcode == OpCode.READA:
+                self.output.flush()
+                frame.operand_stack.append(Array(self.input.readlines()))
+
+            elif instr.opcode == OpCode.READN:
+                x = frame.operand_stack.pop()
+                if x is None or x < 0:
+                    self.error(f'invalid number of lines to read: {x}', frame)
+                if self.input.waiting(x):
+                    self.output.flush()
+                frame.operand_stack.append(Array(self.input.readlines(x)))
+
+            elif instr.opcode == OpCode.EOF:
+                if self.input.waiting():
+                    self.output.flush()
+                frame.operand_stack.append(self.input.at_end())
+
             elif instr.opcode == OpCode.LEN:
                 x = frame.operand_stack.pop()
-                if x == self.next_obj_id -1:
-                    x = self.array_heap[x]
                 if x == None:
                     self.error("cant find length of nothing")
-                elif type(x) != str and type(x) != list:
+                elif type(x) != str and not isinstance(x, (Array, TypedArray)):
                     x = str(x)
                 length = len(x)
                 frame.operand_stack.append(length)
@@ -302,7 +999,6 @@ class VM:
                     frame.operand_stack.append(int_value)
                 except ValueError:
                     self.error("Value cannot be converted to int")
-                frame.operand_stack.append(int(x))
 
             elif instr.opcode == OpCode.TODBL:
                 x = frame.operand_stack.pop()
@@ -313,7 +1009,6 @@ class VM:
                     frame.operand_stack.append(float_value)
                 except ValueError:
                     self.error("Value cannot be converted to double")
-                frame.operand_stack.append(float(x))
 
             elif instr.opcode == OpCode.TOSTR:
                 x = frame.operand_stack.pop()
@@ -327,62 +1022,60 @@ class VM:
 
             # TODO: Fill in rest of ops
             elif instr.opcode == OpCode.ALLOCS:
-                oid = self.next_obj_id
-                self.next_obj_id += 1
-                struct_obj = {}
-                self.struct_heap[oid] = struct_obj
-                frame.operand_stack.append(oid)
+                struct_obj = Struct([None] * instr.operand)
+                frame.operand_stack.append(struct_obj)
 
             elif instr.opcode == OpCode.SETF:
                 value = frame.operand_stack.pop()
-                oid = frame.operand_stack.pop()
+                struct_obj = frame.operand_stack.pop()
                 field = instr.operand
-                if field == None or oid == None:
+                if field == None or struct_obj == None:
                     self.error("struct access can't have None type")
-                elif oid not in self.struct_heap:
-                    self.error("Invalid object ID for struct access")
-                self.struct_heap[oid][field] = value
+                struct_obj[field] = value
 
             elif instr.opcode == OpCode.GETF:
-                oid = frame.operand_stack.pop()
+                struct_obj = frame.operand_stack.pop()
                 field = instr.operand
-                if oid == None:
+                if struct_obj == None:
                     self.error("struct access can't have None type")
-                value = self.struct_heap[oid][field]
-                if oid not in self.struct_heap:
-                    self.error("Invalid object ID for struct access")
+                value = struct_obj[field]
                 frame.operand_stack.append(value)
 
             elif instr.opcode == OpCode.ALLOCA:
                 arr_len = frame.operand_stack.pop()
                 if arr_len is None or arr_len < 0:
                     self.error("Invalid size for array allocation")
-                array_obj = [None] * arr_len
-                oid = self.next_obj_id
-                self.next_obj_id += 1
-                self.array_heap[oid] = array_obj
-                frame.operand_stack.append(oid)
+                array_class = TYPED_ARRAYS.get(instr.operand)
+                if array_class is None:
+                    array_obj = Array([None] * arr_len)
+                else:
+                    array_obj = array_class(arr_len)
+                frame.operand_stack.append(array_obj)
             
             elif instr.opcode == OpCode.SETI:
                 value = frame.operand_stack.pop()
                 index = frame.operand_stack.pop()
-                oid = frame.operand_stack.pop()
-                if index == None or oid == None:
-                    self.error(f"array access can't have None type, value={value}, index={index}, oid={oid}")
-                elif oid not in self.array_heap or index < 0 or index >= len(self.array_heap[oid]):
-                    self.error(f"Invalid index or object ID for array access {value} {index} {oid} {len(self.array_heap[oid])}")
-                self.array_heap[oid][index] = value
+                array_obj = frame.operand_stack.pop()
+                if index == None or array_obj == None:
+                    self.error(f"array access can't have None type, value={value}, index={index}")
+                elif index < 0 or index >= len(array_obj):
+                    self.error(f"Invalid index for array access {value} {index} {len(array_obj)}")
+                if type(array_obj) is Array:
+                    array_obj[index] = value
+                else:
+                    array_obj.put(index, value)
             
             elif instr.opcode == OpCode.GETI:
                 index = frame.operand_stack.pop()
-                oid = frame.operand_stack.pop()
-                if index == None or oid == None:
+                array_obj = frame.operand_stack.pop()
+                if index == None or array_obj == None:
                     self.error("array access can't have None type")
-                elif oid not in self.array_heap:
-                    self.error(f"Invalid object ID for array access, oid = {oid}")
-                elif index < 0 or index >= len(self.array_heap[oid]):
+                elif index < 0 or index >= len(array_obj):
                     self.error(f"Invalid index for array access, index = {index}")
-                value = self.array_heap[oid][index]
+                if type(array_obj) is Array:
+                    value = array_obj[index]
+                else:
+                    value = array_obj.get(index)
                 frame.operand_stack.append(value)
             #------------------------------------------------------------
             # Special 
@@ -399,3 +1092,538 @@ class VM:
 
             else:
                 self.error(f'unsupported operation {instr}')
+
+
+    #----------------------------------------------------------------------
+    # OPCODE HANDLERS
+    #----------------------------------------------------------------------
+
+    def build_handlers(self):
+        """Returns the handler table, a list indexed by OpCode value where
+        each entry is the op_<name> method implementing that opcode.
+
+        """
+        handlers = [self.op_unsupported] * (len(OpCode) + 1)
+        handlers[END] = self.op_end
+        for opcode in OpCode:
+            handlers[opcode.value] = getattr(self, 'op_' + opcode.name.lower())
+        return handlers
+
+
+    def op_end(self, frame, operand):
+        # ran off the end of the instruction stream, which (as in the
+        # original run loop) ends the program
+        return None
+
+
+    def op_unsupported(self, frame, operand):
+        self.error('unsupported operation', frame)
+
+    #------------------------------------------------------------
+    # Literals and Variables
+    #------------------------------------------------------------
+
+    def op_push(self, frame, operand):
+        frame.operand_stack.append(operand)
+        return frame
+
+    def op_pop(self, frame, operand):
+        frame.operand_stack.pop()
+        return frame
+
+    def op_store(self, frame, operand):
+        frame.variables[operand] = frame.operand_stack.pop()
+        return frame
+
+    def op_load(self, frame, operand):
+        frame.operand_stack.append(frame.variables[operand])
+        return frame
+
+    def op_addl(self, frame, operand):
+        x = frame.operand_stack.pop()
+        variables = frame.variables
+        y = variables[operand]
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        # with the variable cleared, y is the string's only reference, so
+        # += appends to it in place instead of copying it. CPython only
+        # does that in specialized code, which a function called as often
+        # as this one gets (and run_switch does not, so it calls this).
+        variables[operand] = None
+        y += x
+        variables[operand] = y
+        return frame
+
+    #------------------------------------------------------------
+    # Operations
+    #------------------------------------------------------------
+
+    def op_add(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        result = y + x
+        if type(x) == int or type(y) == int:
+            result = int(result)
+        frame.operand_stack.append(result)
+        return frame
+
+    def op_sub(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        result = y - x
+        if type(x) == int or type(y) == int:
+            result = int(result)
+        frame.operand_stack.append(result)
+        return frame
+
+    def op_mul(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        result = y * x
+        if type(x) == int or type(y) == int:
+            result = int(result)
+        frame.operand_stack.append(result)
+        return frame
+
+    def op_div(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        elif x == 0:
+            self.error("can't divide by 0", None)
+        result = y / x
+        if type(x) == int or type(y) == int:
+            result = int(result)
+        frame.operand_stack.append(result)
+        return frame
+
+    def op_cmplt(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        frame.operand_stack.append(y < x)
+        return frame
+
+    def op_cmple(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        frame.operand_stack.append(y <= x)
+        return frame
+
+    def op_cmpeq(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        frame.operand_stack.append(y == x)
+        return frame
+
+    def op_cmpne(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        frame.operand_stack.append(y != x)
+        return frame
+
+    def op_and(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        frame.operand_stack.append(y and x)
+        return frame
+
+    def op_or(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        frame.operand_stack.append(y or x)
+        return frame
+
+    def op_not(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == None:
+            self.error("operands cant be None during operator use", None)
+        frame.operand_stack.append(not x)
+        return frame
+
+    #------------------------------------------------------------
+    # Branching
+    #------------------------------------------------------------
+
+    def op_jmp(self, frame, operand):
+        frame.pc = operand
+        return frame
+
+    def op_jmpf(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == False:
+            frame.pc = operand
+        return frame
+
+    #------------------------------------------------------------
+    # Functions
+    #------------------------------------------------------------
+
+    def op_call(self, frame, operand):
+        # operand is the called template (resolved by link), and the
+        # arguments move to the new frame in the order they were pushed
+        new_frame = operand.new_frame()
+        self.call_stack.append(new_frame)
+        stack = frame.operand_stack
+        i = len(stack) - operand.arg_count
+        new_frame.operand_stack[:] = stack[i:]
+        del stack[i:]
+        return new_frame
+
+    def op_ret(self, frame, operand):
+        return_val = frame.operand_stack.pop()
+        self.call_stack.pop()
+        frame.template.free_frame(frame)
+        if self.call_stack:
+            frame = self.call_stack[-1]
+            frame.operand_stack.append(return_val)
+            return frame
+        return None
+
+    def op_call_limited(self, frame, operand):
+        max_depth = self.limits.max_depth
+        if len(self.call_stack) >= max_depth:
+            self.error(f'call depth limit of {max_depth} exceeded', frame)
+        return self.op_call(frame, operand)
+
+    def op_tcall(self, frame, operand):
+        # a tail call to the same function restarts the current frame with
+        # only the arguments left on its stack, any other function gets a
+        # frame that replaces the current one
+        stack = frame.operand_stack
+        i = len(stack) - operand.arg_count
+        if operand is frame.template:
+            del stack[:i]
+            frame.pc = 0
+            return frame
+        new_frame = operand.new_frame()
+        new_frame.operand_stack[:] = stack[i:]
+        self.call_stack[-1] = new_frame
+        frame.template.free_frame(frame)
+        return new_frame
+
+    #------------------------------------------------------------
+    # Built-In Functions
+    #------------------------------------------------------------
+
+    def op_write(self, frame, operand):
+        msg = frame.operand_stack.pop()
+        if msg == None:
+            msg = "null"
+        elif isinstance(msg, bool):
+            msg = "true" if msg else "false"
+        else:
+            msg = str(msg)
+        self.output.write(msg)
+        return frame
+
+    def op_read(self, frame, operand):
+        # what was written so far (such as a prompt) comes out before
+        # waiting for input
+        if self.input.waiting():
+            self.output.flush()
+        frame.operand_stack.append(self.input.readline())
+        return frame
+
+    def op_reada(self, frame, operand):
+        self.output.flush()
+        frame.operand_stack.append(Array(self.input.readlines()))
+        return frame
+
+    def op_readn(self, frame, operand):
+        count = frame.operand_stack.pop()
+        if count is None or count < 0:
+            self.error(f'invalid number of lines to read: {count}', frame)
+        if self.input.waiting(count):
+            self.output.flush()
+        frame.operand_stack.append(Array(self.input.readlines(count)))
+        return frame
+
+    def op_eof(self, frame, operand):
+        if self.input.waiting():
+            self.output.flush()
+        frame.operand_stack.append(self.input.at_end())
+        return frame
+
+    def op_read_queued(self, frame, operand):
+        # READ of a resumable run: stop the run (by returning None) and
+        # back up to the READ when no line has been fed yet
+        if self.input_lines:
+            frame.operand_stack.append(self.input_lines.popleft())
+        elif self.input_closed:
+            frame.operand_stack.append(None)
+        else:
+            frame.pc -= 1
+            self.blocked_frame = frame
+            return None
+        return frame
+
+    def op_reada_queued(self, frame, operand):
+        # the rest of the input of a resumable run is there once it is
+        # closed
+        if not self.input_closed:
+            frame.pc -= 1
+            self.blocked_frame = frame
+            return None
+        frame.operand_stack.append(Array(self.input_lines))
+        self.input_lines.clear()
+        return frame
+
+    def op_readn_queued(self, frame, operand):
+        # the count stays on the stack while waiting for lines
+        count = frame.operand_stack[-1]
+        if count is None or count < 0:
+            self.error(f'invalid number of lines to read: {count}', frame)
+        lines = self.input_lines
+        if len(lines) < count and not self.input_closed:
+            frame.pc -= 1
+            self.blocked_frame = frame
+            return None
+        frame.operand_stack[-1] = Array(
+            [lines.popleft() for i in range(min(count, len(lines)))])
+        return frame
+
+    def op_eof_queued(self, frame, operand):
+        if not self.input_lines and not self.input_closed:
+            frame.pc -= 1
+            self.blocked_frame = frame
+            return None
+        frame.operand_stack.append(not self.input_lines)
+        return frame
+
+    def op_len(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == None:
+            self.error("cant find length of nothing")
+        elif type(x) != str and not isinstance(x, (Array, TypedArray)):
+            x = str(x)
+        frame.operand_stack.append(len(x))
+        return frame
+
+    def op_getc(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("string index error")
+        elif y > len(x)-1 or y<0:
+            self.error("string index error")
+        frame.operand_stack.append(x[y])
+        return frame
+
+    def op_toint(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == None:
+            self.error("None cant become int")
+        try:
+            frame.operand_stack.append(int(x))
+        except ValueError:
+            self.error("Value cannot be converted to int")
+        return frame
+
+    def op_todbl(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == None:
+            self.error("None cant become double")
+        try:
+            frame.operand_stack.append(float(x))
+        except ValueError:
+            self.error("Value cannot be converted to double")
+        return frame
+
+    def op_tostr(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == None:
+            self.error("None cant become string")
+        frame.operand_stack.append(str(x))
+        return frame
+
+    #------------------------------------------------------------
+    # Heap
+    #------------------------------------------------------------
+
+    def op_allocs(self, frame, operand):
+        frame.operand_stack.append(Struct([None] * operand))
+        return frame
+
+    def op_allocs_limited(self, frame, operand):
+        self.check_heap_limit(frame)
+        frame = self.op_allocs(frame, operand)
+        if self.heap_stats is not None:
+            self.heap_stats.record(self, frame)
+        return frame
+
+    def op_setf(self, frame, operand):
+        value = frame.operand_stack.pop()
+        struct_obj = frame.operand_stack.pop()
+        if operand == None or struct_obj == None:
+            self.error("struct access can't have None type")
+        struct_obj[operand] = value
+        return frame
+
+    def op_getf(self, frame, operand):
+        struct_obj = frame.operand_stack.pop()
+        if struct_obj == None:
+            self.error("struct access can't have None type")
+        frame.operand_stack.append(struct_obj[operand])
+        return frame
+
+    def op_alloca(self, frame, operand):
+        arr_len = frame.operand_stack.pop()
+        if arr_len is None or arr_len < 0:
+            self.error("Invalid size for array allocation")
+        array_class = TYPED_ARRAYS.get(operand)
+        if array_class is None:
+            frame.operand_stack.append(Array([None] * arr_len))
+        else:
+            frame.operand_stack.append(array_class(arr_len))
+        return frame
+
+    def op_alloca_limited(self, frame, operand):
+        self.check_heap_limit(frame)
+        frame = self.op_alloca(frame, operand)
+        if self.heap_stats is not None:
+            self.heap_stats.record(self, frame)
+        return frame
+
+    def check_heap_limit(self, frame):
+        if self.limits is None or self.limits.max_heap is None:
+            return
+        max_heap = self.limits.max_heap
+        if self.allocated >= max_heap:
+            # some of the objects counted may be garbage by now
+            self.allocated = self.count_live_objects()
+            if self.allocated >= max_heap:
+                self.error(f'heap limit of {max_heap} objects exceeded', frame)
+        self.allocated += 1
+
+    def count_live_objects(self):
+        """Returns the number of structs and arrays reachable from the
+        frames on the call stack.
+
+        """
+        seen = set()
+        pending = []
+        for frame in self.call_stack:
+            pending.extend(frame.variables)
+            pending.extend(frame.operand_stack)
+        while pending:
+            value = pending.pop()
+            if not isinstance(value, (Struct, Array, TypedArray)) or \
+               id(value) in seen:
+                continue
+            seen.add(id(value))
+            if not isinstance(value, TypedArray):
+                pending.extend(value)
+        return len(seen)
+
+    def op_seti(self, frame, operand):
+        value = frame.operand_stack.pop()
+        index = frame.operand_stack.pop()
+        array_obj = frame.operand_stack.pop()
+        if index == None or array_obj == None:
+            self.error(f"array access can't have None type, value={value}, index={index}")
+        elif index < 0 or index >= len(array_obj):
+            self.error(f"Invalid index for array access {value} {index}")
+        if type(array_obj) is Array:
+            array_obj[index] = value
+        else:
+            array_obj.put(index, value)
+        return frame
+
+    def op_geti(self, frame, operand):
+        index = frame.operand_stack.pop()
+        array_obj = frame.operand_stack.pop()
+        if index == None or array_obj == None:
+            self.error("array access can't have None type")
+        elif index < 0 or index >= len(array_obj):
+            self.error(f"Invalid index for array access, index = {index}")
+        if type(array_obj) is Array:
+            frame.operand_stack.append(array_obj[index])
+        else:
+            frame.operand_stack.append(array_obj.get(index))
+        return frame
+
+    #------------------------------------------------------------
+    # Special
+    #------------------------------------------------------------
+
+    def op_dup(self, frame, operand):
+        frame.operand_stack.append(frame.operand_stack[-1])
+        return frame
+
+    def op_nop(self, frame, operand):
+        return frame
+
+    #------------------------------------------------------------
+    # Superinstructions
+    #------------------------------------------------------------
+
+    def op_incl(self, frame, operand):
+        mem_addr, x = operand
+        y = frame.variables[mem_addr]
+        if y == None:
+            self.error("operands cant be None during operator use", None)
+        result = y + x
+        if type(x) == int or type(y) == int:
+            result = int(result)
+        frame.variables[mem_addr] = result
+        return frame
+
+    def op_loadf(self, frame, operand):
+        mem_addr, field = operand
+        struct_obj = frame.variables[mem_addr]
+        if struct_obj == None:
+            self.error("struct access can't have None type")
+        frame.operand_stack.append(struct_obj[field])
+        return frame
+
+    def op_swap(self, frame, operand):
+        stack = frame.operand_stack
+        stack[-1], stack[-2] = stack[-2], stack[-1]
+        return frame
+
+    def op_cmpltjf(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        if not y < x:
+            frame.pc = operand
+        return frame
+
+    def op_cmplejf(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("operands cant be None during operator use", None)
+        if not y <= x:
+            frame.pc = operand
+        return frame
+
+    def op_cmpeqjf(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if y != x:
+            frame.pc = operand
+        return frame
+
+    def op_cmpnejf(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if y == x:
+            frame.pc = operand
+        return frame
@@ -0,0 +1,1504 @@
+import pytest
+import asyncio
+import gc
+import io
+import json
+import glob
+import os
+import pickle
+import sys
+
+from mypl_error import *
+from mypl_iowrapper import *
+from mypl_token import *
+from mypl_lexer import *
+from mypl_ast_parser import *
+from mypl_semantic_checker import *
+from mypl_var_table import *
+from mypl_code_gen import *
+from mypl_vm import *
+from mypl_fusion import *
+from mypl_threaded import *
+from mypl_register_vm import *
+from mypl_py_gen import *
+from mypl_profile import *
+from mypl_batch import *
+from mypl_async import *
+from mypl_gc import *
+from mypl_heap import *
+from mypl_checkpoint import *
+
+
+#----------------------------------------------------------------------
+# Helper Functions
+#----------------------------------------------------------------------
+def build(program, vm_class=VM):
+    in_stream = FileWrapper(io.StringIO(program))
+    vm = vm_class()
+    cg = CodeGenerator(vm)
+    ast = ASTParser(Lexer(in_stream)).parse()
+    ast.accept(SemanticChecker())
+    ast.accept(cg)
+    return vm
+
+def build_python(program):
+    in_stream = FileWrapper(io.StringIO(program))
+    pygen = PythonGenerator()
+    ast = ASTParser(Lexer(in_stream)).parse()
+    ast.accept(SemanticChecker())
+    ast.accept(pygen)
+    return pygen
+
+def run_example(path, vm_class, capsys, monkeypatch):
+    monkeypatch.setattr('sys.stdin', io.StringIO('3\n5\n7\n'))
+    with open(path) as f:
+        program = f.read()
+    if vm_class == PythonGenerator:
+        vm = build_python(program)
+    else:
+        vm = build(program, vm_class)
+    try:
+        vm.run()
+    except MyPLError as ex:
+        print(ex)
+    return capsys.readouterr().out
+
+# exec-9-fib is left out since it takes too long
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'examples')
+EXAMPLES = [path for path in sorted(glob.glob(EXAMPLES_DIR + '/*.mypl'))
+            if not path.endswith('exec-9-fib.mypl')]
+
+FIB = (
+    'int fib(int x) {\n'
+    '  if (x <= 1) {\n'
+    '    return x;\n'
+    '  }\n'
+    '  return fib(x - 2) + fib(x - 1);\n'
+    '}\n'
+    'void main() {\n'
+    '  for (int i = 0; i < 10; i = i + 1) {\n'
+    '    print(fib(i));\n'
+    '    print(" ");\n'
+    '  }\n'
+    '}\n'
+)
+
+
+#----------------------------------------------------------------------
+# Dispatch
+#----------------------------------------------------------------------
+@pytest.mark.parametrize('dispatch', ['table', 'switch'])
+def test_dispatch_modes(capsys, dispatch):
+    build(FIB).run(dispatch=dispatch)
+    captured = capsys.readouterr()
+    assert captured.out == '0 1 1 2 3 5 8 13 21 34 '
+
+def test_bad_dispatch_mode():
+    with pytest.raises(MyPLError) as e:
+        build(FIB).run(dispatch='bogus')
+    assert str(e.value).startswith('VM Error:')
+
+@pytest.mark.parametrize('dispatch', ['table', 'switch'])
+def test_conversion_pushes_one_value(capsys, dispatch):
+    program = (
+        'void main() {\n'
+        '  print("x" + itos(stoi("23") + 1));\n'
+        '  print(" " + dtos(stod("3.25") + 0.25));\n'
+        '}\n'
+    )
+    build(program).run(dispatch=dispatch)
+    captured = capsys.readouterr()
+    assert captured.out == 'x24 3.5'
+
+
+#----------------------------------------------------------------------
+# Tracing
+#----------------------------------------------------------------------
+def test_trace_callback(capsys):
+    records = []
+    build(FIB).run(trace=records.append)
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    first = records[0]
+    assert (first.function, first.depth, first.pc) == ('main', 1, 0)
+    assert max(r.depth for r in records) > 2
+    writes = [r for r in records if r.instr.opcode == OpCode.WRITE]
+    assert [r.stack_top for r in writes][:2] == [0, ' ']
+    assert all(r.stack_size >= 1 for r in writes)
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM])
+def test_trace_file(capsys, vm_class):
+    out_stream = io.StringIO()
+    build(FIB, vm_class).run(trace=out_stream)
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    lines = out_stream.getvalue().splitlines()
+    records = [json.loads(line) for line in lines]
+    assert records[0]['function'] == 'main'
+    assert records[0]['opcode'] == 'PUSH'
+    assert {'depth', 'pc', 'operand', 'stack_top'} <= set(records[0])
+    assert records[-1]['opcode'] == 'RET'
+
+def test_trace_file_cyclic_struct(capsys):
+    program = (
+        'struct Node {int v; Node next;}\n'
+        'void main() {\n'
+        '  Node n = new Node(1, null);\n'
+        '  n.next = n;\n'
+        '  print(n.next.v);\n'
+        '}\n'
+    )
+    out_stream = io.StringIO()
+    build(program).run(trace=out_stream)
+    assert capsys.readouterr().out == '1'
+    records = [json.loads(line) for line in out_stream.getvalue().splitlines()]
+    tops = [r['stack_top'] for r in records if isinstance(r['stack_top'], dict)]
+    assert tops and all(top['object'] == 'Struct' and top['length'] == 2
+                        for top in tops)
+    assert len({top['id'] for top in tops}) == 1
+
+def test_debug_prints_trace(capsys):
+    build('void main() { print("hi"); }').run(debug=True)
+    out = capsys.readouterr().out
+    assert 'INSTRUCTION...: OpCode.WRITE()' in out
+    assert 'hi' in out
+
+
+#----------------------------------------------------------------------
+# Profiling
+#----------------------------------------------------------------------
+def test_profile_counts(capsys):
+    vm = build(FIB)
+    profiler = Profiler()
+    profiler.profile(vm)
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    assert profiler.calls == {'main': 1, 'fib': 276}
+    assert profiler.opcode_counts['CALL'] == 276
+    assert profiler.opcode_counts['WRITE'] == 20
+    assert profiler.total() == sum(profiler.function_counts.values())
+    # every call runs the parameter store at pc 0
+    assert profiler.instr_counts[('fib', 0)] == 276
+    assert profiler.inclusive['main'] >= profiler.inclusive['fib']
+    assert profiler.inclusive['fib'] >= profiler.exclusive['fib'] > 0
+    assert 'fib' in profiler.report()
+
+def test_profile_tail_calls(capsys):
+    profiler = Profiler()
+    profiler.profile(build(TAIL_CALLS))
+    assert capsys.readouterr().out == '200010000 false'
+    assert profiler.calls['sum'] == 20001
+    assert profiler.calls['is_even'] + profiler.calls['is_odd'] == 5002
+    assert not profiler.shadow_stack
+
+def test_profile_json(capsys):
+    profiler = Profiler()
+    profiler.profile(build(FIB))
+    out_stream = io.StringIO()
+    profiler.write_json(out_stream)
+    profile = json.loads(out_stream.getvalue())
+    assert profile['functions']['fib']['calls'] == 276
+    assert profile['opcodes']['CALL'] == 276
+    assert profile['total_instructions'] == profiler.total()
+    first = profile['instructions'][0]
+    assert set(first) == {'function', 'pc', 'instruction', 'count'}
+
+
+def test_sampling_profiler(capsys):
+    program = (
+        'int fib(int x) {\n'
+        '  if (x <= 1) { return x; }\n'
+        '  return fib(x - 2) + fib(x - 1);\n'
+        '}\n'
+        'void main() { print(fib(20)); }\n'
+    )
+    sampler = SamplingProfiler(0.001)
+    sampler.profile(build(program))
+    assert capsys.readouterr().out == '6765'
+    assert sampler.total() > 0
+    assert sampler.thread is None
+    for line in sampler.collapsed().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert stack.startswith('main') and int(count) > 0
+        assert set(stack.split(';')) <= {'main', 'fib'}
+
+@pytest.mark.parametrize('vm_class', [ThreadedVM, RegisterVM])
+def test_sampling_falls_back(capsys, vm_class):
+    vm = build(FIB, vm_class)
+    sampler = SamplingProfiler(0.001)
+    sampler.profile(vm)
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    # the run used the stack VM, whose frames have pcs to sample
+    assert not vm.compiled
+    assert vm.sampler is None
+
+def test_collapsed_stacks():
+    sampler = SamplingProfiler()
+    sampler.samples = {(('main', 3), ('f', 1)): 2,
+                       (('main', 3), ('f', 5)): 1,
+                       (('main', 7),): 4}
+    assert sampler.collapsed() == 'main 4\nmain;f 3\n'
+    assert sampler.collapsed(pcs=True) == \
+        'main:3;f:1 2\nmain:3;f:5 1\nmain:7 4\n'
+
+
+#----------------------------------------------------------------------
+# Linking
+#----------------------------------------------------------------------
+def test_link_decodes_instructions():
+    template = VMFrameTemplate('main', 0, [PUSH('hi'), WRITE(), NOP()])
+    template.link()
+    assert template.size == 3
+    assert template.opcodes == (OpCode.PUSH.value, OpCode.WRITE.value,
+                                OpCode.NOP.value, END)
+    assert template.operands == ('hi', None, None, None)
+
+def test_run_off_end_of_linked_stream(capsys):
+    vm = VM()
+    vm.add_frame_template(VMFrameTemplate('main', 0, [PUSH('hi'), WRITE()]))
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == 'hi'
+
+
+def test_link_resolves_calls():
+    vm = build(FIB)
+    vm.link()
+    main = vm.frame_templates['main']
+    fib = vm.frame_templates['fib']
+    assert fib in main.operands
+    assert 'fib' not in main.operands
+    # the instructions still name the function
+    assert CALL('fib').operand in [i.operand for i in main.instructions]
+
+def test_link_undefined_function(capsys):
+    vm = VM()
+    main = VMFrameTemplate('main', 0, [PUSH('hi'), WRITE(), CALL('f'),
+                                       PUSH(None), RET()])
+    vm.add_frame_template(main)
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert 'undefined function "f"' in str(e.value)
+    # reported before running anything
+    assert capsys.readouterr().out == ''
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_argument_order(capsys, vm_class):
+    vm = build(
+        'string f(string a, string b, string c) { return a + b + c; }\n'
+        'void g() { print("g"); }\n'
+        'void main() { g(); print(f("x", "y", "z")); }\n',
+        vm_class)
+    vm.run()
+    assert capsys.readouterr().out == 'gxyz'
+
+
+#----------------------------------------------------------------------
+# Heap Objects
+#----------------------------------------------------------------------
+HEAP = (
+    'struct P {int v; P next;}\n'
+    'void main() {\n'
+    '  array int a = new int[3];\n'
+    '  array int b = new int[5];\n'
+    '  array int c = new int[3];\n'
+    '  print(length(a)); print(length(b)); print(" ");\n'
+    '  print(a == c); print(a == a); print(a != c); print(a == null); print(" ");\n'
+    '  P p = new P(1, null); P q = new P(1, p);\n'
+    '  print(p == q); print(q.next == p); print(q.next.next == null);\n'
+    '  c[1] = 7; a = c; print(" "); print(a[1]);\n'
+    '}\n'
+)
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_heap_references(capsys, vm_class):
+    build(HEAP, vm_class).run()
+    assert capsys.readouterr().out == '35 falsetruetruefalse falsetruetrue 7'
+
+def test_heap_references_switch(capsys):
+    build(HEAP).run(dispatch='switch')
+    assert capsys.readouterr().out == '35 falsetruetruefalse falsetruetrue 7'
+
+def test_objects_on_stack():
+    vm = build('struct P {int v;} void main() { P p = new P(4); array string a = new string[2]; }')
+    stack = []
+    vm.run(trace=lambda record: stack.append(record.stack_top))
+    struct_obj = next(x for x in stack if isinstance(x, Struct))
+    array_obj = next(x for x in stack if isinstance(x, Array))
+    assert list(struct_obj) == [4]
+    assert array_obj == array_obj and list(array_obj) == [None, None]
+
+
+TYPED = (
+    'void main() {\n'
+    '  array int xs = new int[4];\n'
+    '  array double ds = new double[3];\n'
+    '  array bool bs = new bool[3];\n'
+    '  xs[1] = 5; xs[2] = 9223372036854775807 * 4; xs[3] = (0 - 9223372036854775807) - 1;\n'
+    '  ds[1] = 2.5;\n'
+    '  bs[1] = true; bs[2] = false;\n'
+    '  for (int i = 0; i < 4; i = i + 1) { print(xs[i]); print(" "); }\n'
+    '  for (int i = 0; i < 3; i = i + 1) { print(ds[i]); print(" "); print(bs[i]); print(" "); }\n'
+    '  xs[1] = null; print(xs[1]); print(" ");\n'
+    '  print(length(xs)); print(xs == xs); print(xs == new int[4]);\n'
+    '}\n'
+)
+
+TYPED_OUTPUT = ('null 5 36893488147419103228 -9223372036854775808 '
+                'null null 2.5 true null false null 4truefalse')
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_typed_arrays(capsys, vm_class):
+    build(TYPED, vm_class).run()
+    assert capsys.readouterr().out == TYPED_OUTPUT
+
+def test_typed_arrays_switch(capsys):
+    build(TYPED).run(dispatch='switch')
+    assert capsys.readouterr().out == TYPED_OUTPUT
+
+def test_typed_array_allocation():
+    vm = build('struct P {int v;}\n'
+               'void main() { array int a = new int[3]; array double b = new double[3];\n'
+               '  array bool c = new bool[3]; array string d = new string[3];\n'
+               '  array P e = new P[3]; }')
+    stack = []
+    vm.run(trace=lambda record: stack.append(record.stack_top))
+    arrays = [x for x in stack if isinstance(x, (Array, TypedArray))]
+    assert [type(x) for x in arrays] == [IntArray, DoubleArray, BoolArray,
+                                         Array, Array]
+    assert arrays[0].itemsize == 8 and arrays[2].itemsize == 1
+    assert [arrays[0].get(i) for i in range(3)] == [None, None, None]
+
+
+FIELDS = (
+    'struct A {int x; int y;}\n'
+    'struct B {int y; A a; array A as;}\n'
+    'void main() {\n'
+    '  B b = new B(1, new A(2, 3), new A[2]);\n'
+    '  b.as[1] = new A(4, 5);\n'
+    '  b.a.y = b.a.y + b.y;\n'
+    '  print(b.y); print(b.a.x); print(b.a.y); print(b.as[1].y);\n'
+    '}\n'
+)
+
+def test_field_slots():
+    # the same field name is at a different slot in each struct
+    instrs = build(FIELDS).frame_templates['main'].instructions
+    allocs = [i.operand for i in instrs if i.opcode == OpCode.ALLOCS]
+    assert allocs == [3, 2, 2]
+    fields = {(i.opcode, i.operand, i.comment) for i in instrs
+              if i.opcode in [OpCode.GETF, OpCode.SETF]}
+    assert fields == {(OpCode.SETF, 0, 'y'), (OpCode.SETF, 1, 'a'),
+                      (OpCode.SETF, 2, 'as'), (OpCode.SETF, 0, 'x'),
+                      (OpCode.SETF, 1, 'y'), (OpCode.GETF, 2, 'as'),
+                      (OpCode.GETF, 1, 'a'), (OpCode.GETF, 0, 'y'),
+                      (OpCode.GETF, 0, 'x'), (OpCode.GETF, 1, 'y')}
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_field_slots_run(capsys, vm_class):
+    vm = build(FIELDS, vm_class)
+    FusionPass().run(vm)
+    vm.run()
+    assert capsys.readouterr().out == '1245'
+
+
+CYCLES = (
+    'struct Node {int v; Node prev; Node next;}\n'
+    'Node build(int n) {\n'
+    '  Node head = new Node(0, null, null);\n'
+    '  Node cur = head;\n'
+    '  for (int i = 1; i < n; i = i + 1) {\n'
+    '    Node nxt = new Node(i, cur, null);\n'
+    '    cur.next = nxt;\n'
+    '    cur = nxt;\n'
+    '  }\n'
+    '  return head;\n'
+    '}\n'
+    'void main() {\n'
+    '  for (int r = 0; r < 20; r = r + 1) { Node h = build(500); }\n'
+    '}\n'
+)
+
+def test_gc_reclaims_cycles():
+    gc.collect()
+    stats = GCStats()
+    stats.profile(build(CYCLES))
+    gc.collect()
+    stats.stop()
+    assert stats.total() > 0
+    # the doubly linked lists are only freed by the collector
+    assert sum(stats.collected) >= 10 * 500
+    assert stats.pause_max <= stats.pause_total
+    assert not stats in gc.callbacks
+    assert set(stats.to_dict()) == {'collections', 'collected',
+                                    'uncollectable', 'pause_total',
+                                    'pause_max'}
+
+@pytest.mark.parametrize('vm_class', [VM, RegisterVM])
+def test_release_frames(vm_class):
+    vm = build(CYCLES, vm_class)
+    vm.run()
+    if vm_class is RegisterVM:
+        free_frames = vm.register_templates['build'].free_frames
+    else:
+        free_frames = vm.frame_templates['build'].free_frames
+    # recycled frames hold no values of their last call
+    assert free_frames
+    assert not any(isinstance(x, Struct) for frame in free_frames
+                   for x in frame.variables + frame.operand_stack)
+    vm.release_frames()
+    assert not free_frames
+    assert vm.collect() >= 0
+    # recycled frames still work
+    vm.run()
+
+
+def test_heap_stats_counts():
+    program = (
+        'struct Node {int v; Node next;}\n'
+        'void main() {\n'
+        '  Node head = null;\n'
+        '  for (int i = 0; i < 30; i = i + 1) { head = new Node(i, head); }\n'
+        '  array int xs = new int[100];\n'
+        '  array string ys = new string[5];\n'
+        '}\n'
+    )
+    stats = HeapStats()
+    stats.profile(build(program))
+    assert stats.total() == 32
+    assert stats.allocations['Node'][0] == 30
+    assert stats.allocations['array int'][0] == 1
+    assert stats.allocations['array string'][0] == 1
+    assert [site[:2] for site in stats.sites.values()] == \
+        [['Node', 30], ['array int', 1], ['array string', 1]]
+    # censuses are spaced by the live objects, so the peak is within a
+    # factor of two
+    assert 15 <= stats.peak['Node'][0] <= 30
+    assert stats.peak_bytes == max(live_bytes for _, _, live_bytes
+                                   in stats.history)
+    assert 'Node' in stats.report()
+    assert set(stats.to_dict()) == {'allocations', 'live', 'peak',
+                                    'peak_bytes', 'sites', 'censuses'}
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_heap_stats_garbage(capsys, vm_class):
+    stats = HeapStats(census_interval=100)
+    vm = build(CYCLES, vm_class)
+    stats.profile(vm)
+    assert stats.total() == 20 * 500
+    # only one list (and part of the next) is ever reachable
+    assert 500 <= stats.peak['Node'][0] < 2 * 500
+    assert len(stats.history) >= 10
+    assert vm.heap_stats is None
+
+def test_heap_stats_errors():
+    program = (
+        'struct T {int v;}\n'
+        'void main() {\n'
+        '  T t = new T(1);\n'
+        '  array T ts = new T[3];\n'
+        '  int x = 1 / 0;\n'
+        '}\n'
+    )
+    stats = HeapStats(census_interval=100)
+    with pytest.raises(MyPLError):
+        stats.profile(build(program))
+    # a last census finds what the failed run still holds
+    assert stats.live['T'][0] == 1 and stats.live['array T'][0] == 1
+    vm = build(program)
+    vm.heap_stats = HeapStats()
+    with pytest.raises(MyPLError):
+        vm.run(trace=lambda record: None)
+
+
+#----------------------------------------------------------------------
+# Frames
+#----------------------------------------------------------------------
+def test_local_count_from_code_generator():
+    vm = build(
+        'int f(int a, int b) {\n'
+        '  int c = a;\n'
+        '  if (a > b) { int d = 1; }\n'
+        '  return c;\n'
+        '}\n'
+        'void main() { f(1, 2); }\n'
+    )
+    f = vm.frame_templates['f']
+    # a, b, c and d, then the two > scratch slots
+    assert f.local_count == 6
+    addrs = {instr.operand for instr in f.instructions
+             if instr.opcode in [OpCode.LOAD, OpCode.STORE]}
+    assert addrs == {0, 1, 2, 3, 4, 5}
+    assert vm.frame_templates['main'].local_count == 0
+
+def test_link_covers_hand_built_templates():
+    template = VMFrameTemplate('main', 1, [PUSH(1), STORE(3), LOAD(3)])
+    template.link()
+    assert template.local_count == 4
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_frames_are_recycled(capsys, vm_class):
+    vm = build(FIB, vm_class)
+    vm.run()
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    if vm_class == RegisterVM:
+        free_frames = vm.register_templates['fib'].free_frames
+    else:
+        free_frames = vm.frame_templates['fib'].free_frames
+    # no more frames than the deepest recursion ever existed
+    assert 0 < len(free_frames) <= 10
+    assert all(not frame.operand_stack for frame in free_frames)
+    # a second run reuses the recycled frames' variable lists
+    variables = {id(frame.variables) for frame in free_frames}
+    vm.run()
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    assert {id(frame.variables) for frame in free_frames} == variables
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_frame_pool_is_capped(vm_class):
+    program = (
+        'struct S {int v;}\n'
+        'int f(int n) { S s = new S(n); if (n == 0) { return 0; }\n'
+        '  return f(n - 1) + 1; }\n'
+        'void main() { f(200); }\n'
+    )
+    vm = build(program, vm_class)
+    vm.run()
+    if vm_class == RegisterVM:
+        free_frames = vm.register_templates['f'].free_frames
+    else:
+        free_frames = vm.frame_templates['f'].free_frames
+    assert 0 < len(free_frames) <= FRAME_POOL_SIZE
+    assert not any(isinstance(x, Struct) for frame in free_frames
+                   for x in frame.variables)
+
+def test_frame_slots():
+    frame = VMFrameTemplate('f', 0, local_count=3).new_frame()
+    assert frame.variables == [None, None, None]
+    with pytest.raises(AttributeError):
+        frame.extra = 1
+
+
+#----------------------------------------------------------------------
+# Tail Calls
+#----------------------------------------------------------------------
+TAIL_CALLS = (
+    'int sum(int n, int acc) {\n'
+    '  if (n == 0) { return acc; }\n'
+    '  return sum(n - 1, acc + n);\n'
+    '}\n'
+    'bool is_even(int n) {\n'
+    '  if (n == 0) { return true; }\n'
+    '  return is_odd(n - 1);\n'
+    '}\n'
+    'bool is_odd(int n) {\n'
+    '  if (n == 0) { return false; }\n'
+    '  return is_even(n - 1);\n'
+    '}\n'
+    'void main() {\n'
+    '  print(sum(20000, 0));\n'
+    '  print(" ");\n'
+    '  print(is_even(5001));\n'
+    '}\n'
+)
+
+def test_tail_call_generated():
+    vm = build(TAIL_CALLS)
+    opcodes = [instr.opcode for instr in vm.frame_templates['sum'].instructions]
+    assert OpCode.TCALL in opcodes and OpCode.CALL not in opcodes
+    opcodes = [instr.opcode for instr in vm.frame_templates['main'].instructions]
+    assert OpCode.TCALL not in opcodes
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_tail_calls_run_in_constant_space(capsys, vm_class):
+    vm = build(TAIL_CALLS, vm_class)
+    vm.run()
+    assert capsys.readouterr().out == '200010000 false'
+    if vm_class == RegisterVM:
+        templates = vm.register_templates
+    else:
+        templates = vm.frame_templates
+    for name in ['sum', 'is_even', 'is_odd']:
+        assert len(templates[name].free_frames) <= 1
+
+def test_tail_calls_switch_dispatch(capsys):
+    build(TAIL_CALLS).run(dispatch='switch')
+    assert capsys.readouterr().out == '200010000 false'
+
+
+#----------------------------------------------------------------------
+# Limits
+#----------------------------------------------------------------------
+FOREVER = 'void main() { int i = 0; while (true) { i = i + 1; } }'
+
+def test_instruction_limit():
+    vm = build(FOREVER, lambda: VM(Limits(max_instructions=25000)))
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert 'instruction limit of 25000 exceeded' in str(e.value)
+    assert vm.executed == 25000
+
+def test_time_limit():
+    vm = build(FOREVER, lambda: VM(Limits(max_time=0.05)))
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert 'time limit of 0.05s exceeded' in str(e.value)
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_depth_limit(vm_class):
+    program = 'int f(int n) { return f(n + 1) + 1; } void main() { f(0); }'
+    vm = build(program, lambda: vm_class(Limits(max_depth=100)))
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert 'call depth limit of 100 exceeded' in str(e.value)
+    assert len(vm.call_stack) == 100
+
+def test_heap_limit():
+    program = (
+        'struct S {S next;}\n'
+        'void main() {\n'
+        '  S s = null;\n'
+        '  while (true) { s = new S(s); }\n'
+        '}\n'
+    )
+    vm = build(program, lambda: VM(Limits(max_heap=10)))
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert 'heap limit of 10 objects exceeded' in str(e.value)
+    assert vm.allocated == 10
+
+def test_heap_limit_counts_live_objects(capsys):
+    program = (
+        'struct S {int x;}\n'
+        'void main() {\n'
+        '  S kept = new S(0);\n'
+        '  for (int i = 0; i < 1000; i = i + 1) {\n'
+        '    S s = new S(i); array int a = new int[2];\n'
+        '    kept.x = kept.x + s.x;\n'
+        '  }\n'
+        '  print(kept.x);\n'
+        '}\n'
+    )
+    vm = build(program, lambda: VM(Limits(max_heap=100)))
+    vm.run()
+    assert capsys.readouterr().out == '499500'
+    assert vm.allocated < 100
+
+def test_within_limits(capsys):
+    limits = Limits(max_instructions=100000, max_time=10, max_depth=20,
+                    max_heap=0, check_interval=7)
+    vm = build(FIB, lambda: VM(limits))
+    vm.run()
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    profiler = Profiler()
+    profiler.profile(build(FIB))
+    capsys.readouterr()
+    assert vm.executed == profiler.total()
+    # tail calls do not count towards the call depth
+    build(TAIL_CALLS, lambda: VM(Limits(max_depth=3))).run()
+    assert capsys.readouterr().out == '200010000 false'
+
+def test_limits_with_tracing():
+    vm = build(FIB, lambda: VM(Limits(max_instructions=10)))
+    with pytest.raises(MyPLError):
+        vm.run(trace=[].append)
+
+
+#----------------------------------------------------------------------
+# Resumable Execution
+#----------------------------------------------------------------------
+def test_resume_in_slices(capsys):
+    vm = build(FIB)
+    vm.start()
+    statuses = []
+    status = RunStatus.YIELDED
+    while status == RunStatus.YIELDED:
+        status = vm.resume(50)
+        statuses.append(status)
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    assert statuses.count(RunStatus.FINISHED) == 1
+    assert len(statuses) == vm.executed // 50 + 1
+    assert not vm.call_stack
+    with pytest.raises(MyPLError) as e:
+        vm.resume(50)
+    assert 'no run to resume' in str(e.value)
+
+def test_resume_before_start():
+    vm = build(FIB)
+    with pytest.raises(MyPLError) as e:
+        vm.resume(50)
+    assert 'no run to resume' in str(e.value)
+    assert vm.executed == 0
+
+def test_resume_blocks_on_input(capsys):
+    program = (
+        'void main() {\n'
+        '  print("name? ");\n'
+        '  string name = input();\n'
+        '  print("hi " + name);\n'
+        '  print(input());\n'
+        '}\n'
+    )
+    vm = build(program)
+    vm.start()
+    assert vm.resume(1000) == RunStatus.BLOCKED
+    assert capsys.readouterr().out == 'name? '
+    # still waiting without input
+    assert vm.resume(1000) == RunStatus.BLOCKED
+    vm.feed_input('ann')
+    assert vm.resume(1000) == RunStatus.BLOCKED
+    assert capsys.readouterr().out == 'hi ann'
+    vm.close_input()
+    assert vm.resume(1000) == RunStatus.FINISHED
+    assert capsys.readouterr().out == 'null'
+
+def test_interleaved_runs(capsys):
+    vms = [build('void main() { for (int i = 0; i < 3; i = i + 1) { print(i); } }')
+           for i in range(3)]
+    for vm in vms:
+        vm.start()
+    running = list(vms)
+    while running:
+        running = [vm for vm in running if vm.resume(4) != RunStatus.FINISHED]
+    assert sorted(capsys.readouterr().out) == sorted('000111222')
+
+def test_resume_with_limits():
+    vm = build(FOREVER, lambda: VM(Limits(max_instructions=1000)))
+    vm.start()
+    assert vm.resume(600) == RunStatus.YIELDED
+    with pytest.raises(MyPLError) as e:
+        vm.resume(600)
+    assert 'instruction limit of 1000 exceeded' in str(e.value)
+    assert vm.executed == 1000
+
+
+#----------------------------------------------------------------------
+# Buffered Output
+#----------------------------------------------------------------------
+
+class EventStdin:
+    """A standard input recording its reads in a list of events."""
+    def __init__(self, lines, events):
+        self.lines = list(lines)
+        self.events = events
+    def readline(self):
+        self.events.append(('read',))
+        return self.lines.pop(0) + '\n'
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_output_buffered(vm_class):
+    chunks = []
+    vm = build(FIB, vm_class)
+    vm.output = OutputBuffer(chunks.append, 8)
+    vm.run()
+    assert ''.join(chunks) == '0 1 1 2 3 5 8 13 21 34 '
+    # flushed once 8 characters are waiting, and at the end
+    assert all(len(chunk) >= 8 for chunk in chunks[:-1])
+    assert 1 < len(chunks) < 20
+
+@pytest.mark.parametrize('dispatch', ['table', 'switch'])
+def test_output_flushed_on_read(monkeypatch, dispatch):
+    program = (
+        'void main() {\n'
+        '  print("name? ");\n'
+        '  string name = input();\n'
+        '  print("hi ");\n'
+        '  print(name);\n'
+        '}\n'
+    )
+    events = []
+    monkeypatch.setattr(sys, 'stdin', EventStdin(['bo'], events))
+    vm = build(program)
+    vm.output = OutputBuffer(lambda text: events.append(('write', text)))
+    vm.run(dispatch=dispatch)
+    assert events == [('write', 'name? '), ('read',), ('write', 'hi bo')]
+
+def test_output_flushed_on_error():
+    program = 'void main() { print("before"); int x = 1 / 0; print("after"); }'
+    chunks = []
+    vm = build(program, ThreadedVM)
+    vm.output = OutputBuffer(chunks.append)
+    with pytest.raises(MyPLError):
+        vm.run()
+    assert chunks == ['before']
+
+def test_output_sinks(capsys):
+    program = 'void main() { print("x = "); print(1.5); print(null); }'
+    binary = io.BytesIO()
+    vm = build(program)
+    vm.output = OutputBuffer(binary)
+    vm.run()
+    assert binary.getvalue() == b'x = 1.5null'
+    text = io.StringIO()
+    vm = build(program)
+    vm.output = OutputBuffer(text)
+    vm.run()
+    assert text.getvalue() == 'x = 1.5null'
+    # standard output is looked up when flushing
+    build(program).run()
+    assert capsys.readouterr().out == 'x = 1.5null'
+
+
+#----------------------------------------------------------------------
+# Buffered Input
+#----------------------------------------------------------------------
+
+LINES = (
+    'void main() {\n'
+    '  string first = input();\n'
+    '  array string pair = input_n(2);\n'
+    '  print(first + pair[0] + pair[1] + " ");\n'
+    '  while (not input_eof()) {\n'
+    '    array string rest = input_n(3);\n'
+    '    print(length(rest));\n'
+    '  }\n'
+    '  print(" " + itos(length(input_all())) + " ");\n'
+    '  print(length(input_n(5)));\n'
+    '}\n'
+)
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM,
+                                      PythonGenerator])
+def test_input_built_ins(capsys, monkeypatch, vm_class):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('a\nb\nc\n1\n2\n3\n4\n5'))
+    if vm_class == PythonGenerator:
+        build_python(LINES).run()
+    else:
+        build(LINES, vm_class).run()
+    assert capsys.readouterr().out == 'abc 32 0 0'
+
+def test_input_built_ins_switch(capsys, monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('a\nb\nc\n1\n2\n3\n4\n'))
+    build(LINES).run(dispatch='switch')
+    assert capsys.readouterr().out == 'abc 31 0 0'
+
+def test_input_blocks():
+    text = 'x\u00e9\r\ny\n\nlast'
+    stream = io.TextIOWrapper(io.BytesIO(text.encode('utf-8')),
+                              encoding='utf-8')
+    # read a few bytes at a time, splitting the two-byte character and the
+    # \r\n pair across blocks
+    buffer = InputBuffer(stream, 3)
+    assert buffer.waiting()
+    assert buffer.readline() == 'x\u00e9'
+    assert buffer.readlines(2) == ['y', '']
+    assert not buffer.at_end()
+    assert buffer.readlines() == ['last']
+    assert buffer.at_end() and not buffer.waiting()
+    assert buffer.readlines(4) == []
+    with pytest.raises(EOFError):
+        buffer.readline()
+
+def test_input_built_ins_queued(capsys):
+    vm = build(LINES)
+    vm.start()
+    assert vm.resume(1000) == RunStatus.BLOCKED
+    vm.feed_input('a')
+    vm.feed_input('b')
+    # input_n(2) waits for its second line
+    assert vm.resume(1000) == RunStatus.BLOCKED
+    for line in ['c', '1', '2']:
+        vm.feed_input(line)
+    assert vm.resume(1000) == RunStatus.BLOCKED
+    assert capsys.readouterr().out == 'abc '
+    vm.feed_input('3')
+    vm.feed_input('4')
+    vm.close_input()
+    assert vm.resume(1000) == RunStatus.FINISHED
+    assert capsys.readouterr().out == '31 0 0'
+
+def test_input_built_ins_checked():
+    for call in ['input_all(1)', 'input_n("2")', 'input_n()', 'input_eof(3)']:
+        with pytest.raises(MyPLError):
+            build(f'void main() {{ {call}; }}')
+    program = 'void main() { array string xs = input_n(0 - 1); }'
+    with pytest.raises(MyPLError) as e:
+        build(program).run()
+    assert 'invalid number of lines' in str(e.value)
+
+
+#----------------------------------------------------------------------
+# String Appends
+#----------------------------------------------------------------------
+
+APPENDS = (
+    'string twice(string x) { x = x + x; return x; }\n'
+    'void main() {\n'
+    '  string s = "";\n'
+    '  for (int i = 0; i < 5; i = i + 1) {\n'
+    '    string t = s;\n'
+    '    s = s + itos(i) + ",";\n'
+    '    print(t + "|");\n'
+    '  }\n'
+    '  print(twice(s) + " " + s + " ");\n'
+    '  s = s + s;\n'
+    '  print(s);\n'
+    '}\n'
+)
+
+APPENDED = ('|0,|0,1,|0,1,2,|0,1,2,3,|0,1,2,3,4,0,1,2,3,4, 0,1,2,3,4, '
+            '0,1,2,3,4,0,1,2,3,4,')
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM,
+                                      PythonGenerator])
+def test_string_appends(capsys, vm_class):
+    if vm_class == PythonGenerator:
+        build_python(APPENDS).run()
+    else:
+        build(APPENDS, vm_class).run()
+    assert capsys.readouterr().out == APPENDED
+
+def test_string_appends_switch_and_fused(capsys):
+    build(APPENDS).run(dispatch='switch')
+    assert capsys.readouterr().out == APPENDED
+    vm = build(APPENDS)
+    FusionPass().run(vm)
+    vm.run()
+    assert capsys.readouterr().out == APPENDED
+
+def test_string_append_code():
+    program = (
+        'struct P {string name;}\n'
+        'void main() {\n'
+        '  string s = "a"; int n = 1; P p = new P("b");\n'
+        '  s = s + "b";\n'
+        '  s = "c" + s;\n'
+        '  n = n + 1;\n'
+        '  p.name = p.name + "c";\n'
+        '}\n'
+    )
+    vm = build(program)
+    instrs = vm.frame_templates['main'].instructions
+    # only the first assignment appends to a string variable
+    assert [instr.operand for instr in instrs
+            if instr.opcode == OpCode.ADDL] == [0]
+    fusion = FusionPass()
+    fusion.run(vm)
+    assert fusion.fired['increment-local'] == {'main': 1}
+
+@pytest.mark.parametrize('vm_class', [VM, ThreadedVM, RegisterVM])
+def test_string_append_null(vm_class):
+    for init in ['string s = null; string t = "x";',
+                 'string s = "x"; string t = null;']:
+        vm = build(f'void main() {{ {init} s = s + t; }}', vm_class)
+        with pytest.raises(MyPLError) as e:
+            vm.run()
+        assert 'cant be None' in str(e.value)
+
+
+#----------------------------------------------------------------------
+# Checkpoints
+#----------------------------------------------------------------------
+
+CHECKPOINTED = (
+    'struct Node {int v; Node prev; Node next;}\n'
+    'Node build(int n, Node prev) {\n'
+    '  if (n == 0) { return null; }\n'
+    '  Node node = new Node(n, prev, null);\n'
+    '  node.next = build(n - 1, node);\n'
+    '  return node;\n'
+    '}\n'
+    'int walk(Node p) {\n'
+    '  int total = 0;\n'
+    '  while (p != null) { total = total + p.prev.v; p = p.next; }\n'
+    '  return total;\n'
+    '}\n'
+    'void main() {\n'
+    '  array int xs = new int[3];\n'
+    '  xs[0] = 9223372036854775807 * 4;\n'
+    '  array double ds = new double[2];\n'
+    '  ds[1] = 2.5;\n'
+    '  array Node ns = new Node[2];\n'
+    '  int total = 0;\n'
+    '  for (int r = 0; r < 30; r = r + 1) {\n'
+    '    ns[0] = build(40, null);\n'
+    '    ns[1] = ns[0];\n'
+    '    total = total + walk(ns[1].next.next);\n'
+    '  }\n'
+    '  print(itos(total) + " " + itos(xs[0]) + " " + dtos(ds[1]));\n'
+    '  if ((xs[1] == null) and (ds[0] == null)) { print(" ok"); }\n'
+    '}\n'
+)
+
+@pytest.mark.parametrize('fork', [False, True])
+def test_checkpoint_restore(capsys, tmp_path, fork):
+    path = str(tmp_path / 'run.ckpt')
+    vm = build(CHECKPOINTED, lambda: VM(Limits(check_interval=997)))
+    checkpointer = Checkpointer(path, 5000, fork)
+    checkpointer.profile(vm)
+    output = capsys.readouterr().out
+    assert output == '23370 36893488147419103228 2.5 ok'
+    assert checkpointer.saves > 1
+    assert vm.checkpointer is None
+    # the last checkpoint was taken before the output was printed (forked
+    # saves are put off while the last one is written, so they can land
+    # anywhere)
+    restored = restore(path, limits=Limits(check_interval=997))
+    if not fork:
+        assert 1 < len(restored.call_stack)
+    assert restored.executed < vm.executed
+    restored.continue_run()
+    assert capsys.readouterr().out == output
+    assert restored.executed == vm.executed
+
+def test_checkpoint_restore_chained(capsys, tmp_path):
+    path = str(tmp_path / 'run.ckpt')
+    vm = build(CHECKPOINTED)
+    vm.checkpointer = Checkpointer(path, 20000, fork=False)
+    vm.run()
+    output = capsys.readouterr().out
+    # restore the first checkpoint and save more from the restored run
+    first = Checkpointer(path, 20000, fork=False)
+    vm = build(CHECKPOINTED, lambda: VM(Limits(max_instructions=25000)))
+    with pytest.raises(MyPLError):
+        first.profile(vm)
+    restored = restore(path, VM)
+    Checkpointer(path, 10000, fork=False).attach(restored)
+    restored.continue_run(dispatch='switch')
+    assert capsys.readouterr().out == output
+    restore(path).continue_run()
+    assert capsys.readouterr().out == output
+
+@pytest.mark.parametrize('fork', [False, True])
+def test_checkpoint_small_interval(capsys, tmp_path, fork):
+    # checkpoints come every interval instructions even when that is less
+    # than the limit check interval, and in runs shorter than one check
+    path = tmp_path / 'run.ckpt'
+    vm = build(FIB)
+    checkpointer = Checkpointer(str(path), 50, fork)
+    checkpointer.profile(vm)
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    assert vm.executed < Limits().check_interval
+    assert path.exists()
+    if not fork:
+        assert checkpointer.saves == vm.executed // 50
+    restored = restore(str(path), limits=Limits())
+    assert restored.executed % 50 == 0
+    restored.continue_run()
+    assert restored.executed == vm.executed
+
+def test_checkpoint_while_sampled(capsys, tmp_path, monkeypatch):
+    def no_fork():
+        raise AssertionError('forked with the sampler thread running')
+    monkeypatch.setattr(os, 'fork', no_fork)
+    path = tmp_path / 'run.ckpt'
+    vm = build(FIB)
+    sampler = SamplingProfiler(0.001)
+    sampler.start(vm)
+    try:
+        Checkpointer(str(path), 500, fork=True).profile(vm)
+    finally:
+        sampler.stop()
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    assert path.exists()
+
+def test_checkpoint_long_list():
+    # a linked list longer than the recursion limit
+    head = None
+    for i in range(50000):
+        head = Struct([i, head])
+    template = VMFrameTemplate('main', 0, [], local_count=2)
+    vm = VM()
+    vm.add_frame_template(template)
+    vm.call_stack.append(VMFrame(template, 3, [head, head], [head]))
+    vm.input.lines.extend(['unread', 'lines'])
+    state = pickle.loads(pickle.dumps(snapshot(vm)))
+    restored = VM()
+    restore_state(restored, state)
+    assert restored.input.readlines(2) == ['unread', 'lines']
+    frame = restored.call_stack[0]
+    assert frame.pc == 3
+    assert frame.variables[0] is frame.variables[1] is frame.operand_stack[0]
+    node = frame.variables[0]
+    count = 0
+    while node is not None:
+        assert node[0] == 49999 - count
+        node = node[1]
+        count += 1
+    assert count == 50000
+
+def test_checkpoint_errors(tmp_path):
+    path = tmp_path / 'bad.ckpt'
+    path.write_bytes(b'not a checkpoint')
+    with pytest.raises(MyPLError):
+        restore(str(path))
+    path.write_bytes(MAGIC + b'garbage')
+    with pytest.raises(MyPLError):
+        restore(str(path))
+    with pytest.raises(MyPLError):
+        VM().continue_run()
+    vm = build(CHECKPOINTED)
+    vm.checkpointer = Checkpointer(str(tmp_path / 'x.ckpt'))
+    with pytest.raises(MyPLError):
+        vm.run(trace=lambda record: None)
+    vm = build(CHECKPOINTED)
+    checkpointer = Checkpointer(str(tmp_path / 'missing' / 'x.ckpt'), 1000)
+    with pytest.raises(MyPLError):
+        checkpointer.profile(vm)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_checkpoint_waited_for_on_error(capsys, tmp_path):
+    # a run stopped by a limit still waits for its forked checkpoint
+    path = tmp_path / 'run.ckpt'
+    vm = build(CHECKPOINTED, lambda: VM(Limits(max_instructions=1500)))
+    checkpointer = Checkpointer(str(path), 1000, fork=True)
+    with pytest.raises(MyPLError) as e:
+        checkpointer.profile(vm)
+    assert 'instruction limit' in str(e.value)
+    assert checkpointer.writer is None and path.exists()
+    assert restore(str(path)).executed == 1000
+    # a failed write is reported without hiding the run's own error
+    vm = build(CHECKPOINTED, lambda: VM(Limits(max_instructions=1500)))
+    checkpointer = Checkpointer(str(tmp_path / 'missing' / 'x.ckpt'), 1000,
+                                fork=True)
+    with pytest.raises(MyPLError) as e:
+        checkpointer.profile(vm)
+    assert 'instruction limit' in str(e.value)
+    assert 'could not write checkpoint' in capsys.readouterr().err
+
+
+#----------------------------------------------------------------------
+# Batch Execution
+#----------------------------------------------------------------------
+ECHO = (
+    'void main() {\n'
+    '  int n = stoi(input());\n'
+    '  print(itos(n * n) + " " + input());\n'
+    '}\n'
+)
+
+def test_batch_runs():
+    templates = compile_program(FileWrapper(io.StringIO(ECHO)))
+    jobs = [BatchJob(f'job{i}', f'{i}\nx{i}\n') for i in range(10)]
+    results, summary = run_batch(templates, jobs, workers=2)
+    assert [r.name for r in results] == [f'job{i}' for i in range(10)]
+    assert [r.output for r in results] == [f'{i*i} x{i}' for i in range(10)]
+    assert all(r.error is None for r in results)
+    assert summary.jobs == 10 and summary.failed == 0 and summary.workers == 2
+
+@pytest.mark.parametrize('backend', ['vm', 'threaded', 'register'])
+def test_batch_errors(backend):
+    templates = compile_program(FileWrapper(io.StringIO(ECHO)))
+    jobs = [BatchJob('ok', '3\nz\n'), BatchJob('bad', 'three\n'),
+            BatchJob('short', '3\n')]
+    results, summary = run_batch(templates, jobs, 2, backend)
+    assert results[0].output == '9 z' and results[0].error is None
+    assert results[1].error.startswith('VM Error:')
+    assert results[2].error.startswith('VM Error:')
+    assert summary.failed == 2
+
+def test_batch_internal_error():
+    # a program whose failure is not a MyPLError (int + string)
+    main = VMFrameTemplate('main', 0, [PUSH(1), PUSH('a'), ADD(),
+                                       PUSH(None), RET()])
+    templates = {'main': main}
+    results, summary = run_batch(templates, [BatchJob('a'), BatchJob('b')], 2)
+    assert all(r.error.startswith('TypeError:') for r in results)
+    assert summary.failed == 2
+
+def test_batch_limits():
+    templates = compile_program(FileWrapper(io.StringIO(FOREVER)))
+    limits = Limits(max_instructions=1000)
+    results, summary = run_batch(templates, [BatchJob('a'), BatchJob('b')],
+                                 2, limits=limits)
+    assert all('instruction limit of 1000 exceeded' in r.error for r in results)
+    assert summary.instructions == 2000
+
+
+#----------------------------------------------------------------------
+# Async Sessions
+#----------------------------------------------------------------------
+GREET = (
+    'void main() {\n'
+    '  print("name? ");\n'
+    '  string name = input();\n'
+    '  while (name != null) {\n'
+    '    print("hi " + name + "\\n");\n'
+    '    name = input();\n'
+    '  }\n'
+    '  print("bye");\n'
+    '}\n'
+)
+
+class BufferWriter:
+    """Stream writer stand-in collecting the bytes written."""
+    def __init__(self):
+        self.data = b''
+    def write(self, data):
+        self.data += data
+    async def drain(self):
+        pass
+
+def test_sessions_over_socket():
+    host = SessionHost(compile_program(FileWrapper(io.StringIO(GREET))))
+    async def client(port, i):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'a{i}\nb{i}\n'.encode())
+        writer.write_eof()
+        output = await reader.read()
+        writer.close()
+        return output.decode()
+    async def main():
+        server = await host.start_server()
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await asyncio.gather(*[client(port, i) for i in range(50)])
+    outputs = asyncio.run(main())
+    assert outputs == [f'name? hi a{i}\nhi b{i}\nbye' for i in range(50)]
+    assert host.finished == 50 and host.failed == 0 and host.active == 0
+
+def test_session_waits_for_input():
+    host = SessionHost(compile_program(FileWrapper(io.StringIO(GREET))))
+    async def main():
+        reader = asyncio.StreamReader()
+        writer = BufferWriter()
+        task = asyncio.create_task(host.run_session(reader, writer))
+        await asyncio.sleep(0.01)
+        # suspended in READ after sending the prompt
+        assert not task.done() and writer.data == b'name? '
+        reader.feed_data(b'ann\n')
+        await asyncio.sleep(0.01)
+        assert writer.data == b'name? hi ann\n'
+        reader.feed_eof()
+        assert await task is None
+        return writer.data
+    assert asyncio.run(main()) == b'name? hi ann\nbye'
+
+def test_sessions_yield_to_each_other():
+    # a session stuck in a loop does not hold up the others
+    looping = SessionHost(compile_program(FileWrapper(io.StringIO(FOREVER))),
+                          Limits(max_instructions=50000), steps=100)
+    greeting = SessionHost(compile_program(FileWrapper(io.StringIO(GREET))))
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_eof()
+        loop_writer, greet_writer = BufferWriter(), BufferWriter()
+        loop_task = asyncio.create_task(
+            looping.run_session(asyncio.StreamReader(), loop_writer))
+        await greeting.run_session(reader, greet_writer)
+        assert not loop_task.done()
+        error = await loop_task
+        return error, loop_writer.data, greet_writer.data
+    error, loop_output, greet_output = asyncio.run(main())
+    assert greet_output == b'name? bye'
+    assert 'instruction limit of 50000 exceeded' in error
+    assert loop_output.decode() == error + '\n'
+    assert looping.failed == 1
+
+def test_session_undecodable_input():
+    host = SessionHost(compile_program(FileWrapper(io.StringIO(GREET))))
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'\xff\xfe\n')
+        reader.feed_eof()
+        writer = BufferWriter()
+        error = await host.run_session(reader, writer)
+        return error, writer.data
+    error, output = asyncio.run(main())
+    assert 'not valid UTF-8' in error
+    assert output == b'name? ' + error.encode() + b'\n'
+    assert host.failed == 1
+
+
+#----------------------------------------------------------------------
+# Superinstruction Fusion
+#----------------------------------------------------------------------
+LOOPS = (
+    'struct Pair {int x; int y;}\n'
+    'int diff(int a, int b) {\n'
+    '  return a - (b - a);\n'
+    '}\n'
+    'void main() {\n'
+    '  Pair p = new Pair(3, 0);\n'
+    '  int n = 10;\n'
+    '  while (n > p.x) {\n'
+    '    n = n - 1;\n'
+    '    p.y = p.y + 2;\n'
+    '  }\n'
+    '  for (int i = 0; i < 3; i = i + 1) {\n'
+    '    print(i);\n'
+    '  }\n'
+    '  print(p.y);\n'
+    '  print(diff(n, 1));\n'
+    '}\n'
+)
+
+def test_fused_program_output(capsys):
+    build(LOOPS).run()
+    expected = capsys.readouterr().out
+    vm = build(LOOPS)
+    FusionPass().run(vm)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == expected == '012145'
+
+def test_fusion_report():
+    vm = build(LOOPS)
+    fusion = FusionPass()
+    fusion.run(vm)
+    assert fusion.fired['increment-local'] == {'main': 2}
+    assert fusion.fired['compare-and-branch'] == {'main': 2}
+    assert fusion.fired['swap'] == {'main': 1}
+    assert fusion.fired['load-field-of-local'] == {'main': 3}
+    assert 'increment-local' in fusion.report()
+
+def test_no_swap_of_live_variables():
+    # parameter stores followed by loads look like the > scratch pattern
+    vm = build(LOOPS)
+    FusionPass().run(vm)
+    opcodes = [instr.opcode for instr in vm.frame_templates['diff'].instructions]
+    assert OpCode.SWAP not in opcodes
+
+
+#----------------------------------------------------------------------
+# Threaded Backend
+#----------------------------------------------------------------------
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_threaded_examples(capsys, monkeypatch, path):
+    expected = run_example(path, VM, capsys, monkeypatch)
+    assert run_example(path, ThreadedVM, capsys, monkeypatch) == expected
+
+def test_threaded_fused_program(capsys):
+    vm = build(LOOPS, ThreadedVM)
+    FusionPass().run(vm)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '012145'
+
+@pytest.mark.parametrize('vm_class', [ThreadedVM, RegisterVM])
+def test_threaded_run_takes_dispatch(capsys, vm_class):
+    build(FIB, vm_class).run(dispatch='switch')
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+    vm = build(FIB, lambda: vm_class(Limits(max_instructions=100000)))
+    vm.run(dispatch='switch')
+    assert capsys.readouterr().out == '0 1 1 2 3 5 8 13 21 34 '
+
+def test_threaded_recursion(capsys):
+    build(FIB, ThreadedVM).run()
+    captured = capsys.readouterr()
+    assert captured.out == '0 1 1 2 3 5 8 13 21 34 '
+
+
+#----------------------------------------------------------------------
+# Register Backend
+#----------------------------------------------------------------------
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_register_examples(capsys, monkeypatch, path):
+    expected = run_example(path, VM, capsys, monkeypatch)
+    assert run_example(path, RegisterVM, capsys, monkeypatch) == expected
+
+def test_register_fused_program(capsys):
+    vm = build(LOOPS, RegisterVM)
+    FusionPass().run(vm)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '012145'
+
+def test_register_recursion(capsys):
+    build(FIB, RegisterVM).run()
+    captured = capsys.readouterr()
+    assert captured.out == '0 1 1 2 3 5 8 13 21 34 '
+
+def test_register_code_has_no_stack_traffic():
+    vm = build(LOOPS, RegisterVM)
+    vm.translate()
+    for name, template in vm.register_templates.items():
+        stack_size = len(vm.frame_templates[name].instructions)
+        assert len(template.instructions) < stack_size
+    # diff(a, b) = a - (b - a) needs no moves at all
+    diff = vm.register_templates['diff'].instructions
+    assert [instr.opcode for instr in diff] == \
+        [RegOpCode.SUB, RegOpCode.SUB, RegOpCode.RET]
+    assert 'main' in vm.stats()
+
+def test_register_store_keeps_loaded_value(capsys):
+    # LOAD 0; PUSH 5; STORE 0; WRITE must print the old value of 0
+    vm = RegisterVM()
+    main = VMFrameTemplate('main', 0)
+    main.instructions = [PUSH(1), STORE(0), LOAD(0), PUSH(5), STORE(0),
+                         WRITE(), LOAD(0), WRITE(), PUSH(None), RET()]
+    vm.add_frame_template(main)
+    vm.run()
+    captured = capsys.readouterr()
+    assert captured.out == '15'
+
+def test_register_null_operand():
+    vm = build('void main() { int x = null; int y = x + 1; }', RegisterVM)
+    with pytest.raises(MyPLError):
+        vm.run()
+
+
+def test_register_stackop_error_location(monkeypatch):
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(''))
+    program = (
+        'int f(int n) {\n'
+        '  int x = 1;\n'
+        '  print(x);\n'
+        '  array string lines = input_n(n - x);\n'
+        '  return x;\n'
+        '}\n'
+        'void main() { print(f(1)); print(f(0)); }\n'
+    )
+    messages = []
+    for vm_class in [VM, RegisterVM]:
+        with pytest.raises(MyPLError) as e:
+            build(program, vm_class).run()
+        messages.append(str(e.value))
+    assert messages[0] == messages[1]
+    assert '(in f at ' in messages[1] and 'READN' in messages[1]
+
+
+#----------------------------------------------------------------------
+# Python Backend
+#----------------------------------------------------------------------
+@pytest.mark.parametrize('path', EXAMPLES)
+def test_python_examples(capsys, monkeypatch, path):
+    expected = run_example(path, VM, capsys, monkeypatch)
+    assert run_example(path, PythonGenerator, capsys, monkeypatch) == expected
+
+def test_python_semantics(capsys):
+    program = (
+        'struct P {int v;}\n'
+        'bool t() { print("t"); return true; }\n'
+        'bool f() { print("f"); return false; }\n'
+        'void main() {\n'
+        '  print(7 / 2); print(" "); print((0 - 7) / 2); print(" ");\n'
+        '  print(7.0 / 2.0); print(" "); print(10 - 4 - 3); print(" ");\n'
+        '  bool b = f() and t(); print(b); print(" ");\n'
+        '  print(null); print(" ");\n'
+        '  array int a = new int[2]; array int c = new int[2];\n'
+        '  print(a == c); print(a == a); print(" ");\n'
+        '  P p = new P(1); P q = new P(1);\n'
+        '  print(p == q); print(p.v == q.v); print(" ");\n'
+        '  int x = 3;\n'
+        '  if (x > 2) { int x = 10; print(x); }\n'
+        '  print(x);\n'
+        '}\n'
+    )
+    build(program).run()
+    expected = capsys.readouterr().out
+    build_python(program).run()
+    captured = capsys.readouterr()
+    assert captured.out == expected == '3 -3 3.5 9 ftfalse null falsetrue falsetrue 103'
+
+@pytest.mark.parametrize('stmt, message', [
+    ('print(p.v);', "struct access can't have None type"),
+    ('p.v = 1;', "struct access can't have None type"),
+    ('int x = null; print(x + 1);', 'operands cant be None during operator use'),
+    ('int x = null; print(x < 1);', 'operands cant be None during operator use'),
+])
+def test_python_null_errors(stmt, message):
+    program = (
+        'struct P {int v;}\n'
+        'void main() {\n'
+        '  P p = null;\n'
+        f'  {stmt}\n'
+        '}\n'
+    )
+    with pytest.raises(MyPLError) as e:
+        build_python(program).run()
+    assert str(e.value) == f'VM Error: {message}'
+
+def test_python_internal_errors_propagate(monkeypatch):
+    def broken(msg):
+        raise TypeError('broken helper')
+    monkeypatch.setitem(RUNTIME, 'write', broken)
+    with pytest.raises(TypeError):
+        build_python('void main() { print("x"); }').run()